@@ -27,7 +27,7 @@ export default function (ngModule) {
 
   function loadPublicDashboard($http, $route) {
     const token = $route.current.params.token;
-    return $http.get(`/api/dashboards/public/${token}`).then(response =>
+    return $http.get(`/api/dashboards/public/${token}`, { params: { result_format: 2 } }).then(response =>
        response.data
     );
   }
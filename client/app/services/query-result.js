@@ -1,9 +1,21 @@
 import debug from 'debug';
 import moment from 'moment';
-import { uniq, contains, values, some, each, isArray, isNumber, isString } from 'underscore';
+import { uniq, contains, values, some, each, isArray, isNumber, isString, object, pluck } from 'underscore';
 
 const logger = debug('redash:services:QueryResult');
 
+// Results are requested in the compact format (rows as arrays of values, ordered as the columns), and expanded into
+// row objects when loaded.
+const RESULT_FORMAT = 2;
+
+function expandRows(data) {
+  if (data.format === RESULT_FORMAT) {
+    const columnNames = pluck(data.columns, 'name');
+    data.rows = data.rows.map(row => object(columnNames, row));
+    delete data.format;
+  }
+}
+
 function getColumnNameWithoutType(column) {
   let typeSplit;
   if (column.indexOf('::') !== -1) {
@@ -46,7 +58,8 @@ function addPointToSeries(point, seriesCollection, seriesName) {
 
 
 function QueryResultService($resource, $timeout, $q) {
-  const QueryResultResource = $resource('api/query_results/:id', { id: '@id' }, { post: { method: 'POST' } });
+  const QueryResultResource = $resource('api/query_results/:id', { id: '@id', result_format: RESULT_FORMAT },
+                                        { post: { method: 'POST' } });
   const Job = $resource('api/jobs/:id', { id: '@id' });
   const statuses = {
     1: 'waiting',
@@ -79,6 +92,8 @@ function QueryResultService($resource, $timeout, $q) {
         this.filters = undefined;
         this.filterFreeze = undefined;
 
+        expandRows(this.query_result.data);
+
         const columnTypes = {};
 
         // TODO: we should stop manipulating incoming data, and switch to relaying
@@ -8,7 +8,7 @@ from flask_script import Manager
 
 from redash import settings, models, __version__
 from redash.wsgi import app
-from redash.cli import users, groups, database, data_sources, organization
+from redash.cli import users, groups, database, data_sources, organization, query_results
 from redash.monitor import get_status
 
 manager = Manager(app)
@@ -17,6 +17,7 @@ manager.add_command("users", users.manager)
 manager.add_command("groups", groups.manager)
 manager.add_command("ds", data_sources.manager)
 manager.add_command("org", organization.manager)
+manager.add_command("query_results", query_results.manager)
 
 
 
@@ -0,0 +1,16 @@
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+from redash.models import db
+from redash import models
+
+if __name__ == '__main__':
+    db.connect_db()
+    migrator = PostgresqlMigrator(db.database)
+
+    with db.database.transaction():
+        migrate(
+            migrator.add_column('query_results', 'data_location', models.QueryResult.data_location),
+            migrator.add_column('query_results', 'data_size', models.QueryResult.data_size),
+            migrator.add_column('query_results', 'data_checksum', models.QueryResult.data_checksum),
+        )
+    db.close_db(None)
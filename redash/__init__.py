@@ -13,6 +13,7 @@ from flask_limiter.util import get_ipaddr
 from redash import settings
 from redash.query_runner import import_query_runners
 from redash.destinations import import_destinations
+from redash.results_storage import import_results_storages
 
 
 __version__ = '1.0.0'
@@ -58,6 +59,7 @@ limiter = Limiter(key_func=get_ipaddr, storage_uri=settings.REDIS_URL)
 
 import_query_runners(settings.QUERY_RUNNERS)
 import_destinations(settings.DESTINATIONS)
+import_results_storages(settings.QUERY_RESULTS_STORAGES)
 
 from redash.version_check import reset_new_version_status
 reset_new_version_status()
@@ -45,6 +45,8 @@ class PgModelConverter(CustomModelConverter):
         additional = {ArrayField: self.handle_array_field,
                       DateTimeTZField: self.handle_datetime_tz_field,
                       models.JSONField: self.handle_json_field,
+                      models.CompressedTextField: self.handle_json_field,
+                      models.QueryResultDataField: self.handle_json_field,
                       }
         super(PgModelConverter, self).__init__(view, additional)
         self.view = view
@@ -0,0 +1,44 @@
+from flask_script import Manager
+from redash import models, settings
+from redash.utils import compression
+
+manager = Manager(help="Query results management commands.")
+
+
+@manager.option('--batch-size', dest='batch_size', default=500, type=int, help="Number of results to compress in each batch (default: 500).")
+def compress(batch_size=500):
+    """Compress existing query results data (see REDASH_QUERY_RESULTS_COMPRESSION_MIN_SIZE)."""
+    select_sql = "SELECT id, data FROM query_results WHERE id > %s ORDER BY id LIMIT %s"
+    update_sql = "UPDATE query_results SET data = %s WHERE id = %s"
+
+    last_id = 0
+    checked_count = 0
+    compressed_count = 0
+    bytes_before = 0
+    bytes_after = 0
+
+    while True:
+        rows = models.db.database.execute_sql(select_sql, params=(last_id, batch_size)).fetchall()
+        if not rows:
+            break
+
+        with models.db.database.transaction():
+            for result_id, data in rows:
+                last_id = result_id
+                checked_count += 1
+
+                if not data or compression.is_compressed(data) or len(data) < settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE:
+                    continue
+
+                compressed = compression.compress(data)
+                models.db.database.execute_sql(update_sql, params=(compressed, result_id))
+
+                compressed_count += 1
+                bytes_before += len(data.encode('utf-8')) if isinstance(data, unicode) else len(data)
+                bytes_after += len(compressed)
+
+        print "Checked {} results, compressed {} (last id: {}).".format(checked_count, compressed_count, last_id)
+
+    print "Done. Compressed {} out of {} results, saved {} bytes ({} -> {}).".format(compressed_count, checked_count,
+                                                                                     bytes_before - bytes_after,
+                                                                                     bytes_before, bytes_after)
@@ -0,0 +1,99 @@
+"""
+Cache of rendered query result exports (CSV, Excel and other file downloads).
+
+Query results never change once stored, so an export of a result can be served again as is. Exports are kept in
+Redis, under a key derived from the result id, the export format and its options. The cache is bounded by
+settings.QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE (in bytes) and the least recently used exports are evicted when it's
+full. Exports of a result are removed when the result is deleted (see `invalidate`).
+"""
+import hashlib
+import json
+import time
+
+from redash import redis_connection, settings
+
+_LRU_KEY = 'export_cache:lru'
+_SIZES_KEY = 'export_cache:sizes'
+_TOTAL_SIZE_KEY = 'export_cache:size'
+
+
+def _key(query_result_id, filetype, options):
+    options_hash = hashlib.sha1(json.dumps(options or {}, sort_keys=True)).hexdigest()
+    return 'export_cache:{}:{}:{}'.format(query_result_id, filetype, options_hash)
+
+
+def _result_keys_key(query_result_id):
+    return 'export_cache:result:{}'.format(query_result_id)
+
+
+def enabled():
+    return settings.QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE > 0
+
+
+def max_export_size():
+    """Return the size (in bytes) of the biggest export that is cached."""
+    return settings.QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE // 4
+
+
+def get(query_result_id, filetype, options=None):
+    """Return the cached export of the query result, or None if it isn't cached."""
+    if not enabled():
+        return None
+
+    key = _key(query_result_id, filetype, options)
+    data = redis_connection.get(key)
+    if data is not None:
+        redis_connection.zadd(_LRU_KEY, time.time(), key)
+
+    return data
+
+
+def put(query_result_id, filetype, data, options=None):
+    if not enabled() or len(data) > max_export_size():
+        return
+
+    key = _key(query_result_id, filetype, options)
+
+    pipe = redis_connection.pipeline()
+    pipe.set(key, data)
+    pipe.zadd(_LRU_KEY, time.time(), key)
+    pipe.sadd(_result_keys_key(query_result_id), key)
+    pipe.hget(_SIZES_KEY, key)
+    pipe.hset(_SIZES_KEY, key, len(data))
+    previous_size = pipe.execute()[3]
+
+    total_size = redis_connection.incrby(_TOTAL_SIZE_KEY, len(data) - int(previous_size or 0))
+    if total_size > settings.QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE:
+        _evict()
+
+
+def _remove(keys):
+    if not keys:
+        return
+
+    sizes = redis_connection.hmget(_SIZES_KEY, keys)
+
+    pipe = redis_connection.pipeline()
+    pipe.delete(*keys)
+    pipe.zrem(_LRU_KEY, *keys)
+    pipe.hdel(_SIZES_KEY, *keys)
+    pipe.decr(_TOTAL_SIZE_KEY, sum(int(size) for size in sizes if size is not None))
+    pipe.execute()
+
+
+def _evict():
+    """Remove the least recently used exports until the cache fits in its size limit."""
+    while int(redis_connection.get(_TOTAL_SIZE_KEY) or 0) > settings.QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE:
+        keys = redis_connection.zrange(_LRU_KEY, 0, 0)
+        if not keys:
+            break
+
+        _remove(keys)
+
+
+def invalidate(query_result_ids):
+    """Remove the cached exports of the given query results."""
+    for query_result_id in query_result_ids:
+        keys = list(redis_connection.smembers(_result_keys_key(query_result_id)))
+        _remove(keys)
+        redis_connection.delete(_result_keys_key(query_result_id))
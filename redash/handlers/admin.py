@@ -5,7 +5,7 @@ from redash import models, redis_connection
 from redash.handlers import routes
 from redash.handlers.base import json_response
 from redash.permissions import require_super_admin
-from redash.tasks.queries import QueryTaskTracker
+from redash.tasks.queries import QueryTaskTracker, execution_slots_in_use
 
 
 @routes.route('/api/admin/queries/outdated', methods=['GET'])
@@ -33,10 +33,20 @@ def queries_tasks():
     in_progress = QueryTaskTracker.all(QueryTaskTracker.IN_PROGRESS_LIST)
     done = QueryTaskTracker.all(QueryTaskTracker.DONE_LIST, limit=50)
 
+    data_sources = models.DataSource.select(models.DataSource.id, models.DataSource.name,
+                                            models.DataSource.options)
+    data_sources = [ds for ds in data_sources if ds.options.get('max_concurrent_queries')]
+    slots_in_use = execution_slots_in_use([ds.id for ds in data_sources])
+
     response = {
         'waiting': [t.data for t in waiting],
         'in_progress': [t.data for t in in_progress],
-        'done': [t.data for t in done]
+        'done': [t.data for t in done],
+        'execution_slots': [{'data_source_id': ds.id,
+                             'name': ds.name,
+                             'in_use': slots_in_use[ds.id],
+                             'max_concurrent_queries': int(ds.options.get('max_concurrent_queries'))}
+                            for ds in data_sources]
     }
 
     return json_response(response)
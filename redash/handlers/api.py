@@ -10,7 +10,8 @@ from redash.handlers.dashboards import DashboardListResource, RecentDashboardsRe
 from redash.handlers.data_sources import DataSourceTypeListResource, DataSourceListResource, DataSourceSchemaResource, DataSourceResource, DataSourcePauseResource, DataSourceTestResource
 from redash.handlers.events import EventResource
 from redash.handlers.queries import QueryForkResource, QueryRefreshResource, QueryListResource, QueryRecentResource, QuerySearchResource, QueryResource, MyQueriesResource
-from redash.handlers.query_results import QueryResultListResource, QueryResultResource, JobResource
+from redash.handlers.query_results import QueryResultListResource, QueryResultResource, QueryResultAggregateResource, \
+    QueryResultBatchResource, JobResource
 from redash.handlers.users import UserResource, UserListResource, UserInviteResource, UserResetPasswordResource
 from redash.handlers.visualizations import VisualizationListResource
 from redash.handlers.visualizations import VisualizationResource
@@ -78,11 +79,14 @@ api.add_org_resource(ObjectPermissionsListResource, '/api/<object_type>/<object_
 api.add_org_resource(CheckPermissionResource, '/api/<object_type>/<object_id>/acl/<access_type>', endpoint='check_permissions')
 
 api.add_org_resource(QueryResultListResource, '/api/query_results', endpoint='query_results')
+api.add_org_resource(QueryResultBatchResource, '/api/query_results/batch', endpoint='query_results_batch')
 api.add_org_resource(QueryResultResource,
                      '/api/query_results/<query_result_id>',
                      '/api/queries/<query_id>/results.<filetype>',
                      '/api/queries/<query_id>/results/<query_result_id>.<filetype>',
                      endpoint='query_result')
+api.add_org_resource(QueryResultAggregateResource, '/api/query_results/<query_result_id>/aggregate',
+                     endpoint='query_result_aggregate')
 api.add_org_resource(JobResource, '/api/jobs/<job_id>', endpoint='job')
 
 api.add_org_resource(UserListResource, '/api/users', endpoint='users')
@@ -8,7 +8,7 @@ from redash import settings
 from redash.authentication import current_org
 from redash.models import ApiUser
 from redash.tasks import record_event as record_event_task
-from redash.utils import json_dumps
+from redash.utils import json_dumps, result_format
 
 routes = Blueprint('redash', __name__, template_folder=settings.fix_assets_path('templates'))
 
@@ -73,6 +73,22 @@ def get_object_or_404(fn, *args, **kwargs):
         abort(404)
 
 
+def get_data_format(value=None):
+    """Return the result format requested by the client (using the `result_format` argument) for the results data."""
+    if value is None:
+        value = request.args.get('result_format', result_format.V1)
+
+    try:
+        data_format = int(value)
+    except (TypeError, ValueError):
+        data_format = None
+
+    if data_format not in result_format.FORMATS:
+        abort(400, message='Unsupported result format: {}.'.format(value))
+
+    return data_format
+
+
 def paginate(query_set, page, page_size, serializer):
     count = query_set.count()
 
@@ -4,7 +4,7 @@ from flask import request, url_for
 from flask_restful import abort
 from funcy import distinct, project, take
 from redash import models, serializers
-from redash.handlers.base import BaseResource, get_object_or_404
+from redash.handlers.base import BaseResource, get_object_or_404, get_data_format
 from redash.models import ConflictDetectedError
 from redash.permissions import (can_modify, require_admin_or_owner,
                                 require_object_modify_permission,
@@ -92,7 +92,7 @@ class PublicDashboardResource(BaseResource):
         else:
             dashboard = self.current_user.object
 
-        return serializers.public_dashboard(dashboard)
+        return serializers.public_dashboard(dashboard, data_format=get_data_format())
 
 
 class DashboardShareResource(BaseResource):
@@ -6,7 +6,8 @@ from funcy import project
 from redash import models
 from redash.utils.configuration import ConfigurationContainer, ValidationError
 from redash.permissions import require_admin, require_permission, require_access, view_only
-from redash.query_runner import query_runners, get_configuration_schema_for_query_runner_type
+from redash.query_runner import query_runners, get_configuration_schema_for_query_runner_type, \
+    invalidate_data_source_query_runner
 from redash.handlers.base import BaseResource, get_object_or_404
 
 
@@ -40,6 +41,7 @@ class DataSourceResource(BaseResource):
         data_source.type = req['type']
         data_source.name = req['name']
         data_source.save()
+        invalidate_data_source_query_runner(data_source.id)
 
         return data_source.to_dict(all=True)
 
@@ -47,6 +49,7 @@ class DataSourceResource(BaseResource):
     def delete(self, data_source_id):
         data_source = models.DataSource.get_by_id_and_org(data_source_id, self.current_org)
         data_source.delete_instance(recursive=True)
+        invalidate_data_source_query_runner(data_source.id)
 
         return make_response('', 204)
 
@@ -1,18 +1,23 @@
-import csv
+import hashlib
 import json
-import cStringIO
+import tempfile
 import time
 
 import pystache
-from flask import make_response, request
+import pytz
+from flask import Response, make_response, request, send_file
 from flask_login import current_user
 from flask_restful import abort
+from werkzeug.http import is_resource_modified
 import xlsxwriter
-from redash import models, settings, utils
+from funcy import distinct
+from redash import export_cache, models, results_storage, settings, utils
+from redash.query_runner import ROWS_BATCH_SIZE
 from redash.tasks import QueryTask, record_event
 from redash.permissions import require_permission, not_view_only, has_access, require_access, view_only
-from redash.handlers.base import BaseResource, get_object_or_404
-from redash.utils import collect_query_parameters, collect_parameters_from_request
+from redash.handlers.base import BaseResource, get_object_or_404, get_data_format
+from redash.utils import arrow, collect_query_parameters, collect_parameters_from_request, columnar, compression, \
+    result_format
 from redash.tasks.queries import enqueue_query
 
 
@@ -20,7 +25,7 @@ def error_response(message):
     return {'job': {'status': 4, 'error': message}}, 400
 
 
-def run_query(data_source, parameter_values, query_text, query_id, max_age=0):
+def run_query(data_source, parameter_values, query_text, query_id, max_age=0, data_format=result_format.V1):
     query_parameters = set(collect_query_parameters(query_text))
     missing_params = set(query_parameters) - set(parameter_values.keys())
     if missing_params:
@@ -43,12 +48,33 @@ def run_query(data_source, parameter_values, query_text, query_id, max_age=0):
         query_result = models.QueryResult.get_latest(data_source, query_text, max_age)
 
     if query_result:
-        return {'query_result': query_result.to_dict()}
+        return {'query_result': query_result.to_dict(raw_data=True, data_format=data_format)}
     else:
         job = enqueue_query(query_text, data_source, current_user.id, metadata={"Username": current_user.email, "Query ID": query_id})
         return {'job': job.to_dict()}
 
 
+def cache_export(query_result_id, filetype, chunks):
+    """Yield the chunks of the export, and store the export in the export cache once all of them were sent (unless
+    it's too big to be cached).
+    """
+    cached = []
+    size = 0
+
+    for chunk in chunks:
+        if cached is not None:
+            size += len(chunk)
+            if size <= export_cache.max_export_size():
+                cached.append(chunk)
+            else:
+                cached = None
+
+        yield chunk
+
+    if cached is not None:
+        export_cache.put(query_result_id, filetype, ''.join(cached))
+
+
 class QueryResultListResource(BaseResource):
     @require_permission('execute_query')
     def post(self):
@@ -58,6 +84,7 @@ class QueryResultListResource(BaseResource):
         query = params['query']
         max_age = int(params.get('max_age', -1))
         query_id = params.get('query_id', 'adhoc')
+        data_format = get_data_format(params.get('result_format', request.args.get('result_format')))
 
         data_source = models.DataSource.get_by_id_and_org(params.get('data_source_id'), self.current_org)
 
@@ -72,11 +99,21 @@ class QueryResultListResource(BaseResource):
             'query': query
         })
 
-        return run_query(data_source, parameter_values, query, query_id, max_age)
+        return run_query(data_source, parameter_values, query, query_id, max_age, data_format)
 
 
 ONE_YEAR = 60 * 60 * 24 * 365.25
 
+EXPORT_CONTENT_TYPES = {
+    'csv': "text/csv; charset=UTF-8",
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'ndjson': "application/x-ndjson; charset=UTF-8",
+    'arrow': arrow.CONTENT_TYPE,
+}
+
+# Excel's limit of rows per sheet (including the header row).
+EXCEL_MAX_ROWS_PER_SHEET = 1048576
+
 
 class QueryResultResource(BaseResource):
     @staticmethod
@@ -142,64 +179,297 @@ class QueryResultResource(BaseResource):
 
                 record_event.delay(event)
 
-            if filetype == 'json':
-                response = self.make_json_response(query_result)
-            elif filetype == 'xlsx':
-                response = self.make_excel_response(query_result)
+            # Results are immutable, so conditional requests can be answered before loading the data:
+            content_encoding = self.get_content_encoding(filetype)
+            etag = self.get_etag(query_result, filetype, content_encoding)
+            last_modified = query_result.retrieved_at
+            if last_modified.tzinfo is not None:
+                last_modified = last_modified.astimezone(pytz.utc).replace(tzinfo=None)
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response("", 304)
+            elif filetype == 'json':
+                response = self.make_json_response(query_result, etag, content_encoding)
             else:
-                response = self.make_csv_response(query_result)
+                response = self.make_export_response(query_result, filetype)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            if filetype == 'json':
+                # The representation depends on the accepted encodings (see get_content_encoding), so caches have to
+                # tell the variants apart, 304 responses included:
+                response.headers['Vary'] = 'Accept-Encoding'
 
             if len(settings.ACCESS_CONTROL_ALLOW_ORIGIN) > 0:
                 self.add_cors_headers(response.headers)
 
             if should_cache:
                 response.headers.add_header('Cache-Control', 'max-age=%d' % ONE_YEAR)
+            else:
+                # The latest result of a query changes, so clients have to revalidate it on every use:
+                response.headers.add_header('Cache-Control', 'no-cache')
 
             return response
 
         else:
             abort(404, message='No cached result found for this query.')
 
-    def make_json_response(self, query_result):
-        data = json.dumps({'query_result': query_result.to_dict()}, cls=utils.JSONEncoder)
+    @staticmethod
+    def get_content_encoding(filetype):
+        if filetype == 'json' and settings.QUERY_RESULTS_GZIP_ENABLED and request.accept_encodings['gzip'] > 0:
+            return 'gzip'
+
+        return None
+
+    @staticmethod
+    def get_etag(query_result, filetype, content_encoding=None):
+        """Return a (strong) ETag for the representation of the result requested."""
+        parts = [query_result.id, query_result.data_checksum, query_result.retrieved_at.isoformat(),
+                 query_result.runtime, filetype, request.query_string, content_encoding]
+        return hashlib.sha1(':'.join(str(part) for part in parts)).hexdigest()
+
+    @staticmethod
+    def get_slice_args():
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', None, type=int)
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, message='Offset and limit must be non-negative integers.')
+
+        columns = request.args.get('columns')
+        columns = columns.split(',') if columns else None
+
+        return offset, limit, columns
+
+    def make_json_response(self, query_result, etag, content_encoding=None):
+        data_format = get_data_format()
+        offset, limit, columns = self.get_slice_args()
+
+        def render():
+            try:
+                query_result_dict = query_result.to_dict(raw_data=True, data_format=data_format, offset=offset,
+                                                         limit=limit, columns=columns)
+            except result_format.UnknownColumnsError as e:
+                abort(400, message=e.message)
+
+            return utils.json_dumps({'query_result': query_result_dict})
+
         headers = {'Content-Type': "application/json"}
+
+        if content_encoding == 'gzip':
+            # The gzipped response is kept in the export cache (by its ETag, which covers the requested
+            # representation), so repeated downloads of a result are served without loading, serializing or
+            # compressing it again. Whole responses of big results are also stored in the results storage, so they
+            # outlive their eviction from the cache:
+            data = export_cache.get(query_result.id, 'json.gz', {'etag': etag})
+            if data is None:
+                stored = not (offset or limit is not None or columns) and \
+                    results_storage.should_store_gzipped_json(query_result.data_size)
+                if stored:
+                    data = results_storage.load_gzipped_json(query_result.org_id, query_result.id, data_format)
+
+                if data is None:
+                    data = compression.gzip_compress(render())
+                    if stored:
+                        results_storage.store_gzipped_json(query_result.org_id, query_result.id, data_format, data)
+
+                export_cache.put(query_result.id, 'json.gz', data, {'etag': etag})
+
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            data = render()
+
         return make_response(data, 200, headers)
 
-    @staticmethod
-    def make_csv_response(query_result):
-        s = cStringIO.StringIO()
+    def make_export_response(self, query_result, filetype):
+        if filetype not in EXPORT_CONTENT_TYPES:
+            filetype = 'csv'
 
-        query_data = json.loads(query_result.data)
-        writer = csv.DictWriter(s, fieldnames=[col['name'] for col in query_data['columns']])
-        writer.writer = utils.UnicodeWriter(s)
-        writer.writeheader()
-        for row in query_data['rows']:
-            writer.writerow(row)
+        # Results don't change, so their exports are rendered once and then served from the export cache:
+        data = export_cache.get(query_result.id, filetype)
+        if data is not None:
+            return Response(data, 200, content_type=EXPORT_CONTENT_TYPES[filetype])
 
-        headers = {'Content-Type': "text/csv; charset=UTF-8"}
-        return make_response(s.getvalue(), 200, headers)
+        if filetype == 'xlsx':
+            return self.make_excel_response(query_result)
+
+        metadata, rows = query_result.iter_rows()
+        if filetype == 'ndjson':
+            chunks = utils.generate_ndjson(result_format.column_names(metadata), rows, chunk_rows=ROWS_BATCH_SIZE)
+        elif filetype == 'arrow':
+            chunks = arrow.generate_stream(metadata['columns'], rows, chunk_rows=ROWS_BATCH_SIZE)
+        else:
+            chunks = utils.generate_csv(result_format.column_names(metadata), rows, chunk_rows=ROWS_BATCH_SIZE)
+
+        return Response(cache_export(query_result.id, filetype, chunks), 200,
+                        content_type=EXPORT_CONTENT_TYPES[filetype])
 
     @staticmethod
     def make_excel_response(query_result):
-        s = cStringIO.StringIO()
+        too_many_rows_message = ('This result has too many rows to export as an Excel file (the limit is {}). '
+                                 'Please download it as CSV instead.'.format(settings.QUERY_RESULTS_EXCEL_MAX_ROWS))
+
+        # Results that are too big are refused before they're loaded, when their size (or number of rows, known from
+        # their rows index) is enough to tell:
+        if query_result.data_size and query_result.data_size > settings.QUERY_RESULTS_EXCEL_MAX_SIZE:
+            abort(400, message='This result is too big to export as an Excel file. Please download it as CSV instead.')
+        if query_result.data_index and query_result.data_index[-1][0] > settings.QUERY_RESULTS_EXCEL_MAX_ROWS:
+            abort(400, message=too_many_rows_message)
+
+        metadata, rows = query_result.iter_rows()
+        names = result_format.column_names(metadata)
+
+        # The workbook is written to a temporary file, and in constant memory mode rows are flushed as they're
+        # written, so memory use doesn't depend on the number of rows:
+        f = tempfile.TemporaryFile()
+        book = xlsxwriter.Workbook(f, {'constant_memory': True})
+
+        def add_sheet():
+            sheet_name = 'result' if not book.worksheets() else 'result {}'.format(len(book.worksheets()) + 1)
+            sheet = book.add_worksheet(sheet_name)
+            sheet.write_row(0, 0, names)
+            return sheet
+
+        sheet = add_sheet()
+        sheet_rows = EXCEL_MAX_ROWS_PER_SHEET - 1
+        for count, row in enumerate(rows):
+            if count >= settings.QUERY_RESULTS_EXCEL_MAX_ROWS:
+                f.close()
+                abort(400, message=too_many_rows_message)
+
+            # Rows beyond the sheet size limit spill onto additional sheets:
+            if count and count % sheet_rows == 0:
+                sheet = add_sheet()
+
+            sheet.write_row(count % sheet_rows + 1, 0, row)
 
-        query_data = json.loads(query_result.data)
-        book = xlsxwriter.Workbook(s)
-        sheet = book.add_worksheet("result")
+        book.close()
 
-        column_names = []
-        for (c, col) in enumerate(query_data['columns']):
-            sheet.write(0, c, col['name'])
-            column_names.append(col['name'])
+        size = f.tell()
+        if size <= export_cache.max_export_size():
+            f.seek(0)
+            export_cache.put(query_result.id, 'xlsx', f.read())
+        f.seek(0)
 
-        for (r, row) in enumerate(query_data['rows']):
-            for (c, name) in enumerate(column_names):
-                sheet.write(r + 1, c, row.get(name))
+        response = send_file(f, mimetype=EXPORT_CONTENT_TYPES['xlsx'], add_etags=False)
+        response.headers['Content-Length'] = size
+        return response
 
-        book.close()
 
-        headers = {'Content-Type': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
-        return make_response(s.getvalue(), 200, headers)
+# The maximal number of results (and queries) a batch request can ask for.
+BATCH_MAX_SIZE = 100
+# The maximal total size (in bytes, serialized) of the results returned by a batch request. Results beyond it are
+# returned in `errors` (with status 413), to be fetched on their own.
+BATCH_MAX_DATA_SIZE = 50 * 1024 * 1024
+
+
+def parse_batch_ids(params, key):
+    ids = params.get(key, [])
+    try:
+        if not isinstance(ids, list):
+            raise ValueError()
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400, message='{} must be a list of ids.'.format(key))
+
+
+class QueryResultBatchResource(BaseResource):
+    @require_permission('view_query')
+    def post(self):
+        """Return several query results (by their ids, or the ids of the queries they're the latest results of) at
+        once, such as all the results of a dashboard's widgets.
+
+        The results are fetched in a single database query, and access is checked once per data source. Results that
+        don't exist or the user has no access to are returned in `errors`.
+        """
+        params = request.get_json(force=True)
+        if not isinstance(params, dict):
+            abort(400, message='Expected an object with query_result_ids and/or query_ids.')
+
+        query_result_ids = parse_batch_ids(params, 'query_result_ids')
+        query_ids = parse_batch_ids(params, 'query_ids')
+        data_format = get_data_format(params.get('result_format', request.args.get('result_format')))
+
+        if len(query_result_ids) + len(query_ids) > BATCH_MAX_SIZE:
+            abort(400, message='A batch can have at most {} results.'.format(BATCH_MAX_SIZE))
+
+        latest_query_data = {}
+        if query_ids:
+            queries = models.Query.select(models.Query.id, models.Query.latest_query_data)\
+                .where(models.Query.id << query_ids, models.Query.org == self.current_org)
+            latest_query_data = {query.id: query._data['latest_query_data'] for query in queries}
+
+        errors = []
+        for query_id in query_ids:
+            if latest_query_data.get(query_id) is None:
+                errors.append({'query_id': query_id, 'status': 404, 'message': 'No cached result found for this query.'})
+
+        ids = distinct(query_result_ids + [i for i in latest_query_data.values() if i is not None])
+        query_results = models.QueryResult.get_by_ids_and_org(ids, self.current_org)
+
+        groups = models.DataSource.groups_by_data_source(set(r.data_source_id for r in query_results))
+        allowed = {data_source_id: has_access(data_source_groups, self.current_user, view_only)
+                   for data_source_id, data_source_groups in groups.iteritems()}
+
+        found = set(r.id for r in query_results)
+        for query_result_id in query_result_ids:
+            if query_result_id not in found:
+                errors.append({'query_result_id': query_result_id, 'status': 404, 'message': 'Query result not found.'})
+
+        for query_result in query_results:
+            if not allowed[query_result.data_source_id]:
+                errors.append({'query_result_id': query_result.id, 'status': 403,
+                               'message': 'You do not have access to this query result.'})
+
+        query_results = [r for r in query_results if allowed[r.data_source_id]]
+        allowed_ids = set(r.id for r in query_results)
+
+        # A result that alone is bigger than the limit is still returned (first), so that every result can be fetched:
+        batch, batch_size = [], 0
+        for query_result in query_results:
+            size = query_result.data_size or 0
+            if batch and batch_size + size > BATCH_MAX_DATA_SIZE:
+                errors.append({'query_result_id': query_result.id, 'status': 413,
+                               'message': 'Query result is too big to be returned in this batch.'})
+            else:
+                batch.append(query_result)
+                batch_size += size
+        latest_query_data = {query_id: query_result_id for query_id, query_result_id in latest_query_data.iteritems()
+                             if query_result_id in allowed_ids}
+
+        def generate():
+            # The results are serialized one at a time, as they're sent:
+            yield '{{"query_ids": {}, "errors": {}, "query_results": ['.format(utils.json_dumps(latest_query_data),
+                                                                              utils.json_dumps(errors))
+            for i, query_result in enumerate(batch):
+                yield (', ' if i else '') + utils.json_dumps(query_result.to_dict(raw_data=True,
+                                                                                  data_format=data_format))
+            yield ']}'
+
+        return Response(generate(), 200, content_type="application/json")
+
+
+class QueryResultAggregateResource(BaseResource):
+    @require_permission('view_query')
+    def post(self, query_result_id):
+        """Filter, group and sort the query result's data on the server (see `redash.utils.columnar` for the spec)."""
+        query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query_result_id, self.current_org)
+        require_access(query_result.data_source.groups, self.current_user, view_only)
+
+        spec = request.get_json(force=True)
+        data_format = get_data_format()
+
+        try:
+            data = query_result.aggregate(spec)
+        except columnar.InvalidSpecError as e:
+            abort(400, message=e.message)
+
+        if data_format == result_format.V2:
+            data = utils.RawJSON(data)
+        else:
+            data = result_format.convert(json.loads(data), data_format)
+
+        response = utils.json_dumps({'query_result': {'id': query_result.id, 'data': data}})
+        return make_response(response, 200, {'Content-Type': "application/json"})
 
 
 class JobResource(BaseResource):
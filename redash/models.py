@@ -15,11 +15,11 @@ from playhouse.gfk import GFKField, BaseModel
 from playhouse.postgres_ext import ArrayField, DateTimeTZField
 from permissions import has_access, view_only
 
-from redash import utils, settings, redis_connection
-from redash.query_runner import get_query_runner, get_configuration_schema_for_query_runner_type
+from redash import utils, settings, redis_connection, statsd_client, results_storage
+from redash.query_runner import get_data_source_query_runner, get_configuration_schema_for_query_runner_type
 from redash.destinations import get_destination, get_configuration_schema_for_destination_type
 from redash.metrics.database import MeteredPostgresqlExtDatabase, MeteredModel
-from redash.utils import generate_token, json_dumps
+from redash.utils import generate_token, json_dumps, compression, columnar, result_format
 from redash.utils.configuration import ConfigurationContainer
 
 
@@ -77,6 +77,49 @@ class JSONField(peewee.TextField):
         return json.loads(value)
 
 
+class CompressedTextField(peewee.TextField):
+    def db_value(self, value):
+        if value and settings.QUERY_RESULTS_COMPRESSION_ENABLED and \
+                len(value) >= settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE:
+            value = compression.compress(value)
+
+        return value
+
+    def python_value(self, value):
+        return compression.decompress(value)
+
+
+class QueryResultDataDescriptor(peewee.FieldDescriptor):
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+
+        value = instance.stored_data
+        if compression.is_compressed(value):
+            # The data is held as it's stored until it's read (so slices of it can be read without decompressing all
+            # of it, see QueryResult.get_data_slice):
+            value = compression.decompress(value)
+            if instance.data_location:
+                instance._external_data = value
+            else:
+                instance._data[self.att_name] = value
+
+        return value
+
+
+class QueryResultDataField(CompressedTextField):
+    # The data isn't selected by default (see QueryResult.select) and is loaded from the database on first access.
+    # Results kept in the external results storage, or sharing the data of another result, have only a pointer
+    # (`data_location`) in the database, and their data is fetched from where it points.
+    def add_to_class(self, model_class, name):
+        super(QueryResultDataField, self).add_to_class(model_class, name)
+        setattr(model_class, name, QueryResultDataDescriptor(self))
+
+    def python_value(self, value):
+        # Decompressed when it's read (see QueryResultDataDescriptor).
+        return value
+
+
 class BaseModel(MeteredModel):
     class Meta:
         database = db.database
@@ -563,7 +606,7 @@ class DataSource(BelongsToOrgMixin, BaseModel):
 
     @property
     def query_runner(self):
-        return get_query_runner(self.type, self.options)
+        return get_data_source_query_runner(self.id, self.type, self.options)
 
     @classmethod
     def all(cls, org, groups=None):
@@ -579,6 +622,16 @@ class DataSource(BelongsToOrgMixin, BaseModel):
         groups = DataSourceGroup.select().where(DataSourceGroup.data_source==self)
         return dict(map(lambda g: (g.group_id, g.view_only), groups))
 
+    @classmethod
+    def groups_by_data_source(cls, data_source_ids):
+        """Return the groups (as the `groups` property returns them) of each of the given data sources, by id."""
+        groups = {data_source_id: {} for data_source_id in data_source_ids}
+        if data_source_ids:
+            for dsg in DataSourceGroup.select().where(DataSourceGroup.data_source << list(data_source_ids)):
+                groups[dsg.data_source_id][dsg.group_id] = dsg.view_only
+
+        return groups
+
 
 class DataSourceGroup(BaseModel):
     data_source = peewee.ForeignKeyField(DataSource)
@@ -595,24 +648,136 @@ class QueryResult(BaseModel, BelongsToOrgMixin):
     data_source = peewee.ForeignKeyField(DataSource)
     query_hash = peewee.CharField(max_length=32, index=True)
     query = peewee.TextField()
-    data = peewee.TextField()
+    data = QueryResultDataField()
+    data_location = peewee.CharField(null=True)
+    data_size = peewee.IntegerField(null=True)
+    data_checksum = peewee.CharField(max_length=64, null=True, index=True)
+    data_index = JSONField(null=True)
     runtime = peewee.FloatField()
     retrieved_at = DateTimeTZField()
 
+    # Results with the same data as a result kept in the database point at it with a `data_location` of this prefix
+    # followed by its id (see `_create_result`):
+    DATA_HOLDER_LOCATION_PREFIX = 'query_result:'
+
     class Meta:
         db_table = 'query_results'
 
-    def to_dict(self):
+    @classmethod
+    def select(cls, *selection):
+        # `data` can be several MBs, so unless explicitly selected it's loaded only when accessed.
+        if not selection:
+            selection = [field for field in cls._meta.get_fields() if field.name != 'data']
+
+        return super(QueryResult, cls).select(*selection)
+
+    def load_deferred_data(self):
+        query_result = QueryResult.select(QueryResult.data, QueryResult.data_location)\
+            .where(QueryResult.id == self.id).get()
+        # Set directly (and not through the field descriptors), as it's not a modification of the loaded values:
+        self._data['data'] = query_result._data['data']
+        self._data['data_location'] = query_result._data['data_location']
+
+    def load_external_data(self):
+        """Return the data of results with a `data_location`, as it's stored (compressed or not)."""
+        if not hasattr(self, '_external_data'):
+            holder_id = self.data_holder_id(self.data_location)
+            if holder_id is None:
+                self._external_data = results_storage.load(self.data_location, decompress=False)
+            else:
+                holder = QueryResult.select(QueryResult.data).where(QueryResult.id == holder_id).get()
+                self._external_data = holder.stored_data
+
+        return self._external_data
+
+    @property
+    def stored_data(self):
+        """The data as it's stored (compressed or not, see `redash.utils.compression`)."""
+        if 'data' not in self._data and self.id is not None:
+            self.load_deferred_data()
+
+        if self.data_location:
+            return self.load_external_data()
+
+        return self._data.get('data')
+
+    def get_data_slice(self, offset=0, limit=None, columns=None):
+        """Return the data with only the rows in the given range (and only the given columns, if any), along with the
+        total number of rows (`total_rows`).
+
+        Results with a rows index are sliced without parsing rows out of the range, and results compressed in blocks
+        (see `redash.utils.result_format`) without decompressing them either.
+        """
+        if self.data_index:
+            data = result_format.read_rows(self.stored_data, self.data_index, offset, limit)
+            data['total_rows'] = self.data_index[-1][0]
+        else:
+            data = json.loads(self.data)
+            data['total_rows'] = len(data['rows'])
+            data['rows'] = data['rows'][offset:None if limit is None else offset + limit]
+
+        if columns:
+            data = result_format.project_columns(data, columns)
+
+        return data
+
+    def iter_rows(self):
+        """Return the metadata of the data (without rows) and an iterator of its rows as lists of values (see
+        `result_format.iter_rows`). The data is decompressed as the rows are read, unless the result has no rows index.
+        """
+        return result_format.iter_rows(self.stored_data, self.data_index)
+
+    def to_dict(self, raw_data=False, data_format=result_format.V1, offset=0, limit=None, columns=None):
+        """
+        :param raw_data: return the data as RawJSON, to be included in a json_dumps output without parsing it (when
+                         it's stored in the requested format).
+        :param data_format: the result format (see `redash.utils.result_format`) to return the data in.
+        :param offset, limit, columns: return only a range of the rows and only the given columns (see
+                                       `get_data_slice`).
+        """
+        if offset or limit is not None or columns:
+            data = result_format.convert(self.get_data_slice(offset, limit, columns), data_format)
+        else:
+            data = self.data
+            if raw_data and result_format.get_serialized_format(data) == data_format:
+                data = utils.RawJSON(data)
+            else:
+                data = result_format.convert(json.loads(data), data_format)
+
         return {
             'id': self.id,
             'query_hash': self.query_hash,
             'query': self.query,
-            'data': json.loads(self.data),
+            'data': data,
             'data_source_id': self.data_source_id,
             'runtime': self.runtime,
             'retrieved_at': self.retrieved_at
         }
 
+    def aggregate(self, spec):
+        """Return the (serialized) output of the filtering/grouping/sorting operations of the spec over the data (see
+        `redash.utils.columnar`). Outputs are cached, as results are immutable.
+        """
+        columnar.validate(spec)
+
+        spec_hash = hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()
+        key = 'query_result:{}:aggregate:{}'.format(self.id, spec_hash)
+
+        output = redis_connection.get(key)
+        if output is None:
+            output = json_dumps(columnar.execute(json.loads(self.data), spec))
+            redis_connection.set(key, output, ex=settings.QUERY_RESULTS_AGGREGATION_CACHE_TTL)
+
+        return output
+
+    @classmethod
+    def get_by_ids_and_org(cls, ids, org):
+        """Return the query results with the given ids (including their data), in a single query."""
+        if not ids:
+            return []
+
+        return list(cls.select(*cls._meta.get_fields()).where(cls.id << list(ids), cls.org == org))
+
     @classmethod
     def unused(cls, days=7):
         age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
@@ -637,16 +802,27 @@ class QueryResult(BaseModel, BelongsToOrgMixin):
         return query.first()
 
     @classmethod
-    def store_result(cls, org_id, data_source_id, query_hash, query, data, run_time, retrieved_at):
-        query_result = cls.create(org=org_id,
-                                  query_hash=query_hash,
-                                  query=query,
-                                  runtime=run_time,
-                                  data_source=data_source_id,
-                                  retrieved_at=retrieved_at,
-                                  data=data)
+    def recent_runtimes(cls, data_source_id, query_hash=None, limit=20):
+        """Return the runtimes of the latest results of the data source (of the given query only, if any)."""
+        query = cls.select(cls.runtime).where(cls.data_source == data_source_id)
+        if query_hash is not None:
+            query = query.where(cls.query_hash == query_hash)
+
+        return [r.runtime for r in query.order_by(cls.id.desc()).limit(limit)]
 
-        logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
+    @classmethod
+    def store_result(cls, org_id, data_source_id, query_hash, query, data, run_time, retrieved_at, data_checksum=None,
+                     data_size=None, data_index=None):
+        """
+        :param data: the JSON serialized result, or its compressed form (with the checksum and size of the
+                     uncompressed data given in `data_checksum` and `data_size`).
+        :param data_index: the rows index of the result (see `redash.utils.result_format`), if available.
+        """
+        if data_checksum is None:
+            data_checksum, data_size = results_storage.data_checksum(data)
+
+        query_result = cls._create_result(org_id, data_source_id, query_hash, query, data, data_checksum, data_size,
+                                          data_index, run_time, retrieved_at)
 
         sql = "UPDATE queries SET latest_query_data_id = %s WHERE query_hash = %s AND data_source_id = %s RETURNING id"
         query_ids = [row[0] for row in db.database.execute_sql(sql, params=(query_result.id, query_hash, data_source_id))]
@@ -660,6 +836,84 @@ class QueryResult(BaseModel, BelongsToOrgMixin):
 
         return query_result, query_ids
 
+    @classmethod
+    def data_lock(cls, data_checksum):
+        """Return the lock held while stored data (with the given data checksum) is shared with a new result, or
+        removed once no result uses it.
+        """
+        return redis_connection.lock('query_results:data_lock:{}'.format(data_checksum), timeout=5 * 60)
+
+    @classmethod
+    def data_holder_id(cls, data_location):
+        """Return the id of the result holding the data in the database, for locations of results pointing at it (see
+        `_create_result`), or None for locations in the results storage.
+        """
+        if data_location and data_location.startswith(cls.DATA_HOLDER_LOCATION_PREFIX):
+            return int(data_location[len(cls.DATA_HOLDER_LOCATION_PREFIX):])
+
+        return None
+
+    @classmethod
+    def hand_over_data(cls, query_result_id):
+        """Move the data of the given result to one of the results pointing at it (if there are any), and point the
+        others (as well as the given result) at it instead, so the given result can be deleted. Must be called while
+        holding the data lock.
+        """
+        location = cls.DATA_HOLDER_LOCATION_PREFIX + str(query_result_id)
+        heir = cls.select(cls.id).where(cls.data_location == location).order_by(cls.id.desc()).first()
+        if heir is None:
+            return
+
+        with db.database.atomic():
+            # Copied within the database, so the data isn't loaded:
+            sql = "UPDATE query_results SET data = holder.data, data_index = holder.data_index, data_location = NULL " \
+                  "FROM query_results AS holder WHERE query_results.id = %s AND holder.id = %s"
+            db.database.execute_sql(sql, params=(heir.id, query_result_id))
+            cls.update(data_location=cls.DATA_HOLDER_LOCATION_PREFIX + str(heir.id))\
+                .where((cls.data_location == location) | (cls.id == query_result_id)).execute()
+
+    @classmethod
+    def _create_result(cls, org_id, data_source_id, query_hash, query, data, data_checksum, data_size, data_index,
+                       run_time, retrieved_at):
+        # Identical data (of this or other queries) is stored only once and shared by the results: results in the
+        # results storage share its content addressed blob, and results in the database point at the result holding
+        # the data. The lock keeps cleanup_query_results from removing data that is about to be shared.
+        with cls.data_lock(data_checksum):
+            if settings.QUERY_RESULTS_DEDUPLICATION_ENABLED:
+                existing = cls.select(cls.id, cls.data_location, cls.data_index)\
+                    .where(cls.org == org_id, cls.data_checksum == data_checksum).first()
+            else:
+                existing = None
+
+            if existing:
+                data_location = existing.data_location or cls.DATA_HOLDER_LOCATION_PREFIX + str(existing.id)
+                data_index = existing.data_index
+                stored_data = ''
+                statsd_client.incr('query_results.dedup.hit')
+                statsd_client.incr('query_results.dedup.saved_bytes', data_size)
+            else:
+                if settings.QUERY_RESULTS_DEDUPLICATION_ENABLED:
+                    statsd_client.incr('query_results.dedup.miss')
+
+                if results_storage.should_store_externally(data_size):
+                    data_location = results_storage.store(org_id, data, data_checksum)
+                    stored_data = ''
+                else:
+                    data_location = None
+                    stored_data = data
+
+            query_result = cls.create(org=org_id, query_hash=query_hash, query=query, runtime=run_time,
+                                      data_source=data_source_id, retrieved_at=retrieved_at, data=stored_data,
+                                      data_location=data_location, data_size=data_size, data_checksum=data_checksum,
+                                      data_index=data_index)
+
+        if data_location and not compression.is_compressed(data):
+            query_result._external_data = data
+
+        logging.info("Inserted query (%s) data; id=%s location=%s", query_hash, query_result.id, data_location)
+
+        return query_result
+
     def __unicode__(self):
         return u"%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
@@ -1077,7 +1331,7 @@ class Alert(ModelTimestampsMixin, BaseModel):
     def evaluate(self):
         data = json.loads(self.query.latest_query_data.data)
         # todo: safe guard for empty
-        value = data['rows'][0][self.options['column']]
+        value = result_format.row_as_dict(data, 0)[self.options['column']]
         op = self.options['op']
 
         if op == 'greater than' and value > self.options['value']:
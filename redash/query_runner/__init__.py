@@ -1,13 +1,20 @@
+import hashlib
 import logging
 import json
+from collections import OrderedDict
 
 from redash import settings
+from redash.utils import json_dumps, compression, result_format
+from . import connection_pool
 
 logger = logging.getLogger(__name__)
 
 __all__ = [
     'BaseQueryRunner',
     'InterruptException',
+    'QueryError',
+    'QueryResultWriter',
+    'ROWS_BATCH_SIZE',
     'BaseSQLQueryRunner',
     'TYPE_DATETIME',
     'TYPE_BOOLEAN',
@@ -39,12 +46,57 @@ SUPPORTED_COLUMN_TYPES = set([
 ])
 
 
+# Number of rows to fetch (and yield from run_query_iter) at a time:
+ROWS_BATCH_SIZE = 1000
+
+# Options every data source has (in addition to its query runner configuration), limiting the size of its results.
+# The limits cap the size of the stored results, not what's fetched: query runners that stream their results (see
+# BaseQueryRunner.supports_streaming) stop reading once a result reaches them, which bounds the memory used only when
+# their driver fetches the rows incrementally too (like PostgreSQL's server side cursors, Presto and TreasureData). The
+# other runners (as well as Redshift, and PostgreSQL queries that can't be read through a cursor) load the whole result
+# before it's limited.
+RESULT_LIMITS_PROPERTIES = {
+    'max_result_rows': {
+        'type': 'number',
+        'title': 'Max Result Rows'
+    },
+    'max_result_bytes': {
+        'type': 'number',
+        'title': 'Max Result Size (Bytes)'
+    }
+}
+
+# Options every data source has, limiting its query executions:
+EXECUTION_LIMITS_PROPERTIES = {
+    'max_concurrent_queries': {
+        'type': 'number',
+        'title': 'Max Concurrent Queries'
+    },
+    'query_timeout': {
+        'type': 'number',
+        'title': 'Query Timeout (Seconds)'
+    }
+}
+
+
 class InterruptException(Exception):
     pass
 
 
+class QueryError(Exception):
+    """Raised by run_query_iter when running the query fails. The message is the error shown to the user."""
+    pass
+
+
 class BaseQueryRunner(object):
     noop_query = None
+    # Query runners that set this keep their connections open between queries (see connection_pool). They implement
+    # `connect` and `reset_connection`, can override `check_connection` and `close_connection`, and run their queries
+    # on connections from `get_connection`. Only data sources whose sessions can be reset are pooled, as the next
+    # query on a connection may be another user's.
+    pool_connections = False
+    # Set when the runner belongs to a (saved) data source, which is what its connections are pooled by:
+    data_source_id = None
 
     def __init__(self, configuration):
         self.syntax = 'sql'
@@ -78,9 +130,117 @@ class BaseQueryRunner(object):
         if error is not None:
             raise Exception(error)
 
+    @classmethod
+    def full_configuration_schema(cls):
+        schema = dict(cls.configuration_schema())
+        schema['properties'] = dict(schema.get('properties', {}), **RESULT_LIMITS_PROPERTIES)
+        schema['properties'].update(EXECUTION_LIMITS_PROPERTIES)
+        return schema
+
+    def _get_limit(self, name):
+        limit = self.configuration.get(name)
+        return int(limit) if limit else None
+
+    @property
+    def max_result_rows(self):
+        return self._get_limit('max_result_rows')
+
+    @property
+    def max_result_bytes(self):
+        return self._get_limit('max_result_bytes')
+
+    @property
+    def max_concurrent_queries(self):
+        return self._get_limit('max_concurrent_queries')
+
+    @property
+    def query_timeout(self):
+        """Return how long (in seconds) queries can run, or None if they can run for as long as they take. Queries that
+        time out are interrupted with Celery's SoftTimeLimitExceeded, which query runners that can cancel their
+        queries should catch (like KeyboardInterrupt), cancel the query and re-raise.
+        """
+        return self._get_limit('query_timeout') or settings.QUERY_TIMEOUT or None
+
+    @classmethod
+    def supports_streaming(cls):
+        return cls.run_query_iter.__func__ is not BaseQueryRunner.run_query_iter.__func__
+
     def run_query(self, query, user):
+        """Run the query, and return a tuple of its JSON serialized result and an error (if the query failed).
+
+        Query runners implement either this or `run_query_iter`, which is used to implement this one.
+        """
+        if not self.supports_streaming():
+            raise NotImplementedError()
+
+        try:
+            results = self.run_query_iter(query, user)
+            writer = QueryResultWriter(next(results), compress=False, output_format=result_format.V1)
+            for rows in results:
+                writer.write_rows(rows)
+        except QueryError as e:
+            return None, e.message
+
+        return writer.finish(), None
+
+    def run_query_iter(self, query, user):
+        """Run the query, and yield its result incrementally: first a dict with its metadata (the `columns` and any
+        other key of the result besides `rows`), then lists of rows. Rows are sequences of values, ordered as the
+        columns (the V2 result format). Raise QueryError if the query fails.
+
+        For query runners implementing only `run_query`, this runs the whole query and then yields its rows in batches
+        (so converting them stops as soon as the caller stops iterating, like when the result reached its limits).
+        """
+        data, error = self.run_query(query, user)
+        if error is not None:
+            raise QueryError(error)
+
+        data = json.loads(data)
+        rows = data.pop('rows', [])
+        yield data
+
+        names = result_format.column_names(data)
+        for i in xrange(0, len(rows), ROWS_BATCH_SIZE):
+            yield result_format.rows_to_arrays(names, rows[i:i + ROWS_BATCH_SIZE])
+
+    def connect(self):
+        """Open a new connection to the data source."""
+        raise NotImplementedError()
+
+    def check_connection(self, connection):
+        """Raise an exception if the (idle) connection can't be used anymore. Called before it's reused."""
+        cursor = connection.cursor()
+        try:
+            cursor.execute(self.noop_query)
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def reset_connection(self, connection):
+        """Prepare the connection to run the next query, after it ran one: end its transaction and reset any session
+        state a query can change (settings, current database, temporary tables...). Raise an exception if it can't be
+        reused.
+        """
         raise NotImplementedError()
 
+    def close_connection(self, connection):
+        connection.close()
+
+    def get_connection(self):
+        """Return a connection to the data source: an idle one from its pool if there's one, or a new one. It has to be
+        given back with `release_connection` (or `discard_connection`) once the query is done.
+        """
+        return connection_pool.acquire(self)
+
+    def release_connection(self, connection):
+        connection_pool.release(self, connection)
+
+    def discard_connection(self, connection):
+        """Close the connection, instead of returning it to the pool. Query runners call this after cancelling a query
+        (or when it fails in a way that may have left the connection in an unknown state).
+        """
+        connection_pool.discard(self, connection)
+
     def fetch_columns(self, columns):
         column_names = []
         duplicates_counter = 1
@@ -114,7 +274,7 @@ class BaseQueryRunner(object):
         return {
             'name': cls.name(),
             'type': cls.type(),
-            'configuration_schema': cls.configuration_schema()
+            'configuration_schema': cls.full_configuration_schema()
         }
 
 
@@ -138,6 +298,116 @@ class BaseSQLQueryRunner(BaseQueryRunner):
                 res = self._run_query_internal('select count(*) as cnt from %s' % t)
                 tables_dict[t]['size'] = res[0]['cnt']
 
+
+class QueryResultWriter(object):
+    """Serializes a query result written incrementally (as yielded by `run_query_iter`), compressing it along the
+    way, so only the compressed result is kept in memory.
+
+    Rows beyond `max_rows`, or beyond the point the result reaches `max_bytes`, are dropped and the result is marked
+    as truncated. Along with the result, it builds its rows index (see `redash.utils.result_format`).
+    """
+
+    def __init__(self, metadata, compress=None, output_format=result_format.V2, max_rows=None, max_bytes=None):
+        if compress is None:
+            compress = settings.QUERY_RESULTS_COMPRESSION_ENABLED
+
+        self._compressor = compression.Compressor() if compress else None
+        self._chunks = []
+        self._checksum = hashlib.sha256()
+        self.size = 0
+        self.row_count = 0
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.truncated = False
+        self.index = []
+
+        # Rows are written as they're yielded (arrays) for V2, and converted to dicts for V1:
+        self._column_names = result_format.column_names(metadata) if output_format == result_format.V1 else None
+        self._write(result_format.serialize_header(metadata, output_format))
+
+    def _write(self, chunk):
+        self._checksum.update(chunk)
+        self.size += len(chunk)
+
+        if self._compressor:
+            self._compressor.write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def _serialize_rows(self, rows):
+        chunk = json_dumps(rows)[1:-1]
+        if self.row_count:
+            chunk = ', ' + chunk
+
+        return chunk
+
+    def _add_index_entry(self, position):
+        entry = [self.row_count, position]
+        if self._compressor:
+            # Every entry starts a block, so each range of rows between entries can be decompressed on its own:
+            entry.append(self._compressor.start_block())
+
+        self.index.append(entry)
+
+    def _write_rows_chunk(self, count, chunk):
+        if not self.index or self.row_count - self.index[-1][0] >= ROWS_BATCH_SIZE:
+            self._add_index_entry(self.size + (len(', ') if self.row_count else 0))
+
+        self.row_count += count
+        self._write(chunk)
+
+    def write_rows(self, rows):
+        # Big batches are split, to keep the rows index granular:
+        for i in range(0, len(rows), ROWS_BATCH_SIZE):
+            self._write_batch(rows[i:i + ROWS_BATCH_SIZE])
+
+    def _write_batch(self, rows):
+        if not rows or self.truncated:
+            return
+
+        if self.max_rows is not None and self.row_count + len(rows) > self.max_rows:
+            rows = rows[:self.max_rows - self.row_count]
+            self.truncated = True
+
+        if self._column_names is not None:
+            rows = result_format.rows_to_dicts(self._column_names, rows)
+
+        chunk = self._serialize_rows(rows)
+
+        if self.max_bytes is not None and self.size + len(chunk) > self.max_bytes:
+            # Write the rows that still fit one by one:
+            self.truncated = True
+            for row in rows:
+                chunk = self._serialize_rows([row])
+                if self.size + len(chunk) > self.max_bytes:
+                    break
+
+                self._write_rows_chunk(1, chunk)
+        elif rows:
+            self._write_rows_chunk(len(rows), chunk)
+
+    @property
+    def checksum(self):
+        return self._checksum.hexdigest()
+
+    def finish(self):
+        """Return the serialized result (compressed, unless it's smaller than the compression threshold)."""
+        if not self.index:
+            self._add_index_entry(self.size)
+        self._add_index_entry(self.size)
+        self._write('], "truncated": true}' if self.truncated else ']}')
+
+        if not self._compressor:
+            return ''.join(self._chunks)
+
+        data = self._compressor.finish()
+        if self.size < settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE:
+            data = compression.decompress(data)
+            self.index = [entry[:2] for entry in self.index]
+
+        return data
+
+
 query_runners = {}
 
 
@@ -150,12 +420,50 @@ def register(query_runner_class):
         logger.warning("%s query runner enabled but not supported, not registering. Either disable or install missing dependencies.", query_runner_class.name())
 
 
-def get_query_runner(query_runner_type, configuration):
+def get_query_runner(query_runner_type, configuration, data_source_id=None):
     query_runner_class = query_runners.get(query_runner_type, None)
     if query_runner_class is None:
         return None
 
-    return query_runner_class(configuration)
+    query_runner = query_runner_class(configuration)
+    query_runner.data_source_id = data_source_id
+    return query_runner
+
+
+# The number of data sources whose query runners are cached (the least recently used are evicted first, so runners of
+# data sources deleted by other processes, which are never asked for again, don't stay forever):
+DATA_SOURCE_QUERY_RUNNERS_CACHE_SIZE = 100
+# Query runners of data sources, by data source id, with the (type, options hash) they were created for, least recently
+# used first:
+_data_source_query_runners = OrderedDict()
+
+
+def get_data_source_query_runner(data_source_id, query_runner_type, configuration):
+    """Return the query runner of the data source. It's created once per process (and whenever the data source's type
+    or options change), so runners can keep state between queries, like connection pools and access tokens.
+    """
+    options_hash = hashlib.sha1(json.dumps(dict(configuration.iteritems()), sort_keys=True, default=unicode)).hexdigest()
+    key = (query_runner_type, options_hash)
+
+    cached = _data_source_query_runners.pop(data_source_id, None)
+    if cached is not None and cached[0] == key:
+        query_runner = cached[1]
+    else:
+        query_runner = get_query_runner(query_runner_type, configuration, data_source_id)
+
+    if query_runner is not None:
+        _data_source_query_runners[data_source_id] = (key, query_runner)
+        while len(_data_source_query_runners) > DATA_SOURCE_QUERY_RUNNERS_CACHE_SIZE:
+            _data_source_query_runners.popitem(last=False)
+
+    return query_runner
+
+
+def invalidate_data_source_query_runner(data_source_id):
+    """Drop the cached query runner of the data source (of this process; other processes create a new one when they
+    see the data source's new options).
+    """
+    _data_source_query_runners.pop(data_source_id, None)
 
 
 def get_configuration_schema_for_query_runner_type(query_runner_type):
@@ -163,7 +471,7 @@ def get_configuration_schema_for_query_runner_type(query_runner_type):
     if query_runner_class is None:
         return None
 
-    return query_runner_class.configuration_schema()
+    return query_runner_class.full_configuration_schema()
 
 
 def import_query_runners(query_runner_imports):
@@ -16,6 +16,8 @@ except ImportError:
 
 class Cassandra(BaseQueryRunner):
     noop_query = "SELECT * FROM system"
+    # The connections are sessions, each with its own cluster (which keeps its connections to the nodes):
+    pool_connections = True
 
     @classmethod
     def enabled(cls):
@@ -61,17 +63,37 @@ class Cassandra(BaseQueryRunner):
         results, error = self.run_query(query, None)
         return results, error
 
+    def connect(self):
+        if self.configuration.get('username', '') and self.configuration.get('password', ''):
+            auth_provider = PlainTextAuthProvider(username='{}'.format(self.configuration.get('username', '')),
+                                                  password='{}'.format(self.configuration.get('password', '')))
+            cluster = Cluster([self.configuration.get('host', '')], auth_provider=auth_provider)
+        else:
+            cluster = Cluster([self.configuration.get('host', '')])
+
+        try:
+            return cluster.connect()
+        except Exception:
+            cluster.shutdown()
+            raise
+
+    def check_connection(self, session):
+        # The driver reconnects to the nodes by itself, so sessions are usable until they're shut down:
+        if session.is_shutdown:
+            raise Exception("Session was shut down.")
+
+    def reset_connection(self, session):
+        # Sessions are opened without a keyspace, and a USE query can't be undone:
+        if session.keyspace is not None:
+            raise Exception("Session keyspace was changed.")
+
+    def close_connection(self, session):
+        session.cluster.shutdown()
+
     def run_query(self, query, user):
-        connection = None
+        session = None
         try:
-            if self.configuration.get('username', '') and self.configuration.get('password', ''):
-                auth_provider = PlainTextAuthProvider(username='{}'.format(self.configuration.get('username', '')),
-                                                      password='{}'.format(self.configuration.get('password', '')))
-                connection = Cluster([self.configuration.get('host', '')], auth_provider=auth_provider)
-            else:
-                connection = Cluster([self.configuration.get('host', '')])
-
-            session = connection.connect()
+            session = self.get_connection()
             logger.debug("Cassandra running query: %s", query)
             result = session.execute(query)
 
@@ -86,8 +108,12 @@ class Cassandra(BaseQueryRunner):
 
             error = None
         except KeyboardInterrupt:
+            self.discard_connection(session)
             error = "Query cancelled by user."
             json_data = None
+        finally:
+            if session:
+                self.release_connection(session)
 
         return json_data, error
 
@@ -0,0 +1,169 @@
+"""
+Per process pools of query runner connections.
+
+Opening a connection to a data source (with its TLS and authentication handshakes) can take longer than running a
+quick query, so query runners that support it (see BaseQueryRunner.pool_connections) keep their connections open
+between queries. Each process has a pool per data source and options (changing the options of a data source starts a
+new pool), which keeps up to settings.QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS idle connections. Idle connections are
+checked before they're reused, and closed once they were idle for settings.QUERY_RUNNER_POOL_MAX_IDLE_TIME seconds.
+Connections that were used by cancelled queries are closed instead of returned to the pool (see `discard`).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pools = {}
+_pools_pid = None
+# The pools (or None for connections that aren't pooled) of the connections in use, by connection id:
+_checked_out = {}
+
+
+def _close(runner, connection):
+    try:
+        runner.close_connection(connection)
+    except Exception:
+        logger.warning("Failed closing connection of %s.", runner.type(), exc_info=1)
+
+
+class ConnectionPool(object):
+    def __init__(self, runner):
+        # Used to open, check and close the connections (all runners of a pool have the same configuration):
+        self.runner = runner
+        self.idle = []
+
+    def acquire(self):
+        while True:
+            with _lock:
+                if not self.idle:
+                    break
+                connection, released_at = self.idle.pop()
+
+            if time.time() - released_at > settings.QUERY_RUNNER_POOL_MAX_IDLE_TIME:
+                _close(self.runner, connection)
+                continue
+
+            try:
+                self.runner.check_connection(connection)
+                return connection
+            except Exception:
+                logger.info("Closing broken connection of %s.", self.runner.type(), exc_info=1)
+                _close(self.runner, connection)
+
+        return self.runner.connect()
+
+    def release(self, connection):
+        try:
+            self.runner.reset_connection(connection)
+        except Exception:
+            logger.info("Closing connection of %s that failed to reset.", self.runner.type(), exc_info=1)
+            _close(self.runner, connection)
+            return
+
+        with _lock:
+            if len(self.idle) < settings.QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS:
+                self.idle.append((connection, time.time()))
+                return
+
+        _close(self.runner, connection)
+
+    def close_expired(self):
+        oldest_release = time.time() - settings.QUERY_RUNNER_POOL_MAX_IDLE_TIME
+        with _lock:
+            expired = [c for c, released_at in self.idle if released_at < oldest_release]
+            self.idle = [(c, released_at) for c, released_at in self.idle if released_at >= oldest_release]
+
+        for connection in expired:
+            _close(self.runner, connection)
+
+    def close_all(self):
+        with _lock:
+            idle, self.idle = self.idle, []
+
+        for connection, _ in idle:
+            _close(self.runner, connection)
+
+
+def _pool_key(runner):
+    configuration = json.dumps(dict(runner.configuration.iteritems()), sort_keys=True, default=unicode)
+    return runner.data_source_id, hashlib.sha1(runner.type() + configuration).hexdigest()
+
+
+def _get_pool(runner):
+    global _pools, _pools_pid
+
+    with _lock:
+        # Connections opened before the process forked are shared with its parent, so they're left to it:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+
+        key = _pool_key(runner)
+        if key not in _pools:
+            _pools[key] = ConnectionPool(runner)
+
+        pool = _pools[key]
+        pools = _pools.values()
+
+    # Connections of data sources that stopped running queries (or changed their options) are closed eventually:
+    for other_pool in pools:
+        other_pool.close_expired()
+
+    return pool
+
+
+def is_pooled(runner):
+    return (runner.pool_connections and runner.data_source_id is not None and
+            settings.QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS > 0)
+
+
+def acquire(runner):
+    """Return a connection of the runner: an idle one from its pool if there's one, or a new one."""
+    pool = _get_pool(runner) if is_pooled(runner) else None
+    connection = pool.acquire() if pool else runner.connect()
+
+    with _lock:
+        _checked_out[id(connection)] = pool
+
+    return connection
+
+
+def release(runner, connection):
+    """Return the connection to its pool, once the runner is done with it (or close it, if it isn't pooled)."""
+    with _lock:
+        if id(connection) not in _checked_out:
+            return
+        pool = _checked_out.pop(id(connection))
+
+    if pool is None:
+        _close(runner, connection)
+    else:
+        pool.release(connection)
+
+
+def discard(runner, connection):
+    """Close the connection instead of returning it to its pool, like when the query it ran was cancelled and it may
+    be left in an unknown state.
+    """
+    with _lock:
+        if id(connection) not in _checked_out:
+            return
+        del _checked_out[id(connection)]
+
+    _close(runner, connection)
+
+
+def close_all():
+    """Close the idle connections of all the pools."""
+    with _lock:
+        pools = _pools.values()
+
+    for pool in pools:
+        pool.close_all()
@@ -3,6 +3,7 @@ import logging
 import sys
 
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 from redash.utils import JSONEncoder
 
@@ -136,6 +137,10 @@ class DynamoDBSQL(BaseSQLQueryRunner):
         except (SyntaxError, RuntimeError) as e:
             error = e.message
             json_data = None
+        except SoftTimeLimitExceeded:
+            if connection:
+                connection.cancel()
+            raise
         except KeyboardInterrupt:
             if connection:
                 connection.cancel()
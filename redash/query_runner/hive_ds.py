@@ -2,6 +2,7 @@ import json
 import logging
 import sys
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 from redash.utils import JSONEncoder
 
@@ -121,6 +122,9 @@ class Hive(BaseSQLQueryRunner):
             data = {'columns': columns, 'rows': rows}
             json_data = json.dumps(data, cls=JSONEncoder)
             error = None
+        except SoftTimeLimitExceeded:
+            connection.cancel()
+            raise
         except KeyboardInterrupt:
             connection.cancel()
             error = "Query cancelled by user."
@@ -2,6 +2,7 @@ import json
 import logging
 import sys
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 from redash.utils import JSONEncoder
 
@@ -132,6 +133,9 @@ class Impala(BaseSQLQueryRunner):
             logging.exception(e)
             json_data = None
             error = "Metastore Error [%s]" % e.message
+        except SoftTimeLimitExceeded:
+            connection.cancel()
+            raise
         except KeyboardInterrupt:
             connection.cancel()
             error = "Query cancelled by user."
@@ -3,6 +3,7 @@ import logging
 import sys
 import uuid
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 from redash.utils import JSONEncoder
 
@@ -121,22 +122,26 @@ class SqlServer(BaseSQLQueryRunner):
 
         return schema.values()
 
+    def connect(self):
+        server = self.configuration.get('server', '')
+        user = self.configuration.get('user', '')
+        password = self.configuration.get('password', '')
+        db = self.configuration['db']
+        port = self.configuration.get('port', 1433)
+        tds_version = self.configuration.get('tds_version', '7.0')
+        charset = self.configuration.get('charset', 'UTF-8')
+
+        if port != 1433:
+            server = server + ':' + str(port)
+
+        return pymssql.connect(server=server, user=user, password=password, database=db, tds_version=tds_version, charset=charset)
+
     def run_query(self, query, user):
         connection = None
 
         try:
-            server = self.configuration.get('server', '')
-            user = self.configuration.get('user', '')
-            password = self.configuration.get('password', '')
-            db = self.configuration['db']
-            port = self.configuration.get('port', 1433)
-            tds_version = self.configuration.get('tds_version', '7.0')
             charset = self.configuration.get('charset', 'UTF-8')
-
-            if port != 1433:
-                server = server + ':' + str(port)
-
-            connection = pymssql.connect(server=server, user=user, password=password, database=db, tds_version=tds_version, charset=charset)
+            connection = self.get_connection()
 
             if isinstance(query, unicode):
                 query = query.encode(charset)
@@ -168,15 +173,20 @@ class SqlServer(BaseSQLQueryRunner):
                 # Connection errors are `args[0][1]`
                 error = e.args[0][1]
             json_data = None
+        except SoftTimeLimitExceeded:
+            connection.cancel()
+            self.discard_connection(connection)
+            raise
         except KeyboardInterrupt:
             connection.cancel()
+            self.discard_connection(connection)
             error = "Query cancelled by user."
             json_data = None
         except Exception as e:
             raise sys.exc_info()[1], None, sys.exc_info()[2]
         finally:
             if connection:
-                connection.close()
+                self.release_connection(connection)
 
         return json_data, error
 
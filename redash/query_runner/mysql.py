@@ -28,6 +28,7 @@ types_map = {
 
 class Mysql(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    pool_connections = True
 
     @classmethod
     def configuration_schema(cls):
@@ -121,18 +122,32 @@ class Mysql(BaseSQLQueryRunner):
 
         return schema.values()
 
+    def connect(self):
+        import MySQLdb
+
+        return MySQLdb.connect(host=self.configuration.get('host', ''),
+                               user=self.configuration.get('user', ''),
+                               passwd=self.configuration.get('passwd', ''),
+                               db=self.configuration['db'],
+                               port=self.configuration.get('port', 3306),
+                               charset='utf8', use_unicode=True,
+                               ssl=self._get_ssl_parameters())
+
+    def check_connection(self, connection):
+        connection.ping()
+
+    def reset_connection(self, connection):
+        # Changing the user (to the same one) rolls back the transaction and resets the session state: variables,
+        # current database, temporary tables, locks...
+        connection.change_user(self.configuration.get('user', ''), self.configuration.get('passwd', ''),
+                               self.configuration['db'])
+
     def run_query(self, query, user):
         import MySQLdb
 
         connection = None
         try:
-            connection = MySQLdb.connect(host=self.configuration.get('host', ''),
-                                         user=self.configuration.get('user', ''),
-                                         passwd=self.configuration.get('passwd', ''),
-                                         db=self.configuration['db'],
-                                         port=self.configuration.get('port', 3306),
-                                         charset='utf8', use_unicode=True,
-                                         ssl=self._get_ssl_parameters())
+            connection = self.get_connection()
             cursor = connection.cursor()
             logger.debug("MySQL running query: %s", query)
             cursor.execute(query)
@@ -156,13 +171,14 @@ class Mysql(BaseSQLQueryRunner):
             json_data = None
             error = e.args[1]
         except KeyboardInterrupt:
+            self.discard_connection(connection)
             error = "Query cancelled by user."
             json_data = None
         except Exception as e:
             raise sys.exc_info()[1], None, sys.exc_info()[2]
         finally:
             if connection:
-                connection.close()
+                self.release_connection(connection)
 
         return json_data, error
 
@@ -2,6 +2,7 @@ import json
 import logging
 import sys
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 from redash.utils import JSONEncoder
 
@@ -138,10 +139,13 @@ class Oracle(BaseSQLQueryRunner):
             if scale <= 0:
                 return cursor.var(cx_Oracle.STRING, 255, outconverter=Oracle._convert_number, arraysize=cursor.arraysize)
 
-    def run_query(self, query, user):
+    def connect(self):
         connection = cx_Oracle.connect(self.connection_string)
         connection.outputtypehandler = Oracle.output_handler
+        return connection
 
+    def run_query(self, query, user):
+        connection = self.get_connection()
         cursor = connection.cursor()
 
         try:
@@ -161,14 +165,19 @@ class Oracle(BaseSQLQueryRunner):
             logging.exception(err.message)
             error = "Query failed. {}.".format(err.message)
             json_data = None
+        except SoftTimeLimitExceeded:
+            connection.cancel()
+            self.discard_connection(connection)
+            raise
         except KeyboardInterrupt:
             connection.cancel()
+            self.discard_connection(connection)
             error = "Query cancelled by user."
             json_data = None
         except Exception as err:
             raise sys.exc_info()[1], None, sys.exc_info()[2]
         finally:
-            connection.close()
+            self.release_connection(connection)
 
         return json_data, error
 
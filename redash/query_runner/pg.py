@@ -2,10 +2,10 @@ import json
 import logging
 import psycopg2
 import select
-import sys
+import sqlparse
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
-from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +46,9 @@ def _wait(conn, timeout=None):
 
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    pool_connections = True
+    # Read the results of SELECT queries through server side cursors (see `_declare_cursor`):
+    server_side_cursors = True
 
     @classmethod
     def configuration_schema(cls):
@@ -115,47 +118,118 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def connect(self):
         connection = psycopg2.connect(self.connection_string, async=True)
         _wait(connection, timeout=10)
+        return connection
 
+    def check_connection(self, connection):
         cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        _wait(connection, timeout=10)
+
+    def reset_connection(self, connection):
+        # Asynchronous connections are always in autocommit mode, so there's no transaction to end, but the session
+        # state (settings, role, temporary tables, prepared statements...) is left by the query:
+        if connection.closed or connection.isexecuting():
+            raise psycopg2.InterfaceError("Connection isn't idle.")
+
+        cursor = connection.cursor()
+        # Queries read through a cursor run in a transaction, which is left open if they failed or stopped early:
+        if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            cursor.execute("ROLLBACK")
+            _wait(connection, timeout=10)
+
+        cursor.execute("DISCARD ALL")
+        _wait(connection, timeout=10)
 
+    def _declare_cursor(self, connection, cursor, query):
+        """Declare a server side cursor for the query, so its rows are fetched (and held in memory) a batch at a time
+        and the query stops once the caller stops reading them. Asynchronous connections can't use psycopg2's named
+        cursors, so the cursor is declared (in a transaction, as cursors live only in one) and read with SQL.
+
+        Return False if the query can't be read through a cursor (only a single SELECT or VALUES statement can), and
+        should be run as is instead.
+        """
+        if not self.server_side_cursors:
+            return False
+
+        statements = [statement for statement in sqlparse.split(query) if statement.strip()]
+        if len(statements) != 1:
+            return False
+
+        cursor.execute("BEGIN")
+        _wait(connection)
         try:
-            cursor.execute(query)
+            cursor.execute("DECLARE redash_cursor NO SCROLL CURSOR FOR " + query)
+            _wait(connection)
+        except psycopg2.DatabaseError:
+            cursor.execute("ROLLBACK")
             _wait(connection)
+            return False
 
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
+        return True
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json.dumps(data, cls=JSONEncoder)
+    def run_query_iter(self, query, user):
+        connection = self.get_connection()
+        cursor = connection.cursor()
+
+        try:
+            if self._declare_cursor(connection, cursor, query):
+                def fetch_rows():
+                    cursor.execute("FETCH FORWARD {} FROM redash_cursor".format(ROWS_BATCH_SIZE))
+                    _wait(connection)
+                    return cursor.fetchall()
+
+                # The columns are described along with the first batch of rows:
+                rows = fetch_rows()
             else:
-                error = 'Query completed but it returned no data.'
-                json_data = None
+                fetch_rows = lambda: cursor.fetchmany(ROWS_BATCH_SIZE)
+                cursor.execute(query)
+                _wait(connection)
+                rows = None
+
+            if cursor.description is None:
+                raise QueryError('Query completed but it returned no data.')
+
+            columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
+            yield {'columns': columns}
+
+            if rows is None:
+                rows = fetch_rows()
+            while rows:
+                yield rows
+                rows = fetch_rows()
+
+            if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                cursor.execute("COMMIT")
+                _wait(connection)
         except (select.error, OSError) as e:
             logging.exception(e)
-            error = "Query interrupted. Please retry."
-            json_data = None
+            self.discard_connection(connection)
+            raise QueryError("Query interrupted. Please retry.")
         except psycopg2.DatabaseError as e:
             logging.exception(e)
-            error = e.message
-            json_data = None
+            raise QueryError(e.message)
+        except SoftTimeLimitExceeded:
+            connection.cancel()
+            self.discard_connection(connection)
+            raise
         except (KeyboardInterrupt, InterruptException):
             connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
-        except Exception as e:
-            raise sys.exc_info()[1], None, sys.exc_info()[2]
+            self.discard_connection(connection)
+            raise QueryError("Query cancelled by user.")
         finally:
-            connection.close()
-
-        return json_data, error
+            self.release_connection(connection)
 
 
 class Redshift(PostgreSQL):
+    # Redshift doesn't support DISCARD, so the session state of its connections can't be reset:
+    pool_connections = False
+    # Redshift materializes the whole result of a cursor on its leader node (up to a size limit, beyond which the query
+    # fails), so its results are read as they are:
+    server_side_cursors = False
+
     @classmethod
     def type(cls):
         return "redshift"
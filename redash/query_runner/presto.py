@@ -1,12 +1,11 @@
 import json
 
-from redash.utils import JSONEncoder
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 
 import logging
 logger = logging.getLogger(__name__)
 
-from collections import defaultdict
 
 try:
     from pyhive import presto
@@ -96,7 +95,7 @@ class Presto(BaseQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def run_query_iter(self, query, user):
         connection = presto.connect(
                 host=self.configuration.get('host', ''),
                 port=self.configuration.get('port', 8080),
@@ -106,19 +105,20 @@ class Presto(BaseQueryRunner):
 
         cursor = connection.cursor()
 
-
         try:
             cursor.execute(query)
             column_tuples = [(i[0], PRESTO_TYPES_MAPPING.get(i[1], None)) for i in cursor.description]
             columns = self.fetch_columns(column_tuples)
-            rows = [dict(zip(([c['name'] for c in columns]), r)) for i, r in enumerate(cursor.fetchall())]
-            data = {'columns': columns, 'rows': rows}
-            json_data = json.dumps(data, cls=JSONEncoder)
-            error = None
+            yield {'columns': columns}
+
+            rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+        except SoftTimeLimitExceeded:
+            cursor.cancel()
+            raise
         except Exception, ex:
-            json_data = None
-            error = ex.message
-
-        return json_data, error
+            raise QueryError(ex.message)
 
 register(Presto)
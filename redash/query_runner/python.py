@@ -3,8 +3,9 @@ import json
 import logging
 import sys
 
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
-from redash.utils import json_dumps
+from redash.utils import json_dumps, result_format
 from redash import models
 
 import importlib
@@ -67,9 +68,7 @@ class Python(BaseQueryRunner):
         self.syntax = "python"
 
         self._allowed_modules = {}
-        self._script_locals = {"result": {"rows": [], "columns": [], "log": []}}
         self._enable_print_log = True
-        self._custom_print = CustomPrint()
 
         if self.configuration.get("allowedImportModules", None):
             for item in self.configuration["allowedImportModules"].split(","):
@@ -179,34 +178,40 @@ class Python(BaseQueryRunner):
         if query.latest_query_data.data is None:
             raise Exception("Query does not have results yet.")
 
-        return json.loads(query.latest_query_data.data)
+        return result_format.convert(json.loads(query.latest_query_data.data), result_format.V1)
 
     def test_connection(self):
         pass
 
     def run_query(self, query, user):
+        # The runner is reused by all the queries of its data source, so the state of a run (its result, print log
+        # and builtins) is kept in the run's own execution environment and not on the runner:
+        script_locals = {"result": {"rows": [], "columns": [], "log": []}}
+        custom_print = CustomPrint()
+
         try:
             error = None
 
             code = compile_restricted(query, '<string>', 'exec')
 
-            safe_builtins["_write_"] = self.custom_write
-            safe_builtins["__import__"] = self.custom_import
-            safe_builtins["_getattr_"] = getattr
-            safe_builtins["getattr"] = getattr
-            safe_builtins["_setattr_"] = setattr
-            safe_builtins["setattr"] = setattr
-            safe_builtins["_getitem_"] = self.custom_get_item
-            safe_builtins["_getiter_"] = self.custom_get_iter
-            safe_builtins["_print_"] = self._custom_print
-
-            restricted_globals = dict(__builtins__=safe_builtins)
+            builtins = dict(safe_builtins)
+            builtins["_write_"] = self.custom_write
+            builtins["__import__"] = self.custom_import
+            builtins["_getattr_"] = getattr
+            builtins["getattr"] = getattr
+            builtins["_setattr_"] = setattr
+            builtins["setattr"] = setattr
+            builtins["_getitem_"] = self.custom_get_item
+            builtins["_getiter_"] = self.custom_get_iter
+            builtins["_print_"] = custom_print
+
+            restricted_globals = dict(__builtins__=builtins)
             restricted_globals["get_query_result"] = self.get_query_result
             restricted_globals["execute_query"] = self.execute_query
             restricted_globals["add_result_column"] = self.add_result_column
             restricted_globals["add_result_row"] = self.add_result_row
-            restricted_globals["disable_print_log"] = self._custom_print.disable
-            restricted_globals["enable_print_log"] = self._custom_print.enable
+            restricted_globals["disable_print_log"] = custom_print.disable
+            restricted_globals["enable_print_log"] = custom_print.enable
 
             # Supported data types
             restricted_globals["TYPE_DATETIME"] = TYPE_DATETIME
@@ -221,15 +226,14 @@ class Python(BaseQueryRunner):
             restricted_globals["min"] = min
             restricted_globals["max"] = max
 
-            # TODO: Figure out the best way to have a timeout on a script
-            #       One option is to use ETA with Celery + timeouts on workers
-            #       And replacement of worker process every X requests handled.
-
-            exec(code) in restricted_globals, self._script_locals
+            # Scripts are stopped by the data source's query timeout (see BaseQueryRunner.query_timeout).
+            exec(code) in restricted_globals, script_locals
 
-            result = self._script_locals['result']
-            result['log'] = self._custom_print.lines
+            result = script_locals['result']
+            result['log'] = custom_print.lines
             json_data = json_dumps(result)
+        except SoftTimeLimitExceeded:
+            raise
         except KeyboardInterrupt:
             error = "Query cancelled by user."
             json_data = None
@@ -1,6 +1,4 @@
-import json
-
-from redash.utils import JSONEncoder
+from celery.exceptions import SoftTimeLimitExceeded
 from redash.query_runner import *
 
 import logging
@@ -94,7 +92,7 @@ class TreasureData(BaseQueryRunner):
                 raise Exception("Failed getting schema")
         return schema.values()
 
-    def run_query(self, query, user):
+    def run_query_iter(self, query, user):
         connection = tdclient.connect(
                 endpoint=self.configuration.get('endpoint', 'https://api.treasuredata.com'),
                 apikey=self.configuration.get('apikey'),
@@ -111,14 +109,16 @@ class TreasureData(BaseQueryRunner):
                 'friendly_name': col[0],
                 'type': TD_TYPES_MAPPING.get(col[1], None)} for col in columns_data]
 
-            rows = [dict(zip(([c[0] for c in columns_data]), r)) for i, r in enumerate(cursor.fetchall())]
-            data = {'columns': columns, 'rows': rows}
-            json_data = json.dumps(data, cls=JSONEncoder)
-            error = None
-        except Exception, ex:
-            json_data = None
-            error = ex.message
+            yield {'columns': columns}
 
-        return json_data, error
+            rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+        except SoftTimeLimitExceeded:
+            cursor.cancel()
+            raise
+        except Exception, ex:
+            raise QueryError(ex.message)
 
 register(TreasureData)
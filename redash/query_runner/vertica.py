@@ -94,9 +94,19 @@ class Vertica(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def connect(self):
         import vertica_python
 
+        conn_info = {
+            'host': self.configuration.get('host', ''),
+            'port': self.configuration.get('port', 5433),
+            'user': self.configuration.get('user', ''),
+            'password': self.configuration.get('password', ''),
+            'database': self.configuration.get('database', '')
+        }
+        return vertica_python.connect(**conn_info)
+
+    def run_query(self, query, user):
         if query == "":
             json_data = None
             error = "Query is empty"
@@ -104,14 +114,7 @@ class Vertica(BaseSQLQueryRunner):
 
         connection = None
         try:
-            conn_info = {
-                'host': self.configuration.get('host', ''),
-                'port': self.configuration.get('port', 5433),
-                'user': self.configuration.get('user', ''),
-                'password': self.configuration.get('password', ''),
-                'database': self.configuration.get('database', '')
-            }
-            connection = vertica_python.connect(**conn_info)
+            connection = self.get_connection()
             cursor = connection.cursor()
             logger.debug("Vetica running query: %s", query)
             cursor.execute(query)
@@ -134,13 +137,14 @@ class Vertica(BaseSQLQueryRunner):
 
             cursor.close()
         except KeyboardInterrupt:
+            self.discard_connection(connection)
             error = "Query cancelled by user."
             json_data = None
         except Exception as e:
             raise sys.exc_info()[1], None, sys.exc_info()[2]
         finally:
             if connection:
-                connection.close()
+                self.release_connection(connection)
 
         return json_data, error
 
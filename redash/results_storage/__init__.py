@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import zlib
+
+from redash import settings
+from redash.utils import compression, result_format
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'BaseResultsStorage',
+    'register',
+    'get_results_storage',
+    'import_results_storages',
+    'should_store_externally',
+    'data_checksum',
+    'store',
+    'load',
+    'remove',
+    'should_store_gzipped_json',
+    'store_gzipped_json',
+    'load_gzipped_json',
+    'remove_gzipped_json'
+]
+
+
+class BaseResultsStorage(object):
+    @classmethod
+    def name(cls):
+        return cls.__name__
+
+    @classmethod
+    def type(cls):
+        return cls.__name__.lower()
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def put(self, key, value):
+        raise NotImplementedError()
+
+    def get(self, key):
+        """Return the value stored under the key, or raise KeyError if there's none."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+results_storages = {}
+_instances = {}
+
+
+def register(results_storage_class):
+    global results_storages
+    if results_storage_class.enabled():
+        logger.debug("Registering %s (%s) results storage.", results_storage_class.name(), results_storage_class.type())
+        results_storages[results_storage_class.type()] = results_storage_class
+    else:
+        logger.warning("%s results storage enabled but not supported, not registering. Either disable or install missing dependencies.", results_storage_class.name())
+
+
+def get_results_storage(results_storage_type):
+    if results_storage_type not in _instances:
+        results_storage_class = results_storages.get(results_storage_type, None)
+        if results_storage_class is None:
+            raise Exception("Unknown query results storage: {}".format(results_storage_type))
+
+        _instances[results_storage_type] = results_storage_class()
+
+    return _instances[results_storage_type]
+
+
+def import_results_storages(results_storage_imports):
+    for storage_import in results_storage_imports:
+        __import__(storage_import)
+
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+
+    return data
+
+
+def data_checksum(data):
+    """Return the checksum and size (in bytes) of the given query result data."""
+    data = _encode(data)
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+def should_store_externally(size):
+    return bool(settings.QUERY_RESULTS_STORAGE) and size >= settings.QUERY_RESULTS_STORAGE_MIN_SIZE
+
+
+def store(org_id, data, checksum):
+    """Store the data (which can be already compressed) in the configured results storage, and return its location
+    (to be used with `load`/`remove`).
+
+    Keys are derived from the data checksum, so the same data is always stored under the same location. The data is
+    stored in the format of `redash.utils.compression`, so blocks of it can be decompressed on their own.
+    """
+    results_storage_type = settings.QUERY_RESULTS_STORAGE
+    key = "{}/{}".format(org_id, checksum)
+    get_results_storage(results_storage_type).put(key, compression.compress(data).encode('ascii'))
+
+    return "{}:{}".format(results_storage_type, key)
+
+
+def load(location, decompress=True):
+    """Return the data stored in the location, decompressed (or, when `decompress` is false, as it's stored, in the
+    format of `redash.utils.compression`).
+    """
+    results_storage_type, key = location.split(':', 1)
+    value = get_results_storage(results_storage_type).get(key)
+
+    if compression.is_compressed(value):
+        value = value.decode('ascii')
+    else:
+        # Stored as a plain zlib stream by earlier versions:
+        value = zlib.decompress(value).decode('utf-8')
+
+    return compression.decompress(value) if decompress else value
+
+
+def remove(location):
+    results_storage_type, key = location.split(':', 1)
+    get_results_storage(results_storage_type).delete(key)
+
+
+# The gzipped JSON responses of big results (in any of the result formats) are kept in the results storage too, next to
+# their data, so they're compressed once per result (the export cache is only a hot layer in front of them):
+def _gzipped_json_key(org_id, query_result_id, data_format):
+    return "{}/responses/{}.v{}.json.gz".format(org_id, query_result_id, data_format)
+
+
+def should_store_gzipped_json(data_size):
+    return should_store_externally(data_size or 0)
+
+
+def store_gzipped_json(org_id, query_result_id, data_format, data):
+    get_results_storage(settings.QUERY_RESULTS_STORAGE).put(_gzipped_json_key(org_id, query_result_id, data_format),
+                                                            data)
+
+
+def load_gzipped_json(org_id, query_result_id, data_format):
+    """Return the gzipped JSON response of the result (see `store_gzipped_json`), or None if it wasn't stored."""
+    try:
+        return get_results_storage(settings.QUERY_RESULTS_STORAGE).get(_gzipped_json_key(org_id, query_result_id,
+                                                                                         data_format))
+    except KeyError:
+        return None
+
+
+def remove_gzipped_json(org_id, query_result_id):
+    for data_format in result_format.FORMATS:
+        get_results_storage(settings.QUERY_RESULTS_STORAGE).delete(_gzipped_json_key(org_id, query_result_id,
+                                                                                     data_format))
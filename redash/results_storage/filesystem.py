@@ -0,0 +1,49 @@
+import errno
+import os
+
+from redash import settings
+from redash.results_storage import BaseResultsStorage, register
+
+
+class FileSystem(BaseResultsStorage):
+    def __init__(self):
+        self.path = settings.QUERY_RESULTS_STORAGE_PATH
+
+    def _path(self, key):
+        return os.path.join(self.path, key)
+
+    def put(self, key, value):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # Another process might have created it in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Write to a temporary file and rename it, so readers never see a partially written file.
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.rename(temp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+register(FileSystem)
@@ -0,0 +1,47 @@
+from redash import settings
+from redash.results_storage import BaseResultsStorage, register
+
+try:
+    import botocore.exceptions
+    import botocore.session
+    enabled = True
+except ImportError:
+    enabled = False
+
+
+class S3(BaseResultsStorage):
+    """Stores results in an S3 (or S3 compatible, using REDASH_QUERY_RESULTS_STORAGE_S3_ENDPOINT_URL) bucket."""
+
+    @classmethod
+    def enabled(cls):
+        return enabled
+
+    def __init__(self):
+        session = botocore.session.get_session()
+        self.client = session.create_client('s3',
+                                            region_name=settings.QUERY_RESULTS_STORAGE_S3_REGION or None,
+                                            endpoint_url=settings.QUERY_RESULTS_STORAGE_S3_ENDPOINT_URL or None)
+        self.bucket = settings.QUERY_RESULTS_STORAGE_S3_BUCKET
+        self.prefix = settings.QUERY_RESULTS_STORAGE_S3_PREFIX
+
+    def _key(self, key):
+        return "{}{}".format(self.prefix, key)
+
+    def put(self, key, value):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=value)
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                raise KeyError(key)
+            raise
+
+        return response['Body'].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+register(S3)
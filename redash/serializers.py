@@ -6,9 +6,10 @@ code and better separation of concerns.
 import json
 from funcy import project
 from redash import models
+from redash.utils import result_format
 
 
-def public_widget(widget):
+def public_widget(widget, data_format=result_format.V1):
     res = {
         'id': widget.id,
         'width': widget.width,
@@ -19,7 +20,8 @@ def public_widget(widget):
     }
 
     if widget.visualization and widget.visualization.id:
-        query_data = models.QueryResult.get_by_id(widget.visualization.query.latest_query_data_id).to_dict()
+        query_result = models.QueryResult.get_by_id(widget.visualization.query.latest_query_data_id)
+        query_data = query_result.to_dict(raw_data=True, data_format=data_format)
         res['visualization'] = {
             'type': widget.visualization.type,
             'name': widget.visualization.name,
@@ -39,14 +41,14 @@ def public_widget(widget):
     return res
 
 
-def public_dashboard(dashboard):
+def public_dashboard(dashboard, data_format=result_format.V1):
     dashboard_dict = project(dashboard.to_dict(), ('name', 'layout', 'dashboard_filters_enabled', 'updated_at', 'created_at'))
 
     widget_list = models.Widget.select(models.Widget, models.Visualization, models.Query) \
         .where(models.Widget.dashboard == dashboard.id) \
         .join(models.Visualization, join_type=models.peewee.JOIN_LEFT_OUTER) \
         .join(models.Query, join_type=models.peewee.JOIN_LEFT_OUTER)
-    widgets = {w.id: public_widget(w) for w in widget_list}
+    widgets = {w.id: public_widget(w, data_format) for w in widget_list}
 
     widgets_layout = []
     for row in dashboard_dict['layout']:
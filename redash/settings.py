@@ -77,6 +77,46 @@ QUERY_RESULTS_CLEANUP_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESUL
 QUERY_RESULTS_CLEANUP_COUNT = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_COUNT", "100"))
 QUERY_RESULTS_CLEANUP_MAX_AGE = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_MAX_AGE", "7"))
 
+# Query results bigger than QUERY_RESULTS_COMPRESSION_MIN_SIZE (in bytes) are stored zlib compressed. Existing results
+# can be compressed with `manage.py query_results compress`. Results of query runners are compressed in blocks of rows,
+# so reading a slice of their rows decompresses only the blocks that have them.
+QUERY_RESULTS_COMPRESSION_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION_ENABLED", "true"))
+QUERY_RESULTS_COMPRESSION_MIN_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION_MIN_SIZE", "1024"))
+
+# When set (to one of the registered results storages, e.g. "filesystem" or "s3"), query results bigger than
+# QUERY_RESULTS_STORAGE_MIN_SIZE (in bytes) are stored in the external storage and the database keeps only a pointer.
+QUERY_RESULTS_STORAGE = os.environ.get("REDASH_QUERY_RESULTS_STORAGE", "")
+QUERY_RESULTS_STORAGE_MIN_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_STORAGE_MIN_SIZE", str(1024 * 1024)))
+QUERY_RESULTS_STORAGE_PATH = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_PATH", "/var/lib/redash/query_results")
+QUERY_RESULTS_STORAGE_S3_BUCKET = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_S3_BUCKET", "")
+QUERY_RESULTS_STORAGE_S3_PREFIX = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_S3_PREFIX", "query_results/")
+QUERY_RESULTS_STORAGE_S3_REGION = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_S3_REGION", "")
+QUERY_RESULTS_STORAGE_S3_ENDPOINT_URL = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_S3_ENDPOINT_URL", "")
+
+# When a result has exactly the same data as one already stored (in the database, or in the results storage, see
+# QUERY_RESULTS_STORAGE), the new result points at the stored data instead of storing another copy.
+QUERY_RESULTS_DEDUPLICATION_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_DEDUPLICATION_ENABLED", "true"))
+
+# Outputs of server side aggregations of query results are cached (in Redis) for this many seconds.
+QUERY_RESULTS_AGGREGATION_CACHE_TTL = int(os.environ.get("REDASH_QUERY_RESULTS_AGGREGATION_CACHE_TTL", "3600"))
+
+# Results with more rows than this can't be downloaded as Excel files (results with more rows than a sheet can have are
+# split across several sheets).
+QUERY_RESULTS_EXCEL_MAX_ROWS = int(os.environ.get("REDASH_QUERY_RESULTS_EXCEL_MAX_ROWS", "3000000"))
+# Results bigger than this (in bytes, serialized) can't be downloaded as Excel files either.
+QUERY_RESULTS_EXCEL_MAX_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_EXCEL_MAX_SIZE", str(500 * 1024 * 1024)))
+
+# JSON query results are sent gzip compressed to clients that accept it. The compressed responses of results big enough
+# to be kept in the results storage (see QUERY_RESULTS_STORAGE) are stored there too, so they're compressed only once,
+# and all compressed responses are kept in the export cache (see QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE) while they're hot.
+QUERY_RESULTS_GZIP_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_GZIP_ENABLED", "true"))
+
+# Rendered exports of query results (CSV, Excel and other downloads) can be cached in Redis, up to this many bytes in
+# total (least recently used exports are evicted first). The cache shares Redis with the Celery broker and the job
+# locks, so Redis needs this much memory to spare (with a noeviction policy, a full Redis fails their writes). Disabled
+# (0) by default.
+QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE", "0"))
+
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("REDASH_SCHEMAS_REFRESH_SCHEDULE", 30))
 
 AUTH_TYPE = os.environ.get("REDASH_AUTH_TYPE", "api_key")
@@ -128,6 +168,42 @@ STATIC_ASSETS_PATHS = [fix_assets_path(path) for path in os.environ.get("REDASH_
 STATIC_ASSETS_PATHS.append(fix_assets_path('./static/'))
 
 JOB_EXPIRY_TIME = int(os.environ.get("REDASH_JOB_EXPIRY_TIME", 3600 * 6))
+
+# Queries of data sources that are running their max concurrent queries are retried after QUERY_CONCURRENCY_RETRY_DELAY
+# seconds, doubled on every retry up to QUERY_CONCURRENCY_RETRY_MAX_DELAY. They fail once they waited for
+# QUERY_CONCURRENCY_MAX_WAIT seconds (or JOB_EXPIRY_TIME, if it's shorter) since they were enqueued.
+QUERY_CONCURRENCY_RETRY_DELAY = int(os.environ.get("REDASH_QUERY_CONCURRENCY_RETRY_DELAY", "5"))
+QUERY_CONCURRENCY_RETRY_MAX_DELAY = int(os.environ.get("REDASH_QUERY_CONCURRENCY_RETRY_MAX_DELAY", "60"))
+QUERY_CONCURRENCY_MAX_WAIT = int(os.environ.get("REDASH_QUERY_CONCURRENCY_MAX_WAIT", "3600"))
+
+# Default timeout (in seconds) of queries of data sources that don't set one (0 means no timeout). Queries that time
+# out are interrupted, and their worker processes are killed if they don't stop within QUERY_TIMEOUT_GRACE_PERIOD.
+QUERY_TIMEOUT = int(os.environ.get("REDASH_QUERY_TIMEOUT", "0"))
+QUERY_TIMEOUT_GRACE_PERIOD = int(os.environ.get("REDASH_QUERY_TIMEOUT_GRACE_PERIOD", "60"))
+
+# Query runners that support it keep up to QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS connections of each data source open
+# (in each process) for reuse, for up to QUERY_RUNNER_POOL_MAX_IDLE_TIME seconds. 0 disables pooling.
+QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS = int(os.environ.get("REDASH_QUERY_RUNNER_POOL_MAX_IDLE_CONNECTIONS", "1"))
+QUERY_RUNNER_POOL_MAX_IDLE_TIME = int(os.environ.get("REDASH_QUERY_RUNNER_POOL_MAX_IDLE_TIME", "300"))
+
+# Fair-share scheduling of queries across orgs and users (see redash.tasks.scheduler). At most
+# QUERY_SCHEDULER_MAX_IN_FLIGHT tasks of each Celery queue are sent to the workers at a time (so it should be about the
+# number of worker processes consuming the queue). QUERY_SCHEDULER_ORG_WEIGHTS is a JSON object of org ids to their
+# weights (the default weight is 1).
+QUERY_SCHEDULER_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_SCHEDULER_ENABLED", "false"))
+QUERY_SCHEDULER_MAX_IN_FLIGHT = int(os.environ.get("REDASH_QUERY_SCHEDULER_MAX_IN_FLIGHT", "8"))
+QUERY_SCHEDULER_ORG_WEIGHTS = json.loads(os.environ.get("REDASH_QUERY_SCHEDULER_ORG_WEIGHTS", "{}"))
+
+# Query runtimes are predicted as this percentile of the runtimes of their (up to QUERY_RUNTIME_PREDICTION_SAMPLES)
+# latest results.
+QUERY_RUNTIME_PREDICTION_PERCENTILE = int(os.environ.get("REDASH_QUERY_RUNTIME_PREDICTION_PERCENTILE", "90"))
+QUERY_RUNTIME_PREDICTION_SAMPLES = int(os.environ.get("REDASH_QUERY_RUNTIME_PREDICTION_SAMPLES", "20"))
+
+# Queries predicted to run at least QUERY_SLOW_LANE_THRESHOLD seconds are sent to their data source's queue name with
+# QUERY_SLOW_LANE_QUEUE_SUFFIX appended (like "queries_slow"), which needs its own workers. 0 disables it.
+QUERY_SLOW_LANE_THRESHOLD = int(os.environ.get("REDASH_QUERY_SLOW_LANE_THRESHOLD", "0"))
+QUERY_SLOW_LANE_QUEUE_SUFFIX = os.environ.get("REDASH_QUERY_SLOW_LANE_QUEUE_SUFFIX", "_slow")
+
 COOKIE_SECRET = os.environ.get("REDASH_COOKIE_SECRET", "c292a0a3aa32397cdb050e233733900f")
 SESSION_COOKIE_SECURE = parse_boolean(os.environ.get("REDASH_SESSION_COOKIE_SECURE") or str(ENFORCE_HTTPS))
 
@@ -204,6 +280,16 @@ additional_destinations = array_from_string(os.environ.get("REDASH_ADDITIONAL_DE
 
 DESTINATIONS = distinct(enabled_destinations + additional_destinations)
 
+# Query results storages
+default_query_results_storages = [
+    'redash.results_storage.filesystem',
+    'redash.results_storage.s3',
+]
+
+additional_query_results_storages = array_from_string(os.environ.get("REDASH_ADDITIONAL_QUERY_RESULTS_STORAGES", ""))
+
+QUERY_RESULTS_STORAGES = distinct(default_query_results_storages + additional_query_results_storages)
+
 EVENT_REPORTING_WEBHOOKS = array_from_string(os.environ.get("REDASH_EVENT_REPORTING_WEBHOOKS", ""))
 
 # Support for Sentry (http://getsentry.com/). Just set your Sentry DSN to enable it:
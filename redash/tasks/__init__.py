@@ -1,3 +1,4 @@
 from .general import record_event, version_check, send_mail
 from .queries import QueryTask, refresh_queries, refresh_schemas, cleanup_tasks, cleanup_query_results, execute_query
+from .scheduler import dispatch_queries
 from .alerts import check_alerts_for_query
\ No newline at end of file
@@ -1,15 +1,20 @@
 import json
+import random
 import time
 import logging
 import signal
+import uuid
 import redis
 from celery.result import AsyncResult
+from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.signals import task_failure, task_postrun, task_revoked
 from celery.utils.log import get_task_logger
-from redash import redis_connection, models, statsd_client, settings, utils
+from redash import export_cache, redis_connection, models, statsd_client, settings, utils, results_storage
 from redash.utils import gen_query_hash
 from redash.worker import celery
-from redash.query_runner import InterruptException
+from redash.query_runner import InterruptException, QueryError, QueryResultWriter
 from .base import BaseTask
+from . import runtime_estimator, scheduler
 from .alerts import check_alerts_for_query
 
 logger = get_task_logger(__name__)
@@ -19,8 +24,126 @@ def _job_lock_id(query_hash, data_source_id):
     return "query_hash_job:%s:%s" % (data_source_id, query_hash)
 
 
-def _unlock(query_hash, data_source_id):
-    redis_connection.delete(_job_lock_id(query_hash, data_source_id))
+# Deletes the job lock (KEYS[1]) if it's held by the task (ARGV[1]), checking and deleting in one step so a lock taken by
+# another job in between isn't deleted.
+_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+
+return 0
+"""
+
+# Sets the job lock (KEYS[1]) to expire in ARGV[2] seconds, if it's held by the task (ARGV[1]).
+_EXPIRE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+
+return 0
+"""
+
+_unlock_script = redis_connection.register_script(_UNLOCK_SCRIPT)
+_expire_lock_script = redis_connection.register_script(_EXPIRE_LOCK_SCRIPT)
+
+
+def _unlock(query_hash, data_source_id, task_id=None):
+    """Release the job lock of the query. With a task_id, only if the lock is still held by that task (and wasn't
+    taken by a newer job of the same query in the meantime).
+    """
+    lock_id = _job_lock_id(query_hash, data_source_id)
+    if task_id is None:
+        redis_connection.delete(lock_id)
+    else:
+        _unlock_script(keys=[lock_id], args=[task_id])
+
+
+def _expire_lock(query_hash, data_source_id, task_id, ttl):
+    """Shorten the job lock of the query to ttl seconds, if it's still held by the task."""
+    _expire_lock_script(keys=[_job_lock_id(query_hash, data_source_id)], args=[task_id, ttl])
+
+
+# Takes an execution slot of a data source (KEYS[1], a sorted set of the tasks holding its slots, scored by the time
+# they took them) for the task (ARGV[4]), if less than the limit (ARGV[2]) are taken. Slots taken before ARGV[1] (now)
+# minus ARGV[3] are considered abandoned (by workers that died) and are released.
+_ACQUIRE_EXECUTION_SLOT_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - tonumber(ARGV[3]))
+
+if redis.call('ZSCORE', key, ARGV[4]) or redis.call('ZCARD', key) < tonumber(ARGV[2]) then
+    redis.call('ZADD', key, now, ARGV[4])
+    return 1
+end
+
+return 0
+"""
+
+_acquire_execution_slot = redis_connection.register_script(_ACQUIRE_EXECUTION_SLOT_SCRIPT)
+
+
+def _execution_slots_key(data_source_id):
+    return 'ds:{}:execution_slots'.format(data_source_id)
+
+
+def acquire_execution_slot(data_source_id, task_id, limit):
+    """Take one of the data source's `limit` execution slots for the task. Returns False if they're all taken."""
+    args = [time.time(), limit, settings.JOB_EXPIRY_TIME, task_id]
+    return bool(_acquire_execution_slot(keys=[_execution_slots_key(data_source_id)], args=args))
+
+
+def release_execution_slot(data_source_id, task_id):
+    redis_connection.zrem(_execution_slots_key(data_source_id), task_id)
+
+
+def execution_slots_in_use(data_source_ids):
+    """Return the number of taken execution slots of each of the data sources, by id."""
+    min_score = time.time() - settings.JOB_EXPIRY_TIME
+    pipe = redis_connection.pipeline()
+    for data_source_id in data_source_ids:
+        pipe.zcount(_execution_slots_key(data_source_id), min_score, '+inf')
+
+    return dict(zip(data_source_ids, pipe.execute()))
+
+
+# Merges the given fields (ARGV: the update time, followed by field name and JSON encoded value pairs) into the tracker
+# hash (KEYS[1]) and moves it to the list (KEYS[2..4]: done, waiting and in progress) of its state. Trackers saved by
+# older versions as JSON strings are converted to hashes first.
+_UPDATE_TRACKER_SCRIPT = """
+local key = KEYS[1]
+
+if redis.call('TYPE', key).ok == 'string' then
+    local legacy = cjson.decode(redis.call('GET', key))
+    redis.call('DEL', key)
+    for name, value in pairs(legacy) do
+        redis.call('HSET', key, name, cjson.encode(value))
+    end
+end
+
+redis.call('HMSET', key, unpack(ARGV, 2))
+
+local state = redis.call('HGET', key, 'state')
+if state then
+    state = cjson.decode(state)
+end
+
+local list = KEYS[4]
+if state == 'finished' or state == 'failed' or state == 'cancelled' or state == 'timed_out' then
+    list = KEYS[2]
+elseif state == 'created' then
+    list = KEYS[3]
+end
+
+for i = 2, 4 do
+    if KEYS[i] ~= list then
+        redis.call('ZREM', KEYS[i], key)
+    end
+end
+redis.call('ZADD', list, ARGV[1], key)
+"""
+
+_update_tracker = redis_connection.register_script(_UPDATE_TRACKER_SCRIPT)
 
 
 # TODO:
@@ -32,14 +155,17 @@ class QueryTaskTracker(object):
     IN_PROGRESS_LIST = 'query_task_trackers:in_progress'
     ALL_LISTS = (DONE_LIST, WAITING_LIST, IN_PROGRESS_LIST)
 
+    DONE_STATES = ('finished', 'failed', 'cancelled', 'timed_out')
+
     def __init__(self, data):
         self.data = data
 
     @classmethod
-    def create(cls, task_id, state, query_hash, data_source_id, scheduled, metadata):
+    def create(cls, task_id, state, query_hash, data_source_id, scheduled, metadata, predicted_runtime=None):
         data = dict(task_id=task_id, state=state,
                     query_hash=query_hash, data_source_id=data_source_id,
                     scheduled=scheduled,
+                    predicted_runtime=predicted_runtime,
                     username=metadata.get('Username', 'unknown'),
                     query_id=metadata.get('Query ID', 'unknown'),
                     retries=0,
@@ -51,52 +177,54 @@ class QueryTaskTracker(object):
         return cls(data)
 
     def save(self, connection=None):
+        self._write(self.data, connection)
+
+    def update(self, **kwargs):
+        """Update the given fields (only), atomically and in a single roundtrip."""
+        self.data.update(kwargs)
+        self._write(kwargs)
+
+    def _write(self, fields, connection=None):
         if connection is None:
             connection = redis_connection
 
-        self.data['updated_at'] = time.time()
-        key_name = self._key_name(self.data['task_id'])
-        connection.set(key_name, utils.json_dumps(self.data))
-        connection.zadd(self._get_list(), time.time(), key_name)
+        fields = dict(fields, updated_at=time.time())
+        self.data['updated_at'] = fields['updated_at']
 
-        for l in self.ALL_LISTS:
-            if l != self._get_list():
-                connection.zrem(l, key_name)
+        args = [fields['updated_at']]
+        for name, value in fields.iteritems():
+            args.extend((name, utils.json_dumps(value)))
 
-    # TOOD: this is not thread/concurrency safe. In current code this is not an issue, but better to fix this.
-    def update(self, **kwargs):
-        self.data.update(kwargs)
-        self.save()
+        _update_tracker(keys=[self._key_name(self.data['task_id'])] + list(self.ALL_LISTS), args=args,
+                        client=connection)
 
     @staticmethod
     def _key_name(task_id):
         return 'query_task_tracker:{}'.format(task_id)
 
-    def _get_list(self):
-        if self.state in ('finished', 'failed', 'cancelled'):
-            return self.DONE_LIST
-
-        if self.state in ('created'):
-            return self.WAITING_LIST
-
-        return self.IN_PROGRESS_LIST
-
     @classmethod
     def get_by_task_id(cls, task_id, connection=None):
         if connection is None:
             connection = redis_connection
 
         key_name = cls._key_name(task_id)
-        data = connection.get(key_name)
+        try:
+            data = connection.hgetall(key_name)
+        except redis.ResponseError:
+            # Tracker saved by an older version (as a JSON string):
+            data = connection.get(key_name)
+
         return cls.create_from_data(data)
 
     @classmethod
     def create_from_data(cls, data):
-        if data:
-            data = json.loads(data)
-            return cls(data)
+        if not data:
+            return None
 
-        return None
+        if isinstance(data, dict):
+            return cls({name: json.loads(value) for name, value in data.iteritems()})
+
+        return cls(json.loads(data))
 
     @classmethod
     def all(cls, list_name, offset=0, limit=-1):
@@ -109,9 +237,14 @@ class QueryTaskTracker(object):
         ids = redis_connection.zrevrange(list_name, offset, limit)
         pipe = redis_connection.pipeline()
         for id in ids:
-            pipe.get(id)
+            pipe.hgetall(id)
 
-        tasks = [cls.create_from_data(data) for data in pipe.execute()]
+        results = pipe.execute(raise_on_error=False)
+        # Trackers saved by an older version are JSON strings:
+        results = [redis_connection.get(id) if isinstance(data, redis.ResponseError) else data
+                   for id, data in zip(ids, results)]
+
+        tasks = [cls.create_from_data(data) for data in results]
         return tasks
 
     @classmethod
@@ -139,6 +272,7 @@ class QueryTask(object):
     STATUSES = {
         'PENDING': 1,
         'STARTED': 2,
+        'RETRY': 1,
         'SUCCESS': 3,
         'FAILURE': 4,
         'REVOKED': 4
@@ -170,10 +304,13 @@ class QueryTask(object):
         else:
             error = ''
 
+        tracker = QueryTaskTracker.get_by_task_id(self._async_result.id)
         if self._async_result.successful() and not error:
             query_result_id = self._async_result.result
+            truncated = bool(tracker and tracker.data.get('truncated'))
         else:
             query_result_id = None
+            truncated = False
 
         return {
             'id': self._async_result.id,
@@ -181,6 +318,8 @@ class QueryTask(object):
             'status': status,
             'error': error,
             'query_result_id': query_result_id,
+            'truncated': truncated,
+            'predicted_runtime': tracker.data.get('predicted_runtime') if tracker else None,
         }
 
     @property
@@ -198,9 +337,28 @@ class QueryTask(object):
         return self._async_result.revoke(terminate=True, signal='SIGINT')
 
 
+def _time_limits(timeout):
+    """Return the Celery time limits of executions of queries with the given timeout: they're interrupted (see
+    QueryExecutor.run) when it expires, and killed if they're still running after the grace period.
+    """
+    if not timeout:
+        return {}
+
+    return {'soft_time_limit': timeout, 'time_limit': timeout + settings.QUERY_TIMEOUT_GRACE_PERIOD}
+
+
+def _predict_runtime(data_source, query_hash):
+    try:
+        return runtime_estimator.predict_runtime(data_source.id, query_hash)
+    except Exception:
+        logger.exception("Failed predicting runtime of %s.", query_hash)
+        return None
+
+
 def enqueue_query(query, data_source, user_id, scheduled=False, metadata={}):
     query_hash = gen_query_hash(query)
     logging.info("Inserting job for %s with metadata=%s", query_hash, metadata)
+    time_limits = _time_limits(data_source.query_runner.query_timeout)
     try_count = 0
     job = None
 
@@ -222,6 +380,8 @@ def enqueue_query(query, data_source, user_id, scheduled=False, metadata={}):
                     job = None
 
             if not job:
+                # Predicted only for new jobs, as most enqueues of a popular query find its job already running:
+                predicted_runtime = _predict_runtime(data_source, query_hash)
                 pipe.multi()
 
                 if scheduled:
@@ -229,14 +389,31 @@ def enqueue_query(query, data_source, user_id, scheduled=False, metadata={}):
                 else:
                     queue_name = data_source.queue_name
 
-                result = execute_query.apply_async(args=(query, data_source.id, metadata, user_id), queue=queue_name)
-                job = QueryTask(async_result=result)
-                tracker = QueryTaskTracker.create(result.id, 'created', query_hash, data_source.id, scheduled, metadata)
+                # Queries predicted to run long go to a separate queue, so they don't hold up quick ones:
+                if (settings.QUERY_SLOW_LANE_THRESHOLD and predicted_runtime is not None and
+                        predicted_runtime >= settings.QUERY_SLOW_LANE_THRESHOLD):
+                    queue_name += settings.QUERY_SLOW_LANE_QUEUE_SUFFIX
+
+                args = (query, data_source.id, metadata, user_id)
+                if settings.QUERY_SCHEDULER_ENABLED:
+                    # The task is sent to Celery by the scheduler, when its turn comes:
+                    job = QueryTask(job_id=uuid.uuid4().hex)
+                    scheduler.enqueue(queue_name, job.id, args, data_source.org_id, user_id, scheduled,
+                                      options=time_limits, client=pipe)
+                else:
+                    job = QueryTask(async_result=execute_query.apply_async(args=args, queue=queue_name,
+                                                                           **time_limits))
+
+                tracker = QueryTaskTracker.create(job.id, 'created', query_hash, data_source.id, scheduled, metadata,
+                                                  predicted_runtime)
                 tracker.save(connection=pipe)
 
                 logging.info("[%s] Created new job: %s", query_hash, job.id)
                 pipe.set(_job_lock_id(query_hash, data_source.id), job.id, settings.JOB_EXPIRY_TIME)
                 pipe.execute()
+
+                if settings.QUERY_SCHEDULER_ENABLED:
+                    scheduler.dispatch(queue_name)
             break
 
         except redis.WatchError:
@@ -287,6 +464,10 @@ def refresh_queries():
 
 @celery.task(name="redash.tasks.cleanup_tasks", base=BaseTask)
 def cleanup_tasks():
+    """
+    Safety net for trackers whose tasks ended without the task signals updating them (see `_finish_tracker`), for
+    example because their worker was killed.
+    """
     in_progress = QueryTaskTracker.all(QueryTaskTracker.IN_PROGRESS_LIST)
     for tracker in in_progress:
         result = AsyncResult(tracker.task_id)
@@ -296,12 +477,12 @@ def cleanup_tasks():
         if result.status == 'PENDING':
             logging.info("In progress tracker for %s is no longer enqueued, cancelling (task: %s).",
                          tracker.query_hash, tracker.task_id)
-            _unlock(tracker.query_hash, tracker.data_source_id)
+            _unlock(tracker.query_hash, tracker.data_source_id, tracker.task_id)
             tracker.update(state='cancelled')
 
         if result.ready():
             logging.info("in progress tracker %s finished", tracker.query_hash)
-            _unlock(tracker.query_hash, tracker.data_source_id)
+            _unlock(tracker.query_hash, tracker.data_source_id, tracker.task_id)
             tracker.update(state='finished')
 
     waiting = QueryTaskTracker.all(QueryTaskTracker.WAITING_LIST)
@@ -310,13 +491,20 @@ def cleanup_tasks():
 
         if result.ready():
             logging.info("waiting tracker %s finished", tracker.query_hash)
-            _unlock(tracker.query_hash, tracker.data_source_id)
+            _unlock(tracker.query_hash, tracker.data_source_id, tracker.task_id)
             tracker.update(state='finished')
 
     # Maintain constant size of the finished tasks list:
     QueryTaskTracker.prune(QueryTaskTracker.DONE_LIST, 1000)
 
 
+def _is_data_location_used(query_result):
+    return models.QueryResult.select(models.QueryResult.id)\
+        .where(models.QueryResult.data_checksum == query_result.data_checksum,
+               models.QueryResult.data_location == query_result.data_location)\
+        .exists()
+
+
 @celery.task(name="redash.tasks.cleanup_query_results", base=BaseTask)
 def cleanup_query_results():
     """
@@ -330,9 +518,55 @@ def cleanup_query_results():
     logging.info("Running query results clean up (removing maximum of %d unused results, that are %d days old or more)",
                  settings.QUERY_RESULTS_CLEANUP_COUNT, settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
 
-    unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE).limit(settings.QUERY_RESULTS_CLEANUP_COUNT)
+    unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE)\
+        .select(models.QueryResult.id, models.QueryResult.org, models.QueryResult.data_location,
+                models.QueryResult.data_checksum, models.QueryResult.data_size)\
+        .limit(settings.QUERY_RESULTS_CLEANUP_COUNT)
+    unused_query_results = list(unused_query_results)
     total_unused_query_results = models.QueryResult.unused().count()
-    deleted_count = models.QueryResult.delete().where(models.QueryResult.id << unused_query_results).execute()
+
+    # Results holding data (in the database) that other results point at are deleted while holding the lock new
+    # results take to share it, after handing the data over to one of the results pointing at it:
+    holders = [r for r in unused_query_results if not r.data_location and r.data_checksum]
+    others = [r for r in unused_query_results if r.data_location or not r.data_checksum]
+
+    if others:
+        deleted_count = models.QueryResult.delete().where(models.QueryResult.id << [r.id for r in others]).execute()
+    else:
+        deleted_count = 0
+
+    for query_result in holders:
+        with models.QueryResult.data_lock(query_result.data_checksum):
+            models.QueryResult.hand_over_data(query_result.id)
+            deleted_count += models.QueryResult.delete().where(models.QueryResult.id == query_result.id).execute()
+
+    export_cache.invalidate([query_result.id for query_result in unused_query_results])
+
+    for query_result in unused_query_results:
+        if not results_storage.should_store_gzipped_json(query_result.data_size):
+            continue
+
+        try:
+            results_storage.remove_gzipped_json(query_result.org_id, query_result.id)
+        except Exception:
+            logger.exception("Failed removing the stored responses of query result %s", query_result.id)
+
+    # Results are deleted from the database first, so no query result is left pointing at a missing blob. As blobs are
+    # content addressed, a blob is removed only when no other result points to it (checked while holding the lock new
+    # results take to share it).
+    for query_result in others:
+        # Results pointing at the data of another result have no blob of their own:
+        if not query_result.data_location or models.QueryResult.data_holder_id(query_result.data_location):
+            continue
+
+        with models.QueryResult.data_lock(query_result.data_checksum):
+            if _is_data_location_used(query_result):
+                continue
+
+            try:
+                results_storage.remove(query_result.data_location)
+            except Exception:
+                logger.exception("Failed removing query result data from %s", query_result.data_location)
 
     logger.info("Deleted %d unused query results out of total of %d." % (deleted_count, total_unused_query_results))
 
@@ -390,43 +624,55 @@ class QueryExecutor(object):
             self.user = None
         self.query_hash = gen_query_hash(self.query)
         # Load existing tracker or create a new one if the job was created before code update:
-        self.tracker = QueryTaskTracker.get_by_task_id(task.request.id) or QueryTaskTracker.create(task.request.id,
-                                                                                                   'created',
-                                                                                                   self.query_hash,
-                                                                                                   self.data_source_id,
-                                                                                                   False, metadata)
+        self.tracker = QueryTaskTracker.get_by_task_id(task.request.id)
+        if self.tracker is None:
+            self.tracker = QueryTaskTracker.create(task.request.id, 'created', self.query_hash, self.data_source_id,
+                                                   False, metadata)
+            # Updates write only the changed fields, so the tracker has to be saved in full first:
+            self.tracker.save()
 
     def run(self):
-        signal.signal(signal.SIGINT, signal_handler)
-        self.tracker.update(started_at=time.time(), state='started')
-
-        logger.debug("Executing query:\n%s", self.query)
-        self._log_progress('executing_query')
-
         query_runner = self.data_source.query_runner
-        annotated_query = self._annotate_query(query_runner)
+        max_concurrent_queries = query_runner.max_concurrent_queries
+        timeout = query_runner.query_timeout
 
         try:
-            data, error = query_runner.run_query(annotated_query, self.user)
-        except Exception as e:
-            error = unicode(e)
-            data = None
-            logging.warning('Unexpected error while running query:', exc_info=1)
+            if max_concurrent_queries and not acquire_execution_slot(self.data_source.id, self.task.request.id,
+                                                                     max_concurrent_queries):
+                self._retry_later()
+
+            data, error, data_checksum, data_size, data_index, truncated, timed_out = self._execute(query_runner,
+                                                                                                    timeout)
+        finally:
+            # Releasing a slot that wasn't taken (when retrying) does nothing:
+            if max_concurrent_queries:
+                release_execution_slot(self.data_source.id, self.task.request.id)
 
         run_time = time.time() - self.tracker.started_at
-        self.tracker.update(error=error, run_time=run_time, state='saving_results')
+        self.tracker.update(error=error, run_time=run_time, state='saving_results', truncated=truncated)
+
+        logger.info(u"task=execute_query query_hash=%s data_length=%s truncated=%s error=[%s]", self.query_hash,
+                    data_size, truncated, error)
 
-        logger.info(u"task=execute_query query_hash=%s data_length=%s error=[%s]", self.query_hash, data and len(data), error)
+        if truncated:
+            statsd_client.incr('query_results.truncated')
 
-        _unlock(self.query_hash, self.data_source.id)
+        _unlock(self.query_hash, self.data_source.id, self.task.request.id)
 
-        if error:
+        if timed_out:
+            self._log_progress('timed_out')
+            statsd_client.incr('query_executions.timed_out')
+            result = QueryExecutionError(error)
+        elif error:
             self.tracker.update(state='failed')
             result = QueryExecutionError(error)
         else:
             query_result, updated_query_ids = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
                                                                               self.query_hash, self.query, data,
-                                                                              run_time, utils.utcnow())
+                                                                              run_time, utils.utcnow(),
+                                                                              data_checksum=data_checksum,
+                                                                              data_size=data_size,
+                                                                              data_index=data_index)
             self._log_progress('checking_alerts')
             for query_id in updated_query_ids:
                 check_alerts_for_query.delay(query_id)
@@ -436,6 +682,92 @@ class QueryExecutor(object):
 
         return result
 
+    def _execute(self, query_runner, timeout):
+        """Run the query, and return its data (or error), with the checksum, size and index of the data and whether
+        it was truncated or timed out.
+        """
+        signal.signal(signal.SIGINT, signal_handler)
+        self.tracker.update(started_at=time.time(), state='started')
+
+        if timeout:
+            # The lock has to outlive the execution only, so it's released soon even if the worker gets killed:
+            _expire_lock(self.query_hash, self.data_source.id, self.task.request.id,
+                         timeout + settings.QUERY_TIMEOUT_GRACE_PERIOD)
+
+        logger.debug("Executing query:\n%s", self.query)
+        self._log_progress('executing_query')
+
+        annotated_query = self._annotate_query(query_runner)
+
+        data_checksum = data_size = data_index = None
+        truncated = timed_out = False
+        try:
+            # Results of query runners that don't stream are passed through the writer too when they have to be
+            # limited in size.
+            if query_runner.supports_streaming() or query_runner.max_result_rows or query_runner.max_result_bytes:
+                data, data_checksum, data_size, data_index, truncated = self._run_query_iter(query_runner,
+                                                                                             annotated_query)
+                error = None
+            else:
+                data, error = query_runner.run_query(annotated_query, self.user)
+                data_size = data and len(data)
+        except QueryError as e:
+            error = e.message
+            data = None
+        except InterruptException:
+            error = "Query cancelled by user."
+            data = None
+        except SoftTimeLimitExceeded:
+            error = "Query exceeded the time limit of {} seconds.".format(timeout)
+            data = None
+            timed_out = True
+        except Exception as e:
+            error = unicode(e)
+            data = None
+            logging.warning('Unexpected error while running query:', exc_info=1)
+
+        return data, error, data_checksum, data_size, data_index, truncated, timed_out
+
+    def _retry_later(self):
+        """Re-queue the task (instead of holding the worker while waiting), with an exponential backoff. Fails the task
+        once it waited too long (while waiting, it holds the query's job lock).
+        """
+        retries = self.task.request.retries
+        countdown = min(settings.QUERY_CONCURRENCY_RETRY_DELAY * 2 ** retries,
+                        settings.QUERY_CONCURRENCY_RETRY_MAX_DELAY) * random.uniform(1, 1.5)
+
+        max_wait = min(settings.QUERY_CONCURRENCY_MAX_WAIT, settings.JOB_EXPIRY_TIME)
+        if time.time() + countdown - self.tracker.created_at > max_wait:
+            logger.info("task=execute_query state=slot_wait_expired query_hash=%s ds_id=%d task_id=%s retries=%d",
+                        self.query_hash, self.data_source.id, self.task.request.id, retries)
+            # The task failure handler releases the job lock:
+            raise QueryExecutionError("Query waited too long for the data source to finish its other queries.")
+
+        logger.info("task=execute_query state=waiting_for_slot query_hash=%s ds_id=%d task_id=%s retries=%d",
+                    self.query_hash, self.data_source.id, self.task.request.id, retries)
+        self.tracker.update(state='created', retries=retries + 1)
+        # The retry is sent to Celery directly, so it doesn't hold a slot of the scheduler while waiting:
+        _release_scheduler_slot(self.task.request.id)
+
+        raise self.task.retry(countdown=countdown, max_retries=None)
+
+    def _run_query_iter(self, query_runner, annotated_query):
+        # The result is serialized and compressed as the rows arrive, so only the compressed result is held in memory.
+        results = query_runner.run_query_iter(annotated_query, self.user)
+        try:
+            writer = QueryResultWriter(next(results), max_rows=query_runner.max_result_rows,
+                                       max_bytes=query_runner.max_result_bytes)
+            for rows in results:
+                writer.write_rows(rows)
+                # Stop fetching once the result reached the data source limits:
+                if writer.truncated:
+                    break
+        finally:
+            results.close()
+
+        data = writer.finish()
+        return data, writer.checksum, writer.size, writer.index, writer.truncated
+
     def _annotate_query(self, query_runner):
         if query_runner.annotate_query():
             self.metadata['Task ID'] = self.task.request.id
@@ -465,3 +797,79 @@ class QueryExecutor(object):
 @celery.task(name="redash.tasks.execute_query", bind=True, base=BaseTask, track_started=True)
 def execute_query(self, query, data_source_id, metadata, user_id=None):
     return QueryExecutor(self, query, data_source_id, user_id, metadata).run()
+
+
+def _finish_tracker(task_id, state, **kwargs):
+    """Move the task's tracker to a final state (unless it's already in one) and release its job lock and execution
+    slot right away (in case the task was killed before releasing them), so the next execution of the query doesn't
+    wait for `cleanup_tasks` and the data source's other queries don't wait for the slot to expire.
+    """
+    tracker = QueryTaskTracker.get_by_task_id(task_id)
+    if tracker is None:
+        return
+
+    _unlock(tracker.query_hash, tracker.data_source_id, task_id)
+    release_execution_slot(tracker.data_source_id, task_id)
+
+    if tracker.state not in QueryTaskTracker.DONE_STATES:
+        tracker.update(state=state, **kwargs)
+
+
+def _release_scheduler_slot(task_id):
+    if not settings.QUERY_SCHEDULER_ENABLED:
+        return
+
+    try:
+        scheduler.release(task_id)
+    except Exception:
+        logger.exception("Failed releasing scheduler slot of task %s.", task_id)
+
+
+@task_postrun.connect
+def task_postrun_handler(signal, sender, task_id, task, args, kwargs, retval, state):
+    # Tasks waiting for an execution slot are retried later:
+    if task.name != execute_query.name or state == 'RETRY':
+        return
+
+    try:
+        if state == 'SUCCESS' and not isinstance(retval, Exception):
+            _finish_tracker(task_id, 'finished')
+        else:
+            _finish_tracker(task_id, 'failed')
+    except Exception:
+        logger.exception("Failed updating tracker of task %s.", task_id)
+
+    _release_scheduler_slot(task_id)
+
+
+@task_failure.connect
+def task_failure_handler(signal, sender, task_id, exception, args, kwargs, traceback, einfo):
+    if sender.name != execute_query.name:
+        return
+
+    # The time limit may expire outside of the query runner (like while storing the result), or the task may be killed:
+    if isinstance(exception, (SoftTimeLimitExceeded, TimeLimitExceeded)):
+        state = 'timed_out'
+        statsd_client.incr('query_executions.timed_out')
+    else:
+        state = 'failed'
+
+    try:
+        _finish_tracker(task_id, state, error=unicode(exception))
+    except Exception:
+        logger.exception("Failed updating tracker of task %s.", task_id)
+
+    _release_scheduler_slot(task_id)
+
+
+@task_revoked.connect
+def task_revoked_handler(signal, sender, request, terminated, signum, expired):
+    if getattr(sender, 'name', None) != execute_query.name:
+        return
+
+    try:
+        _finish_tracker(request.id, 'cancelled')
+    except Exception:
+        logger.exception("Failed updating tracker of task %s.", request.id)
+
+    _release_scheduler_slot(request.id)
@@ -0,0 +1,45 @@
+"""
+Prediction of query runtimes, from the runtimes of their previous results.
+
+A query's runtime is predicted to be the QUERY_RUNTIME_PREDICTION_PERCENTILE percentile of the runtimes of its latest
+results. Queries that have no results yet get the percentile of the latest results of their data source (which is
+cached, as it's shared by all of its queries).
+"""
+import math
+
+from redash import models, redis_connection, settings
+
+DATA_SOURCE_PREDICTION_TTL = 600
+
+
+def percentile(values, p):
+    """Return the p percentile (0-100) of the values, using linear interpolation between the closest ranks."""
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100.0
+    lower = int(math.floor(position))
+    upper = int(math.ceil(position))
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _data_source_prediction(data_source_id):
+    key = 'ds:{}:predicted_runtime'.format(data_source_id)
+    prediction = redis_connection.get(key)
+    if prediction is not None:
+        return float(prediction) if prediction else None
+
+    runtimes = models.QueryResult.recent_runtimes(data_source_id, limit=settings.QUERY_RUNTIME_PREDICTION_SAMPLES)
+    prediction = percentile(runtimes, settings.QUERY_RUNTIME_PREDICTION_PERCENTILE) if runtimes else None
+    redis_connection.set(key, '' if prediction is None else prediction, ex=DATA_SOURCE_PREDICTION_TTL)
+
+    return prediction
+
+
+def predict_runtime(data_source_id, query_hash):
+    """Return the predicted runtime (in seconds) of the query, or None if the data source has no results yet."""
+    runtimes = models.QueryResult.recent_runtimes(data_source_id, query_hash,
+                                                  limit=settings.QUERY_RUNTIME_PREDICTION_SAMPLES)
+    if runtimes:
+        return percentile(runtimes, settings.QUERY_RUNTIME_PREDICTION_PERCENTILE)
+
+    return _data_source_prediction(data_source_id)
@@ -0,0 +1,207 @@
+"""
+Fair-share scheduling of query executions.
+
+When settings.QUERY_SCHEDULER_ENABLED is set, `enqueue_query` doesn't send queries to Celery right away. They're
+kept in per-org and per-user virtual queues in Redis, and at most settings.QUERY_SCHEDULER_MAX_IN_FLIGHT of each
+Celery queue's tasks are sent to the workers at a time. Whenever a task finishes the next one is picked:
+
+* Interactive runs are always picked before scheduled ones.
+* Of the orgs with waiting queries, the one that had the least (weighted) share of executions is picked, and then
+  the same way the user of that org. Each org and user has a virtual time, which advances with every execution it
+  gets (by 1 / weight for orgs, see settings.QUERY_SCHEDULER_ORG_WEIGHTS). Tenants that become active start from
+  the virtual time of the last picked one, so they can't save up a share while idle.
+
+The time queries wait in the virtual queues is reported to statsd (`query_scheduler.wait_time`, tagged by org, user
+and priority class).
+"""
+import json
+import time
+
+from celery.utils.log import get_task_logger
+from redash import redis_connection, settings, statsd_client
+from redash.metrics.celery import metric_name
+from redash.worker import celery
+from .base import BaseTask
+
+logger = get_task_logger(__name__)
+
+INTERACTIVE = 'interactive'
+SCHEDULED = 'scheduled'
+
+_QUEUES_KEY = 'query_scheduler:queues'
+_TASKS_KEY = 'query_scheduler:tasks'
+
+# Adds the job (ARGV[4]) to the virtual queue of its priority class (ARGV[1]), org (ARGV[2]) and user (ARGV[3]) in
+# the Celery queue's scheduler (KEYS[1] is its keys prefix).
+_ENQUEUE_SCRIPT = """
+local prefix, class, org, user, job = KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local vtimes = prefix .. ':vtimes'
+
+local function activate(set, member, vtime_key, vclock_key)
+    if redis.call('ZSCORE', set, member) then
+        return
+    end
+
+    local vtime = tonumber(redis.call('HGET', vtimes, vtime_key) or 0)
+    local vclock = tonumber(redis.call('HGET', vtimes, vclock_key) or 0)
+    redis.call('ZADD', set, math.max(vtime, vclock), member)
+end
+
+redis.call('RPUSH', prefix .. ':jobs:' .. class .. ':' .. org .. ':' .. user, job)
+activate(prefix .. ':orgs:' .. class, org, 'org:' .. class .. ':' .. org, 'vclock:' .. class)
+activate(prefix .. ':users:' .. class .. ':' .. org, user, 'user:' .. class .. ':' .. org .. ':' .. user,
+         'vclock:' .. class .. ':' .. org)
+"""
+
+# Pops the next job to run from the Celery queue's scheduler (KEYS[1] is its keys prefix, KEYS[2] the hash of in
+# flight tasks' queues), unless it has ARGV[2] tasks in flight already. ARGV[1] is the current time, ARGV[3] the time
+# after which in flight tasks are considered lost (so their workers died), ARGV[4] the org weights (JSON) and ARGV[5]
+# the Celery queue's name.
+_DISPATCH_SCRIPT = """
+local prefix, tasks = KEYS[1], KEYS[2]
+local now, max_in_flight, expiry = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local org_weights = cjson.decode(ARGV[4])
+local in_flight = prefix .. ':in_flight'
+local vtimes = prefix .. ':vtimes'
+
+for _, task_id in ipairs(redis.call('ZRANGEBYSCORE', in_flight, '-inf', now - expiry)) do
+    redis.call('ZREM', in_flight, task_id)
+    redis.call('HDEL', tasks, task_id)
+end
+
+if redis.call('ZCARD', in_flight) >= max_in_flight then
+    return false
+end
+
+for _, class in ipairs({'interactive', 'scheduled'}) do
+    local orgs = prefix .. ':orgs:' .. class
+    local first_org = redis.call('ZRANGE', orgs, 0, 0, 'WITHSCORES')
+
+    if first_org[1] then
+        local org, org_vtime = first_org[1], tonumber(first_org[2])
+        local users = prefix .. ':users:' .. class .. ':' .. org
+        local first_user = redis.call('ZRANGE', users, 0, 0, 'WITHSCORES')
+        local user, user_vtime = first_user[1], tonumber(first_user[2])
+        local jobs = prefix .. ':jobs:' .. class .. ':' .. org .. ':' .. user
+        local job = redis.call('LPOP', jobs)
+
+        redis.call('HSET', vtimes, 'vclock:' .. class, org_vtime)
+        redis.call('HSET', vtimes, 'vclock:' .. class .. ':' .. org, user_vtime)
+
+        user_vtime = user_vtime + 1
+        if redis.call('LLEN', jobs) > 0 then
+            redis.call('ZADD', users, user_vtime, user)
+        else
+            redis.call('ZREM', users, user)
+            redis.call('HSET', vtimes, 'user:' .. class .. ':' .. org .. ':' .. user, user_vtime)
+        end
+
+        org_vtime = org_vtime + 1 / tonumber(org_weights[org] or 1)
+        if redis.call('ZCARD', users) > 0 then
+            redis.call('ZADD', orgs, org_vtime, org)
+        else
+            redis.call('ZREM', orgs, org)
+            redis.call('HSET', vtimes, 'org:' .. class .. ':' .. org, org_vtime)
+        end
+
+        local task_id = cjson.decode(job)['task_id']
+        redis.call('ZADD', in_flight, now, task_id)
+        redis.call('HSET', tasks, task_id, ARGV[5])
+
+        return job
+    end
+end
+
+return false
+"""
+
+# Removes the task (ARGV[1]) from the in flight tasks, and returns its Celery queue (or nothing if it wasn't in
+# flight). KEYS[1] is the hash of in flight tasks' queues.
+_RELEASE_SCRIPT = """
+local queue = redis.call('HGET', KEYS[1], ARGV[1])
+if not queue then
+    return false
+end
+
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', 'query_scheduler:' .. queue .. ':in_flight', ARGV[1])
+return queue
+"""
+
+_enqueue = redis_connection.register_script(_ENQUEUE_SCRIPT)
+_dispatch = redis_connection.register_script(_DISPATCH_SCRIPT)
+_release = redis_connection.register_script(_RELEASE_SCRIPT)
+
+
+def _prefix(queue_name):
+    return 'query_scheduler:{}'.format(queue_name)
+
+
+def enqueue(queue_name, task_id, args, org_id, user_id, scheduled, options=None, client=None):
+    """Add an execute_query task (by its id, arguments and Celery execution options) to the scheduler of the Celery
+    queue. It's sent to Celery by `dispatch`.
+    """
+    if client is None:
+        client = redis_connection
+
+    job = json.dumps({
+        'task_id': task_id,
+        'args': args,
+        'options': options or {},
+        'org_id': org_id,
+        'user_id': user_id,
+        'scheduled': scheduled,
+        'enqueued_at': time.time()
+    })
+    priority_class = SCHEDULED if scheduled else INTERACTIVE
+
+    client.sadd(_QUEUES_KEY, queue_name)
+    _enqueue(keys=[_prefix(queue_name)], args=[priority_class, str(org_id), str(user_id), job], client=client)
+
+
+def dispatch(queue_name):
+    """Send the Celery queue's next tasks to the workers, as long as it has less than the max tasks in flight."""
+    org_weights = json.dumps({str(k): v for k, v in settings.QUERY_SCHEDULER_ORG_WEIGHTS.iteritems()})
+    dispatched = 0
+
+    while True:
+        job = _dispatch(keys=[_prefix(queue_name), _TASKS_KEY],
+                        args=[time.time(), settings.QUERY_SCHEDULER_MAX_IN_FLIGHT, settings.JOB_EXPIRY_TIME,
+                              org_weights, queue_name])
+        if not job:
+            return dispatched
+
+        job = json.loads(job)
+        tags = {'org_id': job['org_id'], 'user_id': job['user_id'],
+                'class': SCHEDULED if job['scheduled'] else INTERACTIVE}
+        statsd_client.timing(metric_name('query_scheduler.wait_time', tags), 1000 * (time.time() - job['enqueued_at']))
+
+        try:
+            celery.send_task('redash.tasks.execute_query', args=job['args'], task_id=job['task_id'], queue=queue_name,
+                             **job.get('options', {}))
+        except Exception:
+            # Put the task back, to be dispatched again later (by dispatch_queries):
+            logger.exception("Failed sending task %s to queue %s.", job['task_id'], queue_name)
+            _release(keys=[_TASKS_KEY], args=[job['task_id']])
+            enqueue(queue_name, job['task_id'], job['args'], job['org_id'], job['user_id'], job['scheduled'],
+                    job.get('options'))
+            return dispatched
+
+        dispatched += 1
+
+
+def release(task_id):
+    """Free the in flight slot of the task (when it's done), and dispatch the next task of its queue."""
+    queue_name = _release(keys=[_TASKS_KEY], args=[task_id])
+    if queue_name:
+        dispatch(queue_name)
+
+
+@celery.task(name="redash.tasks.dispatch_queries", base=BaseTask)
+def dispatch_queries():
+    """
+    Dispatches the queries of all the Celery queues. Tasks are dispatched when they're enqueued and when other tasks
+    finish, so this only catches what's left behind (like when tasks of a dead worker expire).
+    """
+    for queue_name in redis_connection.smembers(_QUEUES_KEY):
+        dispatch(queue_name)
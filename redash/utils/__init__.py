@@ -7,6 +7,7 @@ import json
 import random
 import re
 import hashlib
+import uuid
 import pytz
 import pystache
 
@@ -53,10 +54,30 @@ def generate_token(length):
     return ''.join(rand.choice(chars) for x in range(length))
 
 
+class RawJSON(object):
+    """Already serialized JSON value, which json_dumps includes in its output as is.
+
+    Used to return stored query results without parsing and serializing them again.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
 class JSONEncoder(json.JSONEncoder):
     """Custom JSON encoding class, to handle Decimal and datetime.date instances."""
 
+    def __init__(self, *args, **kwargs):
+        super(JSONEncoder, self).__init__(*args, **kwargs)
+        # RawJSON values are encoded as placeholder strings and replaced with the actual values by json_dumps.
+        self.raw_values = []
+        self.raw_values_token = uuid.uuid4().hex
+
     def default(self, o):
+        if isinstance(o, RawJSON):
+            self.raw_values.append(o.value)
+            return u'\x00raw-json:{}:{}'.format(self.raw_values_token, len(self.raw_values) - 1)
+
         if isinstance(o, decimal.Decimal):
             return float(o)
 
@@ -70,7 +91,14 @@ class JSONEncoder(json.JSONEncoder):
 
 
 def json_dumps(data):
-    return json.dumps(data, cls=JSONEncoder)
+    encoder = JSONEncoder()
+    output = encoder.encode(data)
+
+    if encoder.raw_values:
+        placeholder = re.compile(r'"\\u0000raw-json:{}:(\d+)"'.format(encoder.raw_values_token))
+        output = placeholder.sub(lambda match: encoder.raw_values[int(match.group(1))], output)
+
+    return output
 
 
 def build_url(request, host, path):
@@ -119,6 +147,47 @@ class UnicodeWriter:
             self.writerow(row)
 
 
+def _encode_csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+
+def generate_csv(header, rows, chunk_rows=1000):
+    """Yield the (UTF-8 encoded) CSV of the header and rows, in chunks of up to chunk_rows rows, so the whole CSV is
+    never held in memory.
+    """
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_encode_csv_value(value) for value in header])
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_encode_csv_value(value) for value in row])
+
+        if count % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue()
+
+
+def generate_ndjson(header, rows, chunk_rows=1000):
+    """Yield the newline delimited JSON (an object per row) of the rows, in chunks of up to chunk_rows rows."""
+    lines = []
+
+    for row in rows:
+        lines.append(json_dumps(dict(zip(header, row))))
+
+        if len(lines) == chunk_rows:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
 def _collect_key_names(nodes):
     keys = []
     for node in nodes._parse_tree:
@@ -0,0 +1,417 @@
+"""
+Arrow IPC stream export of query results.
+
+The result is written as a stream of record batches (of up to `chunk_rows` rows each), so it can be generated while
+the rows are read, without holding the whole result in memory. Column types are taken from the result's `columns`
+metadata: integers are written as int64, floats as float64, booleans as bool, datetimes as (naive, UTC) millisecond
+timestamps, dates as date32 and everything else as UTF-8 strings. Values that can't be converted to their column's
+type are written as nulls.
+
+When pyarrow is installed it does the writing. Otherwise a minimal writer of the format, which supports only the
+types above, is used. It encodes the (flatbuffers) message metadata by hand; see
+https://arrow.apache.org/docs/format/Columnar.html#serialization-and-interprocess-communication-ipc
+"""
+import datetime
+import io
+import struct
+
+from dateutil import parser as date_parser
+
+from redash.utils import json_dumps
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+INT64 = 'int64'
+FLOAT64 = 'float64'
+BOOL = 'bool'
+TIMESTAMP = 'timestamp'
+DATE32 = 'date32'
+UTF8 = 'utf8'
+
+# Redash column types (see redash.query_runner) and the Arrow types they're written as:
+COLUMN_TYPES = {
+    'integer': INT64,
+    'float': FLOAT64,
+    'boolean': BOOL,
+    'datetime': TIMESTAMP,
+    'date': DATE32,
+}
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _parse_datetime(value):
+    if isinstance(value, basestring):
+        value = date_parser.parse(value)
+
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+
+    return value
+
+
+def _to_int(value):
+    return int(value)
+
+
+def _to_float(value):
+    return float(value)
+
+
+def _to_bool(value):
+    if not isinstance(value, (bool, int, long)):
+        raise ValueError(value)
+
+    return bool(value)
+
+
+def _to_timestamp(value):
+    delta = _parse_datetime(value) - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def _to_date32(value):
+    return (_parse_datetime(value).date() - _EPOCH.date()).days
+
+
+def _to_utf8(value):
+    if isinstance(value, (dict, list)):
+        value = json_dumps(value)
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return value
+
+
+_CONVERTERS = {
+    INT64: _to_int,
+    FLOAT64: _to_float,
+    BOOL: _to_bool,
+    TIMESTAMP: _to_timestamp,
+    DATE32: _to_date32,
+    UTF8: _to_utf8,
+}
+
+
+def column_type(column):
+    return COLUMN_TYPES.get(column.get('type'), UTF8)
+
+
+def _convert(converter, value):
+    if value is None:
+        return None
+
+    try:
+        return converter(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _iter_batches(types, rows, chunk_rows):
+    """Yield the rows in batches of up to chunk_rows rows, as lists of (converted) column values."""
+    converters = [_CONVERTERS[t] for t in types]
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == chunk_rows:
+            yield _to_columns(converters, batch)
+            batch = []
+
+    if batch:
+        yield _to_columns(converters, batch)
+
+
+def _to_columns(converters, rows):
+    return [[_convert(converter, row[i]) for row in rows] for i, converter in enumerate(converters)]
+
+
+def generate_stream(columns, rows, chunk_rows=1000):
+    """Yield the Arrow IPC stream of the rows (lists of values, ordered as the columns), in chunks of a record batch
+    of up to chunk_rows rows each.
+    """
+    names = [column['name'] for column in columns]
+    types = [column_type(column) for column in columns]
+    batches = _iter_batches(types, rows, chunk_rows)
+
+    if pyarrow is not None:
+        return _generate_pyarrow_stream(names, types, batches)
+
+    return _generate_stream(names, types, batches)
+
+
+def _generate_pyarrow_stream(names, types, batches):
+    arrow_types = {
+        INT64: pyarrow.int64(),
+        FLOAT64: pyarrow.float64(),
+        BOOL: pyarrow.bool_(),
+        TIMESTAMP: pyarrow.timestamp('ms'),
+        DATE32: pyarrow.date32(),
+        UTF8: pyarrow.string(),
+    }
+    schema = pyarrow.schema([pyarrow.field(name, arrow_types[t]) for name, t in zip(names, types)])
+
+    sink = io.BytesIO()
+
+    def flush():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    writer = pyarrow.RecordBatchStreamWriter(sink, schema)
+    yield flush()
+
+    for batch in batches:
+        arrays = [pyarrow.array(values, type=arrow_types[t]) for values, t in zip(batch, types)]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, names))
+        yield flush()
+
+    writer.close()
+    yield flush()
+
+
+# The flatbuffers types used in the stream messages (from Arrow's Schema.fbs and Message.fbs):
+_METADATA_VERSION_V5 = 4
+_HEADER_SCHEMA = 1
+_HEADER_RECORD_BATCH = 3
+
+_TYPE_INT = 2
+_TYPE_FLOATING_POINT = 3
+_TYPE_UTF8 = 5
+_TYPE_BOOL = 6
+_TYPE_DATE = 8
+_TYPE_TIMESTAMP = 10
+
+_PRECISION_DOUBLE = 2
+_DATE_UNIT_DAY = 0
+_TIME_UNIT_MILLISECOND = 1
+
+_CONTINUATION = 0xFFFFFFFF
+
+
+class _Table(object):
+    """A flatbuffers table. Fields are (slot, struct format, value) tuples, where values of fields with the _OFFSET
+    format are other flatbuffers objects.
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+
+
+class _String(object):
+    def __init__(self, value):
+        self.value = value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class _TableVector(object):
+    def __init__(self, tables):
+        self.tables = tables
+
+
+class _StructVector(object):
+    """A vector of structs of 8 byte integers."""
+
+    def __init__(self, structs):
+        self.structs = structs
+
+
+_OFFSET = 'offset'
+
+
+class _FlatBufferWriter(object):
+    """Writes a flatbuffer front to back: objects are written before the objects they refer to (as flatbuffers offsets
+    are unsigned), and references are patched in once the referred objects are written.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(4)
+
+    def finish(self, root):
+        struct.pack_into('<I', self.buf, 0, self.write(root))
+        self.align(8)
+        return bytes(self.buf)
+
+    def align(self, alignment, extra=0):
+        self.buf.extend(b'\0' * (-(len(self.buf) + extra) % alignment))
+
+    def write(self, obj):
+        if isinstance(obj, _Table):
+            return self.write_table(obj)
+
+        if isinstance(obj, _String):
+            self.align(4)
+            position = len(self.buf)
+            self.buf.extend(struct.pack('<I', len(obj.value)) + obj.value + b'\0')
+            return position
+
+        if isinstance(obj, _TableVector):
+            self.align(4)
+            position = len(self.buf)
+            self.buf.extend(struct.pack('<I', len(obj.tables)) + b'\0' * 4 * len(obj.tables))
+            for i, table in enumerate(obj.tables):
+                self.patch(position + 4 + 4 * i, self.write(table))
+            return position
+
+        # The structs have to be 8 bytes aligned, so the vector length is 4 bytes before an aligned position:
+        self.align(8, 4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack('<I', len(obj.structs)))
+        for values in obj.structs:
+            self.buf.extend(struct.pack('<{}q'.format(len(values)), *values))
+        return position
+
+    def write_table(self, table):
+        # Fields are laid out by descending size, after the vtable offset, which keeps them aligned as long as the
+        # table starts 4 bytes before an 8 bytes aligned position:
+        fields = sorted(table.fields, key=lambda field: -self.field_size(field))
+        field_offsets = {}
+        offset = 4
+        for field in fields:
+            field_offsets[field[0]] = offset
+            offset += self.field_size(field)
+
+        slots = max(field_offsets.keys()) + 1 if field_offsets else 0
+        vtable = struct.pack('<{}H'.format(slots + 2), 4 + 2 * slots, offset,
+                             *[field_offsets.get(slot, 0) for slot in range(slots)])
+
+        self.align(2)
+        vtable_position = len(self.buf)
+        self.buf.extend(vtable)
+
+        self.align(8, 4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack('<i', position - vtable_position))
+
+        references = []
+        for slot, fmt, value in fields:
+            if fmt == _OFFSET:
+                references.append((len(self.buf), value))
+                self.buf.extend(b'\0' * 4)
+            else:
+                self.buf.extend(struct.pack('<' + fmt, value))
+
+        for field_position, value in references:
+            self.patch(field_position, self.write(value))
+
+        return position
+
+    def patch(self, field_position, position):
+        struct.pack_into('<I', self.buf, field_position, position - field_position)
+
+    @staticmethod
+    def field_size(field):
+        return 4 if field[1] == _OFFSET else struct.calcsize('<' + field[1])
+
+
+def _field_type(t):
+    if t == INT64:
+        return _TYPE_INT, _Table((0, 'i', 64), (1, '?', True))
+    if t == FLOAT64:
+        return _TYPE_FLOATING_POINT, _Table((0, 'h', _PRECISION_DOUBLE))
+    if t == BOOL:
+        return _TYPE_BOOL, _Table()
+    if t == TIMESTAMP:
+        return _TYPE_TIMESTAMP, _Table((0, 'h', _TIME_UNIT_MILLISECOND))
+    if t == DATE32:
+        return _TYPE_DATE, _Table((0, 'h', _DATE_UNIT_DAY))
+
+    return _TYPE_UTF8, _Table()
+
+
+def _message(header_type, header, body=b''):
+    metadata = _FlatBufferWriter().finish(_Table(
+        (0, 'h', _METADATA_VERSION_V5),
+        (1, 'B', header_type),
+        (2, _OFFSET, header),
+        (3, 'q', len(body))
+    ))
+
+    return struct.pack('<Ii', _CONTINUATION, len(metadata)) + metadata + body
+
+
+def _schema_message(names, types):
+    fields = []
+    for name, t in zip(names, types):
+        type_type, type_table = _field_type(t)
+        fields.append(_Table(
+            (0, _OFFSET, _String(name)),
+            (1, '?', True),
+            (2, 'B', type_type),
+            (3, _OFFSET, type_table),
+            (5, _OFFSET, _TableVector([]))
+        ))
+
+    return _message(_HEADER_SCHEMA, _Table((1, _OFFSET, _TableVector(fields))))
+
+
+def _bitmap(flags):
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            bitmap[i // 8] |= 1 << (i % 8)
+
+    return bytes(bitmap)
+
+
+def _column_buffers(t, values):
+    """Return the buffers (validity bitmap first) of the column values."""
+    validity = _bitmap([value is not None for value in values])
+
+    if t == BOOL:
+        return [validity, _bitmap(values)]
+
+    if t == UTF8:
+        offsets = [0]
+        for value in values:
+            offsets.append(offsets[-1] + len(value or b''))
+        return [validity, struct.pack('<{}i'.format(len(offsets)), *offsets),
+                b''.join(value for value in values if value is not None)]
+
+    fmt = {INT64: 'q', FLOAT64: 'd', TIMESTAMP: 'q', DATE32: 'i'}[t]
+    return [validity, struct.pack('<{}{}'.format(len(values), fmt), *[value or 0 for value in values])]
+
+
+def _record_batch_message(types, columns):
+    nodes = []
+    buffers = []
+    body = []
+    body_length = 0
+
+    for t, values in zip(types, columns):
+        nodes.append((len(values), sum(1 for value in values if value is None)))
+
+        for data in _column_buffers(t, values):
+            buffers.append((body_length, len(data)))
+            body.append(data + b'\0' * (-len(data) % 8))
+            body_length += len(body[-1])
+
+    header = _Table(
+        (0, 'q', len(columns[0]) if columns else 0),
+        (1, _OFFSET, _StructVector(nodes)),
+        (2, _OFFSET, _StructVector(buffers))
+    )
+
+    return _message(_HEADER_RECORD_BATCH, header, b''.join(body))
+
+
+def _generate_stream(names, types, batches):
+    yield _schema_message(names, types)
+
+    for columns in batches:
+        yield _record_batch_message(types, columns)
+
+    # End of stream marker:
+    yield struct.pack('<Ii', _CONTINUATION, 0)
@@ -0,0 +1,288 @@
+"""
+Filtering, grouping and sorting of query results on the server.
+
+The result rows are transposed into column arrays once, and every operation works on columns: filters narrow down a
+list of row positions, sorting sorts the positions by the column values and only the rows that make it to the output
+are materialized.
+
+An operation spec looks like:
+
+    {
+        "filters": [{"column": "country", "op": "in", "value": ["US", "CA"]}],
+        "group_by": ["country"],
+        "aggregations": [{"function": "sum", "column": "amount", "name": "total"}, {"function": "count"}],
+        "order_by": [{"column": "total", "direction": "desc"}],
+        "limit": 10
+    }
+
+All keys are optional. Without `group_by` and `aggregations` the filtered (and sorted) rows are returned as they are.
+The output is a V2 result (see `redash.utils.result_format`).
+"""
+import json
+import operator
+from collections import OrderedDict
+
+import jsonschema
+
+from redash.query_runner import TYPE_FLOAT, TYPE_INTEGER
+from redash.utils import result_format
+
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': lambda value, keys: _key(value) in keys,
+    'contains': lambda value, substring: value is not None and substring in unicode(value)
+}
+
+AGGREGATION_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+NUMERIC_AGGREGATION_FUNCTIONS = ('sum', 'avg')
+
+SPEC_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'filters': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'column': {'type': 'string'},
+                    'op': {'enum': FILTER_OPERATORS.keys()},
+                    'value': {}
+                },
+                'required': ['column', 'op', 'value']
+            }
+        },
+        'group_by': {
+            'type': 'array',
+            'items': {'type': 'string'}
+        },
+        'aggregations': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'function': {'enum': list(AGGREGATION_FUNCTIONS)},
+                    'column': {'type': 'string'},
+                    'name': {'type': 'string'}
+                },
+                'required': ['function']
+            }
+        },
+        'order_by': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'column': {'type': 'string'},
+                    'direction': {'enum': ['asc', 'desc']}
+                },
+                'required': ['column']
+            }
+        },
+        'limit': {
+            'type': 'integer',
+            'minimum': 0
+        }
+    },
+    'additionalProperties': False
+}
+
+
+class InvalidSpecError(Exception):
+    pass
+
+
+def _non_null(values):
+    return [value for value in values if value is not None]
+
+
+def _key(value):
+    """Return a hashable key of the value, for set lookups and grouping (values of JSON and array columns are dicts
+    and lists). Keys of equal values are equal.
+    """
+    if isinstance(value, (dict, list)):
+        return 'json', json.dumps(value, sort_keys=True)
+
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _count(values):
+    return len(_non_null(values))
+
+
+def _sum(values):
+    return sum(_non_null(values))
+
+
+def _avg(values):
+    values = _non_null(values)
+    return float(sum(values)) / len(values) if values else None
+
+
+def _min(values):
+    values = _non_null(values)
+    return min(values) if values else None
+
+
+def _max(values):
+    values = _non_null(values)
+    return max(values) if values else None
+
+
+_AGGREGATORS = {
+    'count': _count,
+    'sum': _sum,
+    'avg': _avg,
+    'min': _min,
+    'max': _max
+}
+
+
+def validate(spec):
+    try:
+        jsonschema.validate(spec, SPEC_SCHEMA)
+    except jsonschema.ValidationError as e:
+        raise InvalidSpecError(e.message)
+
+    for f in spec.get('filters', []):
+        if f['op'] == 'contains' and not isinstance(f['value'], basestring):
+            raise InvalidSpecError("The value of the contains filter must be a string.")
+
+    for aggregation in spec.get('aggregations', []):
+        if aggregation['function'] != 'count' and 'column' not in aggregation:
+            raise InvalidSpecError("The {} aggregation requires a column.".format(aggregation['function']))
+
+
+def _aggregation_name(aggregation):
+    if 'name' in aggregation:
+        return aggregation['name']
+
+    if 'column' in aggregation:
+        return u'{}_{}'.format(aggregation['function'], aggregation['column'])
+
+    return aggregation['function']
+
+
+class ColumnarResult(object):
+    def __init__(self, data):
+        self.columns = OrderedDict((column['name'], column) for column in data['columns'])
+        self.length = len(data['rows'])
+        self._data = data
+        self._arrays = {}
+
+    def column(self, name):
+        """Return the values of the column as a list (built on first use)."""
+        if name not in self.columns:
+            raise InvalidSpecError(u"Unknown column: {}".format(name))
+
+        if name not in self._arrays:
+            rows = self._data['rows']
+            if result_format.get_format(self._data) == result_format.V2:
+                position = self.columns.keys().index(name)
+                self._arrays[name] = [row[position] for row in rows]
+            else:
+                self._arrays[name] = [row.get(name) for row in rows]
+
+        return self._arrays[name]
+
+    def filter(self, filters):
+        positions = range(self.length)
+        for f in filters:
+            values = self.column(f['column'])
+            compare = FILTER_OPERATORS[f['op']]
+            value = f['value']
+            if f['op'] == 'in':
+                value = set(_key(v) for v in value) if isinstance(value, list) else set([_key(value)])
+
+            positions = [position for position in positions if compare(values[position], value)]
+
+        return positions
+
+    def group(self, positions, group_by, aggregations):
+        key_columns = [self.column(name) for name in group_by]
+
+        groups = OrderedDict()
+        if group_by:
+            for position in positions:
+                key = tuple(_key(values[position]) for values in key_columns)
+                groups.setdefault(key, []).append(position)
+        else:
+            groups[()] = positions
+
+        columns = [self.columns[name] for name in group_by]
+        aggregators = []
+        for aggregation in aggregations:
+            function = aggregation['function']
+            values = self.column(aggregation['column']) if 'column' in aggregation else None
+
+            # Column types are optional (and not always accurate), so it's the values that are checked:
+            if function in NUMERIC_AGGREGATION_FUNCTIONS and not all(_is_number(v) for v in _non_null(values)):
+                raise InvalidSpecError(u"The {} aggregation requires a numeric column, but {} isn't.".format(
+                    function, aggregation['column']))
+
+            if function == 'count':
+                column_type = TYPE_INTEGER
+            elif function == 'avg':
+                column_type = TYPE_FLOAT
+            else:
+                column_type = self.columns[aggregation['column']].get('type')
+
+            name = _aggregation_name(aggregation)
+            columns.append({'name': name, 'friendly_name': name, 'type': column_type})
+            aggregators.append((_AGGREGATORS[function], values))
+
+        rows = []
+        for group_positions in groups.itervalues():
+            # The group's values (and not their keys), taken from its first row:
+            row = [values[group_positions[0]] for values in key_columns]
+            for aggregate, values in aggregators:
+                if values is None:
+                    row.append(len(group_positions))
+                else:
+                    row.append(aggregate([values[position] for position in group_positions]))
+            rows.append(row)
+
+        return columns, rows
+
+
+def _sort_rows(columns, rows, order_by):
+    names = [column['name'] for column in columns]
+    for order in reversed(order_by):
+        if order['column'] not in names:
+            raise InvalidSpecError(u"Unknown column: {}".format(order['column']))
+
+        rows.sort(key=operator.itemgetter(names.index(order['column'])), reverse=order.get('direction') == 'desc')
+
+
+def execute(data, spec):
+    """Apply the operations of the spec to the result data (of any format), and return the output as a V2 result."""
+    validate(spec)
+
+    result = ColumnarResult(data)
+    positions = result.filter(spec.get('filters', []))
+    order_by = spec.get('order_by', [])
+    limit = spec.get('limit')
+
+    if spec.get('group_by') or spec.get('aggregations'):
+        columns, rows = result.group(positions, spec.get('group_by', []), spec.get('aggregations', []))
+        _sort_rows(columns, rows, order_by)
+        rows = rows[:limit]
+    else:
+        # Sort and limit the positions, to materialize only the returned rows:
+        for order in reversed(order_by):
+            positions.sort(key=result.column(order['column']).__getitem__, reverse=order.get('direction') == 'desc')
+
+        positions = positions[:limit]
+        columns = result.columns.values()
+        arrays = [result.column(name) for name in result.columns]
+        rows = [[values[position] for values in arrays] for position in positions]
+
+    return {'format': result_format.V2, 'columns': columns, 'rows': rows}
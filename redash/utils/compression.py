@@ -0,0 +1,159 @@
+"""
+Storage encoding of query result payloads.
+
+Query results are stored as text in the `query_results.data` column. Compressed values start with a format marker
+(which includes the encoding version), followed by the compressed JSON:
+
+zlib1: the base64 representation of the zlib compressed JSON.
+zlib2: the JSON compressed in blocks, each the base64 representation of a separate zlib stream, separated by commas.
+       Every block can be decompressed on its own, so parts of the JSON can be read without decompressing all of it
+       (see `decompress_blocks`).
+
+JSON text never starts with a control character, so values without the marker are legacy (uncompressed) payloads and
+are returned as is.
+"""
+import base64
+import gzip
+import zlib
+from cStringIO import StringIO
+
+FORMAT_MARKER = u'\x1fredash:'
+ZLIB_V1 = u'zlib1'
+ZLIB_V2 = u'zlib2'
+
+_ZLIB_V1_PREFIX = u'{}{}:'.format(FORMAT_MARKER, ZLIB_V1)
+_ZLIB_V2_PREFIX = u'{}{}:'.format(FORMAT_MARKER, ZLIB_V2)
+_BLOCKS_SEPARATOR = u','
+
+
+class UnsupportedFormatError(Exception):
+    pass
+
+
+def is_compressed(value):
+    return value is not None and value.startswith(FORMAT_MARKER)
+
+
+def is_block_compressed(value):
+    return value is not None and value.startswith(_ZLIB_V2_PREFIX)
+
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+
+    return data
+
+
+def compress(data, level=6):
+    if is_compressed(data):
+        return data
+
+    return _ZLIB_V2_PREFIX + base64.b64encode(zlib.compress(_encode(data), level)).decode('ascii')
+
+
+def decompress(value):
+    if not is_compressed(value):
+        return value
+
+    if value.startswith(_ZLIB_V1_PREFIX):
+        return zlib.decompress(base64.b64decode(value[len(_ZLIB_V1_PREFIX):])).decode('utf-8')
+
+    if value.startswith(_ZLIB_V2_PREFIX):
+        return decompress_blocks(value)
+
+    raise UnsupportedFormatError("Unsupported query result storage format: {!r}".format(value[:32]))
+
+
+def decompress_blocks(value, start=None, end=None):
+    """Return the decompressed data of the blocks of a zlib2 value between the given positions (block start positions,
+    as returned by `Compressor.start_block`), from its first block and up to its end by default.
+    """
+    if start is None:
+        start = len(_ZLIB_V2_PREFIX)
+
+    blocks = value[start:end].split(_BLOCKS_SEPARATOR)
+    return ''.join(zlib.decompress(base64.b64decode(block)) for block in blocks if block).decode('utf-8')
+
+
+def iter_decompressed(value, chunk_size=64 * 1024):
+    """Yield the decompressed data of the value (compressed or not) in chunks of bytes, decompressing it as a stream,
+    so it isn't all held in memory at once.
+    """
+    if not is_compressed(value):
+        for i in xrange(0, len(value), chunk_size):
+            yield _encode(value[i:i + chunk_size])
+        return
+
+    if value.startswith(_ZLIB_V1_PREFIX):
+        streams = [(len(_ZLIB_V1_PREFIX), len(value))]
+    elif value.startswith(_ZLIB_V2_PREFIX):
+        streams = _iter_blocks(value)
+    else:
+        raise UnsupportedFormatError("Unsupported query result storage format: {!r}".format(value[:32]))
+
+    # Base64 is decoded in slices of whole 4 characters groups:
+    chunk_size -= chunk_size % 4
+    for start, end in streams:
+        decompressor = zlib.decompressobj()
+        for i in xrange(start, end, chunk_size):
+            yield decompressor.decompress(base64.b64decode(value[i:min(i + chunk_size, end)]))
+        yield decompressor.flush()
+
+
+def _iter_blocks(value):
+    """Yield the (start, end) positions of the blocks of a zlib2 value."""
+    start = len(_ZLIB_V2_PREFIX)
+    while start <= len(value):
+        end = value.find(_BLOCKS_SEPARATOR, start)
+        if end == -1:
+            end = len(value)
+
+        yield start, end
+        start = end + len(_BLOCKS_SEPARATOR)
+
+
+def gzip_compress(data, level=6):
+    """Return the data compressed in the gzip format (as HTTP's gzip content encoding expects)."""
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(_encode(data))
+
+    return buf.getvalue()
+
+
+class Compressor(object):
+    """Compresses data written to it in chunks, to the same format `compress` returns. The data is compressed in blocks
+    (see `start_block`), each of which can be decompressed on its own.
+    """
+
+    def __init__(self, level=6):
+        self._level = level
+        self._compressor = zlib.compressobj(level)
+        self._chunks = []
+        self._blocks = []
+        self._position = len(_ZLIB_V2_PREFIX)
+
+    def write(self, data):
+        self._chunks.append(self._compressor.compress(_encode(data)))
+
+    def start_block(self):
+        """End the current block and start a new one. Return the position in the compressed value where the new block
+        starts (to be used with `decompress_blocks`).
+        """
+        self._end_block()
+        self._compressor = zlib.compressobj(self._level)
+        self._chunks = []
+
+        return self._position
+
+    def _end_block(self):
+        self._chunks.append(self._compressor.flush())
+        block = base64.b64encode(''.join(self._chunks)).decode('ascii')
+        self._blocks.append(block)
+        self._position += len(block) + len(_BLOCKS_SEPARATOR)
+
+    def finish(self):
+        """Return the compressed value. No more data can be written afterwards."""
+        self._end_block()
+        return _ZLIB_V2_PREFIX + _BLOCKS_SEPARATOR.join(self._blocks)
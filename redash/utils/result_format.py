@@ -0,0 +1,245 @@
+"""
+Query result data formats.
+
+V1: {"columns": [...], "rows": [{"column name": value, ...}, ...]}
+V2: {"format": 2, "columns": [...], "rows": [[value, ...], ...]}
+
+In V2 rows are arrays of values, positioned by the `columns` list, so column names aren't repeated in every row. V2
+results are serialized with the format key first, which allows telling the format of serialized results without
+parsing them.
+
+Results serialized by QueryResultWriter come with a rows index: a list of [row number, position] pairs, of the
+position in the serialized result where every (about) ROWS_BATCH_SIZE rows start, ending with the number of rows and
+the position where the rows array ends. It's used to read a range of rows without parsing the whole result.
+
+Results it compresses are compressed in blocks (see `redash.utils.compression`) that start at the positions of the
+index, and every entry of their index has a third value: the position in the compressed result where its block
+starts. The header (up to the rows), each range of rows between index entries and the trailer (after the rows) can
+then be decompressed on their own.
+"""
+import bisect
+import itertools
+import json
+
+from redash.utils import compression, json_dumps
+
+V1 = 1
+V2 = 2
+
+FORMATS = (V1, V2)
+
+_V2_PREFIX = '{"format": 2'
+
+
+class UnknownColumnsError(Exception):
+    pass
+
+
+def get_format(data):
+    return data.get('format', V1)
+
+
+def get_serialized_format(serialized):
+    return V2 if serialized.startswith(_V2_PREFIX) else V1
+
+
+def serialize_header(metadata, result_format):
+    """Return the beginning of the serialized result (everything up to the first row) for the given metadata."""
+    header = '{'
+    if result_format == V2:
+        header += '"format": 2, '
+
+    metadata = json_dumps(metadata)[1:-1]
+    if metadata:
+        header += metadata + ', '
+
+    return header + '"rows": ['
+
+
+def column_names(data):
+    return [column['name'] for column in data['columns']]
+
+
+def rows_to_dicts(names, rows):
+    return [dict(zip(names, row)) for row in rows]
+
+
+def rows_to_arrays(names, rows):
+    return [[row.get(name) for name in names] for row in rows]
+
+
+def row_as_dict(data, index):
+    row = data['rows'][index]
+    if get_format(data) == V2:
+        row = dict(zip(column_names(data), row))
+
+    return row
+
+
+def iter_row_values(data):
+    """Yield the rows of the result (of any format) as lists of values, ordered as its columns."""
+    if get_format(data) == V2:
+        return iter(data['rows'])
+
+    names = column_names(data)
+    return ([row.get(name) for name in names] for row in data['rows'])
+
+
+def convert(data, result_format):
+    """Return the result (of any format) in the given format."""
+    if get_format(data) == result_format:
+        return data
+
+    data = dict(data)
+    names = column_names(data)
+
+    if result_format == V2:
+        data['format'] = V2
+        data['rows'] = rows_to_arrays(names, data['rows'])
+    else:
+        data.pop('format')
+        data['rows'] = rows_to_dicts(names, data['rows'])
+
+    return data
+
+
+def read_rows(serialized, index, offset=0, limit=None):
+    """Return the result with only the rows in the given range, parsing (and decompressing, for results compressed in
+    blocks) only the part of the serialized result that has them (located using the rows index).
+    """
+    row_numbers = [entry[0] for entry in index]
+    total_rows = row_numbers[-1]
+    end = total_rows if limit is None else min(offset + limit, total_rows)
+    offset = min(offset, end)
+
+    first = max(bisect.bisect_right(row_numbers, offset) - 1, 0)
+    last = bisect.bisect_left(row_numbers, end)
+    start_row = index[first][0]
+
+    serialized = _decompress_unindexed(serialized, index)
+    data = read_metadata(serialized, index)
+    data['rows'] = _parse_rows(_read_part(serialized, index, first, last))[offset - start_row:end - start_row]
+
+    return data
+
+
+def read_metadata(serialized, index):
+    """Return the result without its rows (an empty rows list), using the rows index to skip parsing them."""
+    serialized = _decompress_unindexed(serialized, index)
+    return _parse_metadata(_read_part(serialized, index, None, 0), _read_part(serialized, index, len(index) - 1, None))
+
+
+def _parse_metadata(header, trailer):
+    # The header (up to the rows) and the trailer (after them) are the metadata of the result:
+    data = json.loads(header + ']}')
+    data.update(json.loads('{"rows": [' + trailer))
+
+    return data
+
+
+def _is_block_indexed(serialized, index):
+    """Whether the serialized result is compressed in blocks its index points at."""
+    return compression.is_block_compressed(serialized) and len(index[0]) > 2
+
+
+def _decompress_unindexed(serialized, index):
+    """Return the serialized result decompressed, unless it's compressed in blocks its index points at."""
+    if _is_block_indexed(serialized, index):
+        return serialized
+
+    return compression.decompress(serialized)
+
+
+def _read_part(serialized, index, first, last):
+    """Return the part of the serialized result between the positions of the given index entries (from its beginning
+    when `first` is None, and up to its end when `last` is None).
+    """
+    if compression.is_block_compressed(serialized):
+        return compression.decompress_blocks(serialized, None if first is None else index[first][2],
+                                             None if last is None else index[last][2])
+
+    return serialized[None if first is None else index[first][1]:None if last is None else index[last][1]]
+
+
+def _parse_rows(serialized):
+    # Blocks of rows start with the separator from the previous rows, and ranges of rows end with the separator from
+    # the next ones:
+    return json.loads('[' + serialized.strip(', ') + ']')
+
+
+def _iter_parts(serialized, index):
+    """Yield the header of the serialized result, its rows between every two index entries and its trailer,
+    decompressing it as a stream, so only one part of it is held in memory at a time.
+    """
+    chunks = compression.iter_decompressed(serialized)
+    part, part_size, part_start = [], 0, 0
+
+    for entry in index:
+        position = entry[1]
+        while part_start + part_size < position:
+            chunk = next(chunks)
+            part.append(chunk)
+            part_size += len(chunk)
+
+        part = ''.join(part)
+        yield part[:position - part_start]
+
+        part = [part[position - part_start:]]
+        part_size = len(part[0])
+        part_start = position
+
+    yield ''.join(part) + ''.join(chunks)
+
+
+def iter_rows(serialized, index=None):
+    """Return the result metadata (without rows) and an iterator of its rows as lists of values, ordered as its
+    columns. With a rows index, the rows are decompressed and parsed a batch at a time, as the iterator is consumed.
+
+    Results without a rows index (stored before results had one) are decompressed and parsed whole, so the memory it
+    takes isn't bounded.
+    """
+    if not index:
+        data = json.loads(compression.decompress(serialized))
+        batches = [data['rows']]
+        data['rows'] = []
+    elif compression.is_compressed(serialized) and not _is_block_indexed(serialized, index):
+        # Compressed as a single stream: it's decompressed once to get to the trailer, and again as the rows are read.
+        parts = _iter_parts(serialized, index)
+        header = next(parts)
+        for trailer in parts:
+            pass
+
+        data = _parse_metadata(header, trailer)
+        batches = (_parse_rows(part) for part in itertools.islice(_iter_parts(serialized, index), 1, len(index)))
+    else:
+        data = read_metadata(serialized, index)
+        batches = (_parse_rows(_read_part(serialized, index, i, i + 1)) for i in range(len(index) - 1))
+
+    names = column_names(data)
+    is_v2 = get_format(data) == V2
+
+    def rows():
+        for batch in batches:
+            for row in batch:
+                yield row if is_v2 else [row.get(name) for name in names]
+
+    return data, rows()
+
+
+def project_columns(data, names):
+    """Return the result (of any format) with only the given columns."""
+    columns = {column['name']: column for column in data['columns']}
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise UnknownColumnsError(u"Unknown columns: {}".format(u", ".join(unknown)))
+
+    data = dict(data)
+    if get_format(data) == V2:
+        positions = [column_names(data).index(name) for name in names]
+        data['rows'] = [[row[position] for position in positions] for row in data['rows']]
+    else:
+        data['rows'] = [{name: row.get(name) for name in names} for row in data['rows']]
+
+    data['columns'] = [columns[name] for name in names]
+
+    return data
@@ -17,9 +17,10 @@ celery_schedule = {
         'task': 'redash.tasks.refresh_queries',
         'schedule': timedelta(seconds=30)
     },
+    # Trackers are updated by task signals, this only catches the ones they missed:
     'cleanup_tasks': {
         'task': 'redash.tasks.cleanup_tasks',
-        'schedule': timedelta(minutes=5)
+        'schedule': timedelta(hours=1)
     },
     'refresh_schemas': {
         'task': 'redash.tasks.refresh_schemas',
@@ -35,6 +36,12 @@ if settings.VERSION_CHECK:
         'schedule': crontab(minute=randint(0, 59), hour=randint(0, 23))
     }
 
+if settings.QUERY_SCHEDULER_ENABLED:
+    celery_schedule['dispatch_queries'] = {
+        'task': 'redash.tasks.dispatch_queries',
+        'schedule': timedelta(minutes=1)
+    }
+
 if settings.QUERY_RESULTS_CLEANUP_ENABLED:
     celery_schedule['cleanup_query_results'] = {
         'task': 'redash.tasks.cleanup_query_results',
@@ -2,6 +2,7 @@ import os
 os.environ['REDASH_REDIS_URL'] = "redis://localhost:6379/5"
 # Use different url for Celery to avoid DB being cleaned up:
 os.environ['REDASH_CELERY_BROKER'] = "redis://localhost:6379/6"
+os.environ['REDASH_QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE'] = str(16 * 1024 * 1024)
 
 # Dummy values for oauth login
 os.environ['REDASH_GOOGLE_CLIENT_ID'] = "dummy"
@@ -38,7 +39,7 @@ class BaseTestCase(TestCase):
         redash.models.create_db(False, True)
         redis_connection.flushdb()
 
-    def make_request(self, method, path, org=None, user=None, data=None, is_json=True):
+    def make_request(self, method, path, org=None, user=None, data=None, is_json=True, headers=None):
         if user is None:
             user = self.factory.user
 
@@ -48,7 +49,7 @@ class BaseTestCase(TestCase):
         if org is not False:
             path = "/{}{}".format(org.slug, path)
 
-        return make_request(method, path, user, data, is_json)
+        return make_request(method, path, user, data, is_json, headers)
 
     def assertResponseEqual(self, expected, actual):
         for k, v in expected.iteritems():
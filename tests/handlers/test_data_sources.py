@@ -72,6 +72,28 @@ class TestDataSourceAPIPost(BaseTestCase):
         self.assertEqual(data_source.name, new_name)
         self.assertEqual(data_source.options.to_dict(), new_options)
 
+    def test_updates_result_limits(self):
+        admin = self.factory.create_admin()
+        new_options = {"dbname": "newdb", "max_result_rows": 1000, "max_result_bytes": 1048576}
+        rv = self.make_request('post', self.path,
+                               data={'name': 'DS 1', 'type': 'pg', 'options': new_options},
+                               user=admin)
+
+        self.assertEqual(rv.status_code, 200)
+        data_source = DataSource.get_by_id(self.factory.data_source.id)
+        self.assertEqual(1000, data_source.query_runner.max_result_rows)
+        self.assertEqual(1048576, data_source.query_runner.max_result_bytes)
+
+    def test_replaces_cached_query_runner(self):
+        query_runner = self.factory.data_source.query_runner
+        admin = self.factory.create_admin()
+        rv = self.make_request('post', self.path,
+                               data={'name': 'DS 1', 'type': 'pg', 'options': {"dbname": "test"}},
+                               user=admin)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIsNot(query_runner, DataSource.get_by_id(self.factory.data_source.id).query_runner)
+
 
 class TestDataSourceListAPIPost(BaseTestCase):
     def test_returns_400_when_missing_fields(self):
@@ -1,5 +1,14 @@
+import gzip
 import json
+import shutil
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+from mock import patch
 from tests import BaseTestCase
+from redash import export_cache, models, results_storage, settings
+from redash.query_runner import QueryResultWriter
 
 
 class TestQueryResultsCacheHeaders(BaseTestCase):
@@ -15,7 +24,65 @@ class TestQueryResultsCacheHeaders(BaseTestCase):
         query = self.factory.create_query(latest_query_data=query_result)
 
         rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id))
-        self.assertNotIn('Cache-Control', rv.headers)
+        self.assertNotIn('max-age', rv.headers.get('Cache-Control', ''))
+
+
+class TestQueryResultsConditionalRequests(BaseTestCase):
+    def test_returns_304_for_matching_etag(self):
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+
+        for path in ['/api/queries/{}/results.json', '/api/queries/{}/results.csv']:
+            rv = self.make_request('get', path.format(query.id), is_json=False)
+            self.assertEquals(rv.status_code, 200)
+            self.assertIn('Last-Modified', rv.headers)
+
+            with patch.object(models.QueryResult, 'load_deferred_data') as load_deferred_data:
+                rv = self.make_request('get', path.format(query.id), is_json=False,
+                                       headers={'If-None-Match': rv.headers['ETag']})
+            self.assertEquals(rv.status_code, 304)
+            self.assertEquals('', rv.data)
+            self.assertFalse(load_deferred_data.called)
+
+    def test_returns_304_if_not_modified_since(self):
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+
+        rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id))
+        rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id),
+                               headers={'If-Modified-Since': rv.headers['Last-Modified']})
+        self.assertEquals(rv.status_code, 304)
+
+    def test_sends_cache_headers_with_304(self):
+        query_result = self.factory.create_query_result()
+        path = '/api/query_results/{}'.format(query_result.id)
+
+        rv = self.make_request('get', path, headers={'Accept-Encoding': 'gzip'}, is_json=False)
+        rv = self.make_request('get', path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']},
+                               is_json=False)
+
+        self.assertEquals(rv.status_code, 304)
+        self.assertEquals('Accept-Encoding', rv.headers['Vary'])
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+
+    def test_etag_changes_with_latest_result(self):
+        query = self.factory.create_query(latest_query_data=self.factory.create_query_result())
+        rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id))
+        etag = rv.headers['ETag']
+
+        query.latest_query_data = self.factory.create_query_result()
+        query.save()
+
+        rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id), headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 200)
+        self.assertNotEquals(etag, rv.headers['ETag'])
+
+    def test_etag_depends_on_representation(self):
+        query_result = self.factory.create_query_result()
+
+        rv1 = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        rv2 = self.make_request('get', '/api/query_results/{}?result_format=2'.format(query_result.id))
+        self.assertNotEquals(rv1.headers['ETag'], rv2.headers['ETag'])
 
     def test_returns_404_if_no_cached_result_found(self):
         query = self.factory.create_query(latest_query_data=None)
@@ -115,6 +182,264 @@ class TestQueryResultAPI(BaseTestCase):
         rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
         self.assertEquals(rv.status_code, 200)
 
+    def test_returns_stored_data(self):
+        data = '{"rows": [{"test": 1}], "columns": [{"name": "test"}]}'
+        query_result = self.factory.create_query_result(data=data)
+
+        rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(rv.json['query_result']['id'], query_result.id)
+        self.assertEquals(rv.json['query_result']['data'], json.loads(data))
+        self.assertIn(data, rv.data)
+
+    def test_returns_data_in_requested_format(self):
+        query_result = self.factory.create_query_result(data=json.dumps({'columns': [{'name': 'test'}],
+                                                                          'rows': [{'test': 1}]}))
+
+        rv = self.make_request('get', '/api/query_results/{}?result_format=2'.format(query_result.id))
+        self.assertEquals(rv.json['query_result']['data'], {'format': 2, 'columns': [{'name': 'test'}], 'rows': [[1]]})
+
+        rv = self.make_request('get', '/api/query_results/{}?result_format=3'.format(query_result.id))
+        self.assertEquals(rv.status_code, 400)
+
+    def test_returns_v2_data_as_v1_by_default(self):
+        query_result = self.factory.create_query_result(data='{"format": 2, "columns": [{"name": "test"}], "rows": [[1]]}')
+
+        rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        self.assertEquals(rv.json['query_result']['data'], {'columns': [{'name': 'test'}], 'rows': [{'test': 1}]})
+
+
+class TestQueryResultBatchAPI(BaseTestCase):
+    def test_returns_results_by_id_and_by_query_id(self):
+        query_result = self.factory.create_query_result()
+        latest_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=latest_result)
+
+        rv = self.make_request('post', '/api/query_results/batch',
+                               data={'query_result_ids': [query_result.id], 'query_ids': [query.id]})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals([], rv.json['errors'])
+        self.assertEquals({str(query.id): latest_result.id}, rv.json['query_ids'])
+        results = {r['id']: r for r in rv.json['query_results']}
+        self.assertItemsEqual([query_result.id, latest_result.id], results.keys())
+        self.assertEquals(json.loads(query_result.data), results[query_result.id]['data'])
+
+    def test_returns_errors_for_missing_and_forbidden_results(self):
+        ds = self.factory.create_data_source(group=self.factory.create_group())
+        forbidden_result = self.factory.create_query_result(data_source=ds)
+        query = self.factory.create_query(latest_query_data=None)
+
+        rv = self.make_request('post', '/api/query_results/batch',
+                               data={'query_result_ids': [forbidden_result.id, 999999], 'query_ids': [query.id]})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals([], rv.json['query_results'])
+        self.assertItemsEqual([(None, query.id, 404), (999999, None, 404), (forbidden_result.id, None, 403)],
+                              [(e.get('query_result_id'), e.get('query_id'), e['status']) for e in rv.json['errors']])
+
+    def test_returns_400_for_too_many_results(self):
+        with patch('redash.handlers.query_results.BATCH_MAX_SIZE', 1):
+            rv = self.make_request('post', '/api/query_results/batch', data={'query_result_ids': [1, 2]})
+
+        self.assertEquals(rv.status_code, 400)
+
+    def test_returns_400_for_invalid_ids(self):
+        for data in [{'query_result_ids': ['a']}, {'query_ids': [None]}, {'query_ids': 1}, [1]]:
+            rv = self.make_request('post', '/api/query_results/batch', data=data)
+            self.assertEquals(rv.status_code, 400)
+
+    def test_defers_results_beyond_max_data_size(self):
+        query_result = self.factory.create_query_result(data_size=10)
+        big_result = self.factory.create_query_result(data_size=20)
+
+        with patch('redash.handlers.query_results.BATCH_MAX_DATA_SIZE', 25):
+            rv = self.make_request('post', '/api/query_results/batch',
+                                   data={'query_result_ids': [query_result.id, big_result.id]})
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(1, len(rv.json['query_results']))
+        deferred_id = ({query_result.id, big_result.id} - {rv.json['query_results'][0]['id']}).pop()
+        self.assertEquals([(deferred_id, 413)], [(e['query_result_id'], e['status']) for e in rv.json['errors']])
+
+
+class TestQueryResultGzipResponse(BaseTestCase):
+    def test_returns_gzipped_json_when_accepted(self):
+        query_result = self.factory.create_query_result()
+        path = '/api/query_results/{}'.format(query_result.id)
+
+        rv = self.make_request('get', path, headers={'Accept-Encoding': 'gzip, deflate'}, is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals('gzip', rv.headers['Content-Encoding'])
+        data = json.loads(gzip.GzipFile(fileobj=StringIO(rv.data)).read())
+        self.assertEquals(query_result.id, data['query_result']['id'])
+
+        # The compressed response is cached:
+        with patch.object(models.QueryResult, 'load_deferred_data') as load_deferred_data:
+            cached = self.make_request('get', path, headers={'Accept-Encoding': 'gzip'}, is_json=False)
+        self.assertFalse(load_deferred_data.called)
+        self.assertEquals(rv.data, cached.data)
+        self.assertEquals(rv.headers['ETag'], cached.headers['ETag'])
+
+    def test_stores_gzipped_json_of_big_results(self):
+        storage_path = tempfile.mkdtemp()
+
+        try:
+            with patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+                    patch('redash.settings.QUERY_RESULTS_STORAGE_MIN_SIZE', 10), \
+                    patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', storage_path), \
+                    patch.dict(results_storage._instances, clear=True):
+                query_result = self.factory.create_query_result(data_size=100)
+                path = '/api/query_results/{}'.format(query_result.id)
+
+                rv = self.make_request('get', path, headers={'Accept-Encoding': 'gzip'}, is_json=False)
+                self.assertEquals(rv.data, results_storage.load_gzipped_json(query_result.org_id, query_result.id, 1))
+
+                # Served from the results storage once it's evicted from the export cache:
+                export_cache.invalidate([query_result.id])
+                with patch.object(models.QueryResult, 'load_deferred_data') as load_deferred_data:
+                    stored = self.make_request('get', path, headers={'Accept-Encoding': 'gzip'}, is_json=False)
+                self.assertFalse(load_deferred_data.called)
+                self.assertEquals(rv.data, stored.data)
+        finally:
+            shutil.rmtree(storage_path)
+
+    def test_returns_plain_json_when_gzip_not_accepted(self):
+        query_result = self.factory.create_query_result()
+        path = '/api/query_results/{}'.format(query_result.id)
+
+        rv = self.make_request('get', path)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEquals(query_result.id, rv.json['query_result']['id'])
+
+        gzipped = self.make_request('get', path, headers={'Accept-Encoding': 'gzip'}, is_json=False)
+        self.assertNotEquals(rv.headers['ETag'], gzipped.headers['ETag'])
+
+        rv = self.make_request('get', path, headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+
+class TestQueryResultSlicing(BaseTestCase):
+    def create_query_result(self):
+        writer = QueryResultWriter({'columns': [{'name': 'a'}, {'name': 'b'}]}, compress=False)
+        writer.write_rows([(i, i * 2) for i in range(10)])
+        data = writer.finish()
+        return self.factory.create_query_result(data=data, data_index=writer.index)
+
+    def test_returns_rows_range(self):
+        for query_result in [self.create_query_result(),
+                             self.factory.create_query_result(data=json.dumps({
+                                 'columns': [{'name': 'a'}, {'name': 'b'}],
+                                 'rows': [{'a': i, 'b': i * 2} for i in range(10)]}))]:
+            rv = self.make_request('get', '/api/query_results/{}?offset=2&limit=3'.format(query_result.id))
+
+            self.assertEquals(rv.status_code, 200)
+            data = rv.json['query_result']['data']
+            self.assertEquals([{'a': 2, 'b': 4}, {'a': 3, 'b': 6}, {'a': 4, 'b': 8}], data['rows'])
+            self.assertEquals(10, data['total_rows'])
+
+    def test_returns_selected_columns(self):
+        query_result = self.create_query_result()
+
+        rv = self.make_request('get', '/api/query_results/{}?limit=2&columns=b&result_format=2'.format(query_result.id))
+        self.assertEquals({'format': 2, 'columns': [{'name': 'b'}], 'rows': [[0], [2]], 'total_rows': 10},
+                          rv.json['query_result']['data'])
+
+    def test_returns_400_for_unknown_columns(self):
+        query_result = self.create_query_result()
+
+        rv = self.make_request('get', '/api/query_results/{}?columns=c'.format(query_result.id))
+        self.assertEquals(rv.status_code, 400)
+
+
+class TestQueryResultAggregateResource(BaseTestCase):
+    def test_returns_aggregated_data(self):
+        query_result = self.factory.create_query_result(data=json.dumps({
+            'columns': [{'name': 'a'}, {'name': 'b'}],
+            'rows': [{'a': i % 2, 'b': i} for i in range(10)]}))
+        spec = {'group_by': ['a'], 'aggregations': [{'function': 'sum', 'column': 'b'}], 'order_by': [{'column': 'a'}]}
+
+        for path in ['/api/query_results/{}/aggregate', '/api/query_results/{}/aggregate?result_format=2']:
+            rv = self.make_request('post', path.format(query_result.id), data=spec)
+            self.assertEquals(rv.status_code, 200)
+
+        self.assertEquals([[0, 20], [1, 25]], rv.json['query_result']['data']['rows'])
+
+        rv = self.make_request('post', '/api/query_results/{}/aggregate'.format(query_result.id), data=spec)
+        self.assertEquals([{'a': 0, 'sum_b': 20}, {'a': 1, 'sum_b': 25}], rv.json['query_result']['data']['rows'])
+
+    def test_returns_400_for_invalid_spec(self):
+        query_result = self.factory.create_query_result()
+
+        rv = self.make_request('post', '/api/query_results/{}/aggregate'.format(query_result.id),
+                               data={'aggregations': [{'function': 'median', 'column': 'a'}]})
+        self.assertEquals(rv.status_code, 400)
+
+
+class TestQueryResultCSVResponse(BaseTestCase):
+    def test_renders_v1_and_v2_results(self):
+        query = self.factory.create_query()
+        for data in ['{"columns": [{"name": "a"}, {"name": "b"}], "rows": [{"a": 1, "b": "x"}, {"a": 2}]}',
+                     '{"format": 2, "columns": [{"name": "a"}, {"name": "b"}], "rows": [[1, "x"], [2, null]]}']:
+            query_result = self.factory.create_query_result(data=data)
+
+            rv = self.make_request('get', '/api/queries/{}/results/{}.csv'.format(query.id, query_result.id),
+                                   is_json=False)
+            self.assertEquals(rv.status_code, 200)
+            self.assertEquals(rv.data, 'a,b\r\n1,x\r\n2,\r\n')
+
+    def test_streams_indexed_results(self):
+        query = self.factory.create_query()
+        writer = QueryResultWriter({'columns': [{'name': 'a'}, {'name': 'b'}]}, compress=False)
+        writer.write_rows([(i, u'\u05d0') for i in range(2500)])
+        query_result = self.factory.create_query_result(data=writer.finish(), data_index=writer.index)
+
+        rv = self.make_request('get', '/api/queries/{}/results/{}.csv'.format(query.id, query_result.id),
+                               is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        lines = rv.data.splitlines()
+        self.assertEquals(2501, len(lines))
+        self.assertEquals(u'2499,\u05d0'.encode('utf-8'), lines[-1])
+
+
+class TestQueryResultExportCache(BaseTestCase):
+    def test_serves_cached_exports(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result()
+
+        for filetype in ['csv', 'xlsx']:
+            path = '/api/queries/{}/results/{}.{}'.format(query.id, query_result.id, filetype)
+            rv = self.make_request('get', path, is_json=False)
+
+            with patch.object(models.QueryResult, 'iter_rows') as iter_rows:
+                cached = self.make_request('get', path, is_json=False)
+
+            self.assertFalse(iter_rows.called)
+            self.assertEquals(rv.data, cached.data)
+            self.assertEquals(rv.headers['Content-Type'], cached.headers['Content-Type'])
+
+
+class TestQueryResultNDJSONResponse(BaseTestCase):
+    def test_renders_a_line_per_row(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result(data=json.dumps({
+            'format': 2, 'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [[1, 'x'], [2, None]]}))
+
+        rv = self.make_request('get', '/api/queries/{}/results/{}.ndjson'.format(query.id, query_result.id),
+                               is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals([{'a': 1, 'b': 'x'}, {'a': 2, 'b': None}], [json.loads(line) for line in rv.data.splitlines()])
+
+
+class TestQueryResultArrowResponse(BaseTestCase):
+    def test_renders_arrow_stream(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result()
+
+        rv = self.make_request('get', '/api/queries/{}/results/{}.arrow'.format(query.id, query_result.id),
+                               is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals('application/vnd.apache.arrow.stream', rv.headers['Content-Type'])
+        self.assertEquals('\xff\xff\xff\xff\x00\x00\x00\x00', rv.data[-8:])
+
 
 class TestQueryResultExcelResponse(BaseTestCase):
     def test_renders_excel_file(self):
@@ -124,6 +449,55 @@ class TestQueryResultExcelResponse(BaseTestCase):
         rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id), is_json=False)
         self.assertEquals(rv.status_code, 200)
 
+    def test_spills_rows_to_additional_sheets(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result(data=json.dumps({
+            'format': 2, 'columns': [{'name': 'a'}], 'rows': [[i] for i in range(5)]}))
+
+        with patch('redash.handlers.query_results.EXCEL_MAX_ROWS_PER_SHEET', 3):
+            rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id),
+                                   is_json=False)
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(len(rv.data), int(rv.headers['Content-Length']))
+        sheets = [name for name in zipfile.ZipFile(StringIO(rv.data)).namelist() if name.startswith('xl/worksheets/')]
+        self.assertEquals(3, len(sheets))
+
+    def test_returns_400_above_max_rows(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result(data=json.dumps({
+            'format': 2, 'columns': [{'name': 'a'}], 'rows': [[i] for i in range(5)]}))
+
+        with patch.object(settings, 'QUERY_RESULTS_EXCEL_MAX_ROWS', 4):
+            rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id),
+                                   is_json=False)
+
+        self.assertEquals(rv.status_code, 400)
+
+    def test_returns_400_above_max_rows_without_loading_indexed_results(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result(data_index=[[0, 10], [5, 40]])
+
+        with patch.object(settings, 'QUERY_RESULTS_EXCEL_MAX_ROWS', 4), \
+                patch.object(models.QueryResult, 'iter_rows') as iter_rows:
+            rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id),
+                                   is_json=False)
+
+        self.assertEquals(rv.status_code, 400)
+        self.assertFalse(iter_rows.called)
+
+    def test_returns_400_above_max_size_without_loading_result(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result(data_size=1000)
+
+        with patch.object(settings, 'QUERY_RESULTS_EXCEL_MAX_SIZE', 100), \
+                patch.object(models.QueryResult, 'iter_rows') as iter_rows:
+            rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id),
+                                   is_json=False)
+
+        self.assertEquals(rv.status_code, 400)
+        self.assertFalse(iter_rows.called)
+
     def test_renders_excel_file_when_rows_have_missing_columns(self):
         query = self.factory.create_query()
         query_result = self.factory.create_query_result(data=json.dumps({'rows': [{'test': 1}, {'test': 2, 'test2': 3}], 'columns': [{'name': 'test'}, {'name': 'test2'}]}))
@@ -1,3 +1,4 @@
+import json
 from tests import BaseTestCase
 from redash.models import Alert
 
@@ -35,3 +36,18 @@ class TestAlertAll(BaseTestCase):
         alerts = Alert.all(groups=[self.factory.default_group, group])
         self.assertEqual(1, len(list(alerts)))
         self.assertIn(alert, alerts)
+
+
+class TestAlertEvaluate(BaseTestCase):
+    def create_alert(self, data):
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+        query = self.factory.create_query(latest_query_data=query_result)
+        return self.factory.create_alert(query=query, options={'column': 'value', 'op': 'greater than', 'value': 1})
+
+    def test_evaluates_v1_results(self):
+        alert = self.create_alert({'columns': [{'name': 'value'}], 'rows': [{'value': 2}]})
+        self.assertEqual(Alert.TRIGGERED_STATE, alert.evaluate())
+
+    def test_evaluates_v2_results(self):
+        alert = self.create_alert({'format': 2, 'columns': [{'name': 'other'}, {'name': 'value'}], 'rows': [[5, 0]]})
+        self.assertEqual(Alert.OK_STATE, alert.evaluate())
@@ -1,3 +1,4 @@
+from mock import patch
 from tests import BaseTestCase
 from redash.models import DataSource
 from redash.utils.configuration import ConfigurationContainer
@@ -9,6 +10,29 @@ class TestDataSourceCreate(BaseTestCase):
         self.assertIn(self.factory.org.default_group.id, data_source.groups)
 
 
+class TestDataSourceQueryRunner(BaseTestCase):
+    def test_reuses_query_runner(self):
+        data_source = self.factory.data_source
+        self.assertIs(data_source.query_runner, DataSource.get_by_id(data_source.id).query_runner)
+
+    def test_creates_new_query_runner_when_options_change(self):
+        data_source = self.factory.data_source
+        query_runner = data_source.query_runner
+        data_source.options = ConfigurationContainer.from_json('{"dbname": "other"}')
+
+        self.assertIsNot(query_runner, data_source.query_runner)
+        self.assertEqual('other', data_source.query_runner.configuration['dbname'])
+
+    def test_keeps_only_the_latest_query_runners(self):
+        data_source = self.factory.data_source
+        query_runner = data_source.query_runner
+        other_data_source = self.factory.create_data_source()
+
+        with patch('redash.query_runner.DATA_SOURCE_QUERY_RUNNERS_CACHE_SIZE', 1):
+            other_data_source.query_runner
+            self.assertIsNot(query_runner, DataSource.get_by_id(data_source.id).query_runner)
+
+
 class TestDataSourceIsPaused(BaseTestCase):
     def test_returns_false_by_default(self):
         self.assertFalse(self.factory.data_source.paused)
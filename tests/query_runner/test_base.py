@@ -0,0 +1,232 @@
+import hashlib
+import json
+import zlib
+from unittest import TestCase
+
+from mock import patch
+from redash import settings
+from redash.query_runner import BaseQueryRunner, QueryError, QueryResultWriter
+from redash.utils import compression, result_format
+
+
+class RowsQueryRunner(BaseQueryRunner):
+    def run_query(self, query, user):
+        return json.dumps({'columns': [{'name': 'a'}], 'rows': [{'a': 1}, {'a': 2}], 'log': ['done']}), None
+
+
+class StreamingQueryRunner(BaseQueryRunner):
+    def run_query_iter(self, query, user):
+        if query == 'fail':
+            raise QueryError('Query failed.')
+
+        yield {'columns': [{'name': 'a'}]}
+        yield [(1,), (2,)]
+        yield [(3,)]
+
+
+class TestRunQueryIter(TestCase):
+    def test_adapts_run_query(self):
+        results = list(RowsQueryRunner({}).run_query_iter('SELECT 1', None))
+
+        self.assertFalse(RowsQueryRunner.supports_streaming())
+        self.assertEqual([{'columns': [{'name': 'a'}], 'log': ['done']}, [[1], [2]]], results)
+
+    def test_yields_rows_in_batches(self):
+        with patch('redash.query_runner.ROWS_BATCH_SIZE', 1):
+            results = list(RowsQueryRunner({}).run_query_iter('SELECT 1', None))
+
+        self.assertEqual([[[1]], [[2]]], results[1:])
+
+    def test_raises_query_error(self):
+        class FailingQueryRunner(BaseQueryRunner):
+            def run_query(self, query, user):
+                return None, 'Error.'
+
+        with self.assertRaises(QueryError):
+            list(FailingQueryRunner({}).run_query_iter('SELECT 1', None))
+
+
+class TestRunQueryFromIter(TestCase):
+    def test_returns_all_rows(self):
+        data, error = StreamingQueryRunner({}).run_query('SELECT 1', None)
+
+        self.assertTrue(StreamingQueryRunner.supports_streaming())
+        self.assertIsNone(error)
+        self.assertEqual({'columns': [{'name': 'a'}], 'rows': [{'a': 1}, {'a': 2}, {'a': 3}]}, json.loads(data))
+
+    def test_returns_error(self):
+        self.assertEqual((None, 'Query failed.'), StreamingQueryRunner({}).run_query('fail', None))
+
+
+class TestQueryResultWriter(TestCase):
+    def write(self, metadata, batches, **kwargs):
+        writer = QueryResultWriter(metadata, **kwargs)
+        for rows in batches:
+            writer.write_rows(rows)
+        return writer, writer.finish()
+
+    def test_serializes_result(self):
+        writer, data = self.write({'columns': [{'name': 'a'}]}, [[(1,)], [], [(2,)]], compress=False)
+
+        self.assertEqual({'format': 2, 'columns': [{'name': 'a'}], 'rows': [[1], [2]]}, json.loads(data))
+        self.assertEqual(result_format.V2, result_format.get_serialized_format(data))
+        self.assertEqual(2, writer.row_count)
+        self.assertEqual(len(data), writer.size)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), writer.checksum)
+
+    def test_serializes_v1_result(self):
+        writer, data = self.write({'columns': [{'name': 'a'}]}, [[(1,)], [(2,)]], compress=False,
+                                  output_format=result_format.V1)
+
+        self.assertEqual({'columns': [{'name': 'a'}], 'rows': [{'a': 1}, {'a': 2}]}, json.loads(data))
+        self.assertEqual(result_format.V1, result_format.get_serialized_format(data))
+
+    def test_serializes_empty_result(self):
+        writer, data = self.write({}, [], compress=False)
+        self.assertEqual({'format': 2, 'rows': []}, json.loads(data))
+
+    def test_compresses_result(self):
+        rows = [[i] for i in range(1000)]
+        with patch('redash.settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE', 1024):
+            writer, data = self.write({'columns': [{'name': 'a'}]}, [rows[:500], rows[500:]], compress=True)
+
+        self.assertTrue(compression.is_compressed(data))
+        self.assertEqual(rows, json.loads(compression.decompress(data))['rows'])
+        self.assertEqual(len(compression.decompress(data)), writer.size)
+
+    def test_doesnt_compress_small_results(self):
+        with patch('redash.settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE', 1024):
+            writer, data = self.write({'columns': [{'name': 'a'}]}, [[(1,)]], compress=True)
+
+        self.assertFalse(compression.is_compressed(data))
+
+    def test_truncates_rows_over_limit(self):
+        writer, data = self.write({}, [[(1,), (2,)], [(3,), (4,)]], compress=False, max_rows=3)
+
+        self.assertTrue(writer.truncated)
+        self.assertEqual({'format': 2, 'rows': [[1], [2], [3]], 'truncated': True}, json.loads(data))
+
+    def test_truncates_rows_over_size_limit(self):
+        writer, data = self.write({}, [[(1,), (2,)], [(3,), (4,)]], compress=False, max_bytes=40)
+
+        self.assertTrue(writer.truncated)
+        self.assertEqual({'format': 2, 'rows': [[1], [2], [3]], 'truncated': True}, json.loads(data))
+
+    def test_doesnt_mark_results_within_limits_truncated(self):
+        writer, data = self.write({}, [[(1,), (2,)]], compress=False, max_rows=2, max_bytes=1000)
+
+        self.assertFalse(writer.truncated)
+        self.assertNotIn('truncated', json.loads(data))
+
+
+class TestReadRows(TestCase):
+    def setUp(self):
+        self.rows = [(i, 'row {}'.format(i)) for i in range(10)]
+        with patch('redash.query_runner.ROWS_BATCH_SIZE', 3):
+            writer = QueryResultWriter({'columns': [{'name': 'i'}, {'name': 'name'}]}, compress=False, max_rows=8)
+            writer.write_rows(self.rows[:2])
+            writer.write_rows(self.rows[2:])
+            self.data = writer.finish()
+            self.index = writer.index
+
+    def test_builds_rows_index(self):
+        self.assertEqual([0, 5, 8], [row for row, position in self.index])
+        for row, position in self.index[1:-1]:
+            self.assertTrue(self.data[position:].startswith('[{}, '.format(row)))
+        self.assertTrue(self.data[self.index[-1][1]:].startswith(']'))
+
+    def test_reads_rows_range(self):
+        expected = [list(row) for row in self.rows[:8]]
+        for offset in range(10):
+            for limit in [None, 0, 1, 2, 3, 5, 10]:
+                data = result_format.read_rows(self.data, self.index, offset, limit)
+                end = None if limit is None else offset + limit
+                self.assertEqual(expected[offset:end], data['rows'])
+
+    def test_reads_metadata(self):
+        data = result_format.read_rows(self.data, self.index, 0, 0)
+
+        self.assertEqual({'format': 2, 'columns': [{'name': 'i'}, {'name': 'name'}], 'rows': [], 'truncated': True},
+                         data)
+
+    def test_iterates_rows_in_batches(self):
+        data, rows = result_format.iter_rows(self.data, self.index)
+
+        self.assertEqual([], data['rows'])
+        self.assertTrue(data['truncated'])
+        self.assertEqual([list(row) for row in self.rows[:8]], list(rows))
+
+    def test_iterates_rows_of_result_compressed_as_a_single_stream(self):
+        compressed = compression.compress(self.data)
+
+        with patch('redash.utils.compression.zlib.decompress') as decompress:
+            data, rows = result_format.iter_rows(compressed, self.index)
+            self.assertEqual([list(row) for row in self.rows[:8]], list(rows))
+
+        self.assertTrue(data['truncated'])
+        # Decompressed as a stream, and not whole:
+        self.assertFalse(decompress.called)
+
+    def write_block_compressed(self):
+        with patch('redash.query_runner.ROWS_BATCH_SIZE', 3), \
+                patch('redash.settings.QUERY_RESULTS_COMPRESSION_MIN_SIZE', 0):
+            writer = QueryResultWriter({'columns': [{'name': 'i'}, {'name': 'name'}]}, compress=True, max_rows=8)
+            writer.write_rows(self.rows[:2])
+            writer.write_rows(self.rows[2:])
+            return writer.finish(), writer.index
+
+    def test_reads_rows_range_of_block_compressed_result(self):
+        data, index = self.write_block_compressed()
+        self.assertTrue(compression.is_block_compressed(data))
+        self.assertEqual(self.index, [entry[:2] for entry in index])
+
+        expected = [list(row) for row in self.rows[:8]]
+        for offset in range(10):
+            for limit in [None, 0, 1, 2, 3, 5, 10]:
+                end = None if limit is None else offset + limit
+                self.assertEqual(expected[offset:end], result_format.read_rows(data, index, offset, limit)['rows'])
+
+        self.assertEqual(expected, list(result_format.iter_rows(data, index)[1]))
+
+    def test_decompresses_only_blocks_with_rows_range(self):
+        data, index = self.write_block_compressed()
+
+        with patch('redash.utils.compression.zlib.decompress', wraps=zlib.decompress) as decompress:
+            rows = result_format.read_rows(data, index, 5, 2)['rows']
+
+        self.assertEqual([[5, 'row 5'], [6, 'row 6']], rows)
+        # The header, the trailer and the block of rows 5-7 (but not the block of rows 0-4):
+        self.assertEqual(3, decompress.call_count)
+
+    def test_reads_empty_result(self):
+        writer = QueryResultWriter({'columns': []}, compress=False)
+        data = writer.finish()
+
+        self.assertEqual([], result_format.read_rows(data, writer.index, 0, 10)['rows'])
+
+
+class TestFullConfigurationSchema(TestCase):
+    def test_adds_result_limits(self):
+        class ConfiguredQueryRunner(BaseQueryRunner):
+            @classmethod
+            def configuration_schema(cls):
+                return {'type': 'object', 'properties': {'host': {'type': 'string'}}, 'required': ['host']}
+
+        schema = ConfiguredQueryRunner.full_configuration_schema()
+
+        self.assertEqual(['host', 'max_concurrent_queries', 'max_result_bytes', 'max_result_rows', 'query_timeout'],
+                         sorted(schema['properties'].keys()))
+        self.assertEqual(['host'], schema['required'])
+        self.assertEqual(['host'], ConfiguredQueryRunner.configuration_schema()['properties'].keys())
+
+    def test_reads_limits_from_configuration(self):
+        self.assertEqual(10, BaseQueryRunner({'max_result_rows': 10.0}).max_result_rows)
+        self.assertIsNone(BaseQueryRunner({'max_result_rows': 0}).max_result_rows)
+        self.assertIsNone(BaseQueryRunner({}).max_result_bytes)
+
+    def test_query_timeout_defaults_to_settings(self):
+        self.assertEqual(30, BaseQueryRunner({'query_timeout': 30}).query_timeout)
+        self.assertIsNone(BaseQueryRunner({}).query_timeout)
+
+        with patch.object(settings, 'QUERY_TIMEOUT', 60):
+            self.assertEqual(60, BaseQueryRunner({}).query_timeout)
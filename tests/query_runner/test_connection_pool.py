@@ -0,0 +1,100 @@
+from unittest import TestCase
+
+from mock import patch
+from redash import settings
+from redash.query_runner import BaseQueryRunner, connection_pool
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+
+    def close(self):
+        self.closed = True
+
+
+class PooledQueryRunner(BaseQueryRunner):
+    pool_connections = True
+
+    def connect(self):
+        return FakeConnection()
+
+    def check_connection(self, connection):
+        if connection.broken:
+            raise Exception("Connection is broken.")
+
+    def reset_connection(self, connection):
+        pass
+
+
+def pooled_runner(configuration=None, data_source_id=1):
+    runner = PooledQueryRunner(configuration or {'host': 'localhost'})
+    runner.data_source_id = data_source_id
+    return runner
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        # Starts over with new pools:
+        connection_pool._pools_pid = None
+
+    def test_reuses_released_connections(self):
+        runner = pooled_runner()
+        connection = runner.get_connection()
+        runner.release_connection(connection)
+
+        self.assertIs(connection, pooled_runner().get_connection())
+        self.assertFalse(connection.closed)
+
+    def test_closes_connections_of_runners_without_data_source(self):
+        runner = pooled_runner(data_source_id=None)
+        connection = runner.get_connection()
+        runner.release_connection(connection)
+
+        self.assertTrue(connection.closed)
+        self.assertIsNot(connection, runner.get_connection())
+
+    def test_pools_connections_by_options(self):
+        runner = pooled_runner()
+        connection = runner.get_connection()
+        runner.release_connection(connection)
+
+        self.assertIsNot(connection, pooled_runner({'host': 'example.com'}).get_connection())
+
+    def test_closes_discarded_connections(self):
+        runner = pooled_runner()
+        connection = runner.get_connection()
+        runner.discard_connection(connection)
+        runner.release_connection(connection)
+
+        self.assertTrue(connection.closed)
+        self.assertIsNot(connection, runner.get_connection())
+
+    def test_replaces_broken_connections(self):
+        runner = pooled_runner()
+        connection = runner.get_connection()
+        runner.release_connection(connection)
+        connection.broken = True
+
+        self.assertIsNot(connection, runner.get_connection())
+        self.assertTrue(connection.closed)
+
+    def test_closes_connections_idle_for_too_long(self):
+        runner = pooled_runner()
+        connection = runner.get_connection()
+        runner.release_connection(connection)
+
+        with patch.object(settings, 'QUERY_RUNNER_POOL_MAX_IDLE_TIME', -1):
+            self.assertIsNot(connection, runner.get_connection())
+
+        self.assertTrue(connection.closed)
+
+    def test_keeps_up_to_max_idle_connections(self):
+        runner = pooled_runner()
+        connections = [runner.get_connection(), runner.get_connection()]
+        for connection in connections:
+            runner.release_connection(connection)
+
+        self.assertFalse(connections[0].closed)
+        self.assertTrue(connections[1].closed)
@@ -1,8 +1,15 @@
+import datetime
+import json
 from tests import BaseTestCase
-from redash import redis_connection
-from redash.tasks.queries import QueryTaskTracker, enqueue_query, execute_query
+from redash import export_cache, redis_connection, models, settings
+from redash.tasks.queries import QueryTaskTracker, QueryExecutor, enqueue_query, execute_query, cleanup_query_results, \
+    task_failure_handler, task_postrun_handler, task_revoked_handler, _job_lock_id, acquire_execution_slot, \
+    execution_slots_in_use, QueryExecutionError
+from redash.query_runner import BaseQueryRunner
+from redash.utils import gen_query_hash, utcnow
 from unittest import TestCase
-from mock import MagicMock
+from mock import MagicMock, PropertyMock, patch
+from celery.exceptions import Retry, SoftTimeLimitExceeded
 from collections import namedtuple
 import uuid
 
@@ -68,3 +75,315 @@ class TestEnqueueTask(BaseTestCase):
         self.assertEqual(3, redis_connection.zcard(QueryTaskTracker.WAITING_LIST))
         self.assertEqual(0, redis_connection.zcard(QueryTaskTracker.IN_PROGRESS_LIST))
         self.assertEqual(0, redis_connection.zcard(QueryTaskTracker.DONE_LIST))
+
+    def test_routes_queries_predicted_to_run_long_to_slow_lane(self):
+        query = self.factory.create_query()
+        execute_query.apply_async = MagicMock(side_effect=gen_hash)
+
+        with patch('redash.tasks.queries.runtime_estimator.predict_runtime', return_value=600), \
+                patch.object(settings, 'QUERY_SLOW_LANE_THRESHOLD', 300):
+            job = enqueue_query(query.query, query.data_source, True, {'Username': 'Arik', 'Query ID': query.id})
+
+        self.assertEqual(query.data_source.queue_name + '_slow', execute_query.apply_async.call_args[1]['queue'])
+        self.assertEqual(600, QueryTaskTracker.get_by_task_id(job.id).data['predicted_runtime'])
+
+    def test_keeps_queries_predicted_to_run_quickly_in_their_queue(self):
+        query = self.factory.create_query()
+        execute_query.apply_async = MagicMock(side_effect=gen_hash)
+
+        with patch('redash.tasks.queries.runtime_estimator.predict_runtime', return_value=10), \
+                patch.object(settings, 'QUERY_SLOW_LANE_THRESHOLD', 300):
+            enqueue_query(query.query, query.data_source, True, {'Username': 'Arik', 'Query ID': query.id})
+
+        self.assertEqual(query.data_source.queue_name, execute_query.apply_async.call_args[1]['queue'])
+
+    def test_predicts_runtime_only_for_new_jobs(self):
+        query = self.factory.create_query()
+        execute_query.apply_async = MagicMock(side_effect=gen_hash)
+
+        with patch('redash.tasks.queries.runtime_estimator.predict_runtime', return_value=10) as predict_runtime:
+            enqueue_query(query.query, query.data_source, True, {'Username': 'Arik', 'Query ID': query.id})
+            enqueue_query(query.query, query.data_source, True, {'Username': 'Arik', 'Query ID': query.id})
+
+        self.assertEqual(1, predict_runtime.call_count)
+
+    def test_sets_time_limits_of_data_source_timeout(self):
+        query = self.factory.create_query()
+        execute_query.apply_async = MagicMock(side_effect=gen_hash)
+
+        with patch.object(settings, 'QUERY_TIMEOUT', 30):
+            enqueue_query(query.query, query.data_source, True, {'Username': 'Arik', 'Query ID': query.id})
+
+        self.assertEqual(30, execute_query.apply_async.call_args[1]['soft_time_limit'])
+        self.assertEqual(30 + settings.QUERY_TIMEOUT_GRACE_PERIOD, execute_query.apply_async.call_args[1]['time_limit'])
+
+
+class TestQueryTaskTracker(BaseTestCase):
+    def test_update_merges_fields_and_moves_lists(self):
+        tracker = QueryTaskTracker.create('task', 'created', 'hash', 1, False, {'Username': 'Arik'})
+        tracker.save()
+
+        other = QueryTaskTracker.get_by_task_id('task')
+        tracker.update(state='started', started_at=10.5)
+        other.update(run_time=1.5)
+
+        tracker = QueryTaskTracker.get_by_task_id('task')
+        self.assertEqual('started', tracker.state)
+        self.assertEqual(10.5, tracker.started_at)
+        self.assertEqual(1.5, tracker.run_time)
+        self.assertEqual('Arik', tracker.username)
+        self.assertEqual(0, redis_connection.zcard(QueryTaskTracker.WAITING_LIST))
+        self.assertEqual(1, redis_connection.zcard(QueryTaskTracker.IN_PROGRESS_LIST))
+
+    def test_reads_and_converts_trackers_saved_as_json(self):
+        data = QueryTaskTracker.create('task', 'created', 'hash', 1, False, {}).data
+        redis_connection.set('query_task_tracker:task', json.dumps(data))
+        redis_connection.zadd(QueryTaskTracker.WAITING_LIST, 1, 'query_task_tracker:task')
+
+        self.assertEqual('hash', QueryTaskTracker.all(QueryTaskTracker.WAITING_LIST)[0].query_hash)
+
+        QueryTaskTracker.get_by_task_id('task').update(state='finished')
+
+        self.assertEqual('hash', redis_connection.type('query_task_tracker:task'))
+        self.assertEqual('hash', QueryTaskTracker.get_by_task_id('task').query_hash)
+        self.assertEqual(1, redis_connection.zcard(QueryTaskTracker.DONE_LIST))
+
+
+class TestTrackerSignals(BaseTestCase):
+    def create_tracker(self, state='started'):
+        task_id = uuid.uuid4().hex
+        tracker = QueryTaskTracker.create(task_id, state, 'hash', 1, False, {})
+        tracker.save()
+        redis_connection.set(_job_lock_id('hash', 1), task_id)
+        return tracker
+
+    def test_finishes_tracker_and_unlocks_after_task_run(self):
+        tracker = self.create_tracker()
+
+        task_postrun_handler(None, execute_query, tracker.task_id, execute_query, [], {}, 1, 'SUCCESS')
+
+        self.assertEqual('finished', QueryTaskTracker.get_by_task_id(tracker.task_id).state)
+        self.assertEqual(1, redis_connection.zcard(QueryTaskTracker.DONE_LIST))
+        self.assertFalse(redis_connection.exists(_job_lock_id('hash', 1)))
+
+    def test_fails_tracker_on_task_failure(self):
+        tracker = self.create_tracker()
+
+        task_failure_handler(None, execute_query, tracker.task_id, Exception('boom'), [], {}, None, None)
+
+        tracker = QueryTaskTracker.get_by_task_id(tracker.task_id)
+        self.assertEqual('failed', tracker.state)
+        self.assertEqual('boom', tracker.error)
+
+    def test_cancels_tracker_of_revoked_task(self):
+        tracker = self.create_tracker(state='created')
+
+        task_revoked_handler(None, execute_query, namedtuple('Request', 'id')(tracker.task_id), True, 2, False)
+
+        self.assertEqual('cancelled', QueryTaskTracker.get_by_task_id(tracker.task_id).state)
+        self.assertEqual(0, redis_connection.zcard(QueryTaskTracker.WAITING_LIST))
+
+    def test_releases_execution_slot_of_killed_task(self):
+        tracker = self.create_tracker()
+        acquire_execution_slot(1, tracker.task_id, 1)
+
+        task_failure_handler(None, execute_query, tracker.task_id, Exception('killed'), [], {}, None, None)
+
+        self.assertEqual({1: 0}, execution_slots_in_use([1]))
+
+    def test_keeps_lock_taken_by_another_task(self):
+        tracker = self.create_tracker()
+        redis_connection.set(_job_lock_id('hash', 1), 'another-task')
+
+        task_postrun_handler(None, execute_query, tracker.task_id, execute_query, [], {}, 1, 'SUCCESS')
+
+        self.assertEqual('another-task', redis_connection.get(_job_lock_id('hash', 1)))
+
+
+class TestCleanupQueryResults(BaseTestCase):
+    def test_deletes_unused_results_and_their_stored_data(self):
+        old = utcnow() - datetime.timedelta(days=30)
+        stored_result = self.factory.create_query_result(retrieved_at=old, data='', data_location='filesystem:1/abc')
+        db_result = self.factory.create_query_result(retrieved_at=old)
+        used_result = self.factory.create_query_result(retrieved_at=old)
+        self.factory.create_query(latest_query_data=used_result)
+
+        with patch('redash.tasks.queries.results_storage.remove') as remove:
+            cleanup_query_results()
+            remove.assert_called_once_with('filesystem:1/abc')
+
+        remaining_ids = [r.id for r in models.QueryResult.select()]
+        self.assertNotIn(stored_result.id, remaining_ids)
+        self.assertNotIn(db_result.id, remaining_ids)
+        self.assertIn(used_result.id, remaining_ids)
+
+    def test_removes_cached_exports_of_deleted_results(self):
+        old = utcnow() - datetime.timedelta(days=30)
+        query_result = self.factory.create_query_result(retrieved_at=old)
+        export_cache.put(query_result.id, 'csv', 'a,b\r\n')
+
+        cleanup_query_results()
+
+        self.assertIsNone(export_cache.get(query_result.id, 'csv'))
+
+    def test_removes_stored_responses_of_deleted_results(self):
+        old = utcnow() - datetime.timedelta(days=30)
+        query_result = self.factory.create_query_result(retrieved_at=old, data_size=100)
+        self.factory.create_query_result(retrieved_at=old, data_size=5)
+
+        with patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+                patch('redash.settings.QUERY_RESULTS_STORAGE_MIN_SIZE', 10), \
+                patch('redash.tasks.queries.results_storage.remove_gzipped_json') as remove_gzipped_json:
+            cleanup_query_results()
+            remove_gzipped_json.assert_called_once_with(query_result.org_id, query_result.id)
+
+    def test_keeps_stored_data_used_by_other_results(self):
+        old = utcnow() - datetime.timedelta(days=30)
+        self.factory.create_query_result(retrieved_at=old, data='', data_location='filesystem:1/abc', data_checksum='abc')
+        used_result = self.factory.create_query_result(data='', data_location='filesystem:1/abc', data_checksum='abc')
+        self.factory.create_query(latest_query_data=used_result)
+
+        with patch('redash.tasks.queries.results_storage.remove') as remove:
+            cleanup_query_results()
+            self.assertFalse(remove.called)
+
+    def test_hands_over_data_used_by_other_results(self):
+        old = utcnow() - datetime.timedelta(days=30)
+        holder = self.factory.create_query_result(retrieved_at=old, data='{"columns": [], "rows": [[1]]}',
+                                                  data_checksum='abc')
+        location = 'query_result:{}'.format(holder.id)
+        used_result = self.factory.create_query_result(data='', data_location=location, data_checksum='abc')
+        other_result = self.factory.create_query_result(data='', data_location=location, data_checksum='abc')
+        self.factory.create_query(latest_query_data=used_result)
+        self.factory.create_query(latest_query_data=other_result)
+
+        cleanup_query_results()
+
+        remaining_ids = [r.id for r in models.QueryResult.select()]
+        self.assertNotIn(holder.id, remaining_ids)
+        self.assertEqual('{"columns": [], "rows": [[1]]}', models.QueryResult.get_by_id(used_result.id).data)
+        self.assertEqual('{"columns": [], "rows": [[1]]}', models.QueryResult.get_by_id(other_result.id).data)
+        self.assertIsNone(models.QueryResult.get_by_id(other_result.id).data_location)
+
+
+class StreamingQueryRunner(BaseQueryRunner):
+    def run_query_iter(self, query, user):
+        yield {'columns': [{'name': 'n'}]}
+        for i in range(0, 10, 3):
+            yield [(n,) for n in range(i, min(i + 3, 10))]
+
+
+class TimingOutQueryRunner(BaseQueryRunner):
+    def run_query_iter(self, query, user):
+        yield {'columns': [{'name': 'n'}]}
+        raise SoftTimeLimitExceeded()
+
+
+class TestQueryExecutor(BaseTestCase):
+    def run_query(self, options):
+        task = MagicMock()
+        task.request.id = str(uuid.uuid4())
+        task.request.delivery_info = {'routing_key': 'queries'}
+
+        with patch.object(models.DataSource, 'query_runner', new_callable=PropertyMock) as query_runner, \
+                patch('redash.tasks.queries.check_alerts_for_query'):
+            query_runner.return_value = StreamingQueryRunner(options)
+            executor = QueryExecutor(task, "SELECT n", self.factory.data_source.id, None, {})
+            query_result_id = executor.run()
+
+        return executor.tracker, models.QueryResult.get_by_id(query_result_id)
+
+    def test_stores_streamed_result(self):
+        tracker, query_result = self.run_query({})
+
+        data = json.loads(query_result.data)
+        self.assertEqual([[n] for n in range(10)], data['rows'])
+        self.assertNotIn('truncated', data)
+        self.assertFalse(tracker.truncated)
+
+    def test_truncates_result_over_row_limit(self):
+        tracker, query_result = self.run_query({'max_result_rows': 4})
+
+        data = json.loads(query_result.data)
+        self.assertEqual([[n] for n in range(4)], data['rows'])
+        self.assertTrue(data['truncated'])
+        self.assertTrue(tracker.truncated)
+
+    def test_truncates_result_over_size_limit(self):
+        tracker, query_result = self.run_query({'max_result_bytes': 70})
+
+        data = json.loads(query_result.data)
+        self.assertLessEqual(len(query_result.data), 90)
+        self.assertTrue(0 < len(data['rows']) < 10)
+        self.assertTrue(data['truncated'])
+        self.assertTrue(tracker.truncated)
+
+    def test_retries_when_data_source_has_no_free_execution_slots(self):
+        data_source_id = self.factory.data_source.id
+        self.assertTrue(acquire_execution_slot(data_source_id, 'other-task', 1))
+
+        task = MagicMock()
+        task.request.id = str(uuid.uuid4())
+        task.request.retries = 2
+        task.retry.return_value = Retry()
+
+        with patch.object(models.DataSource, 'query_runner', new_callable=PropertyMock) as query_runner:
+            query_runner.return_value = StreamingQueryRunner({'max_concurrent_queries': 1})
+            executor = QueryExecutor(task, "SELECT n", data_source_id, None, {})
+            self.assertRaises(Retry, executor.run)
+
+        countdown = task.retry.call_args[1]['countdown']
+        self.assertTrue(20 <= countdown <= 30)
+        self.assertEqual('created', executor.tracker.state)
+        self.assertEqual({data_source_id: 1}, execution_slots_in_use([data_source_id]))
+
+    def test_gives_up_waiting_for_execution_slot(self):
+        data_source_id = self.factory.data_source.id
+        self.assertTrue(acquire_execution_slot(data_source_id, 'other-task', 1))
+
+        task = MagicMock()
+        task.request.id = str(uuid.uuid4())
+        task.request.retries = 50
+
+        with patch.object(models.DataSource, 'query_runner', new_callable=PropertyMock) as query_runner:
+            query_runner.return_value = StreamingQueryRunner({'max_concurrent_queries': 1})
+            executor = QueryExecutor(task, "SELECT n", data_source_id, None, {})
+            executor.tracker.data['created_at'] -= settings.QUERY_CONCURRENCY_MAX_WAIT
+            self.assertRaises(QueryExecutionError, executor.run)
+
+        self.assertFalse(task.retry.called)
+
+    def test_releases_execution_slot_when_run_fails_before_query(self):
+        task = MagicMock()
+        task.request.id = str(uuid.uuid4())
+        task.request.delivery_info = {'routing_key': 'queries'}
+
+        with patch.object(models.DataSource, 'query_runner', new_callable=PropertyMock) as query_runner, \
+                patch.object(QueryExecutor, '_annotate_query', side_effect=ValueError):
+            query_runner.return_value = StreamingQueryRunner({'max_concurrent_queries': 1})
+            executor = QueryExecutor(task, "SELECT n", self.factory.data_source.id, None, {})
+            self.assertRaises(ValueError, executor.run)
+
+        self.assertEqual({self.factory.data_source.id: 0}, execution_slots_in_use([self.factory.data_source.id]))
+
+    def test_releases_execution_slot(self):
+        tracker, query_result = self.run_query({'max_concurrent_queries': 1})
+
+        self.assertIsNotNone(query_result)
+        self.assertEqual({self.factory.data_source.id: 0}, execution_slots_in_use([self.factory.data_source.id]))
+
+    def test_times_out_and_unlocks_query(self):
+        task = MagicMock()
+        task.request.id = str(uuid.uuid4())
+        task.request.delivery_info = {'routing_key': 'queries'}
+        lock_id = _job_lock_id(gen_query_hash("SELECT n"), self.factory.data_source.id)
+        redis_connection.set(lock_id, task.request.id)
+
+        with patch.object(models.DataSource, 'query_runner', new_callable=PropertyMock) as query_runner:
+            query_runner.return_value = TimingOutQueryRunner({'query_timeout': 10})
+            executor = QueryExecutor(task, "SELECT n", self.factory.data_source.id, None, {})
+            result = executor.run()
+
+        self.assertIsInstance(result, QueryExecutionError)
+        self.assertEqual('timed_out', executor.tracker.state)
+        self.assertIsNone(redis_connection.get(lock_id))
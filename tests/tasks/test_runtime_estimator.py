@@ -0,0 +1,30 @@
+from unittest import TestCase
+from tests import BaseTestCase
+from redash.tasks import runtime_estimator
+from redash.utils import gen_query_hash
+
+
+class TestPercentile(TestCase):
+    def test_interpolates_between_closest_ranks(self):
+        self.assertEqual(2.5, runtime_estimator.percentile([4, 1, 3, 2], 50))
+        self.assertEqual(4, runtime_estimator.percentile([4, 1, 3, 2], 100))
+        self.assertEqual(7, runtime_estimator.percentile([7], 90))
+
+
+class TestPredictRuntime(BaseTestCase):
+    def test_uses_runtimes_of_the_query(self):
+        for runtime in [1, 2, 3, 4, 100]:
+            self.factory.create_query_result(query="SELECT 1", query_hash=gen_query_hash("SELECT 1"), runtime=runtime)
+        self.factory.create_query_result(query="SELECT 2", query_hash=gen_query_hash("SELECT 2"), runtime=1000)
+
+        prediction = runtime_estimator.predict_runtime(self.factory.data_source.id, gen_query_hash("SELECT 1"))
+        self.assertAlmostEqual(61.6, prediction)
+
+    def test_falls_back_to_runtimes_of_the_data_source(self):
+        self.factory.create_query_result(query="SELECT 2", query_hash=gen_query_hash("SELECT 2"), runtime=10)
+
+        prediction = runtime_estimator.predict_runtime(self.factory.data_source.id, gen_query_hash("SELECT 1"))
+        self.assertEqual(10, prediction)
+
+    def test_returns_none_without_results(self):
+        self.assertIsNone(runtime_estimator.predict_runtime(self.factory.data_source.id, gen_query_hash("SELECT 1")))
@@ -0,0 +1,48 @@
+from mock import patch
+from tests import BaseTestCase
+from redash import redis_connection, settings
+from redash.tasks import scheduler
+
+
+class TestScheduler(BaseTestCase):
+    def dispatch(self, queue_name='queries'):
+        with patch.object(scheduler.celery, 'send_task') as send_task:
+            scheduler.dispatch(queue_name)
+
+        return [call[1]['task_id'] for call in send_task.call_args_list]
+
+    def test_dispatches_by_fair_share_of_orgs_and_users(self):
+        for i in range(3):
+            scheduler.enqueue('queries', 'a{}'.format(i), [], 1, 1, False)
+        scheduler.enqueue('queries', 'b0', [], 1, 2, False)
+        scheduler.enqueue('queries', 'c0', [], 2, 3, False)
+        scheduler.enqueue('queries', 'c1', [], 2, 3, False)
+
+        self.assertEqual(['a0', 'c0', 'b0', 'c1', 'a1', 'a2'], self.dispatch())
+
+    def test_dispatches_interactive_queries_first(self):
+        scheduler.enqueue('queries', 's0', [], 1, 1, True)
+        scheduler.enqueue('queries', 'i0', [], 1, 1, False)
+
+        self.assertEqual(['i0', 's0'], self.dispatch())
+
+    def test_uses_org_weights(self):
+        for i in range(3):
+            scheduler.enqueue('queries', 'x{}'.format(i), [], 1, 1, False)
+            scheduler.enqueue('queries', 'y{}'.format(i), [], 2, 2, False)
+
+        with patch.object(settings, 'QUERY_SCHEDULER_ORG_WEIGHTS', {1: 2}):
+            self.assertEqual(['x0', 'y0', 'x1', 'x2', 'y1', 'y2'], self.dispatch())
+
+    def test_limits_tasks_in_flight(self):
+        for i in range(3):
+            scheduler.enqueue('queries', 't{}'.format(i), [], 1, 1, False)
+
+        with patch.object(settings, 'QUERY_SCHEDULER_MAX_IN_FLIGHT', 2):
+            self.assertEqual(['t0', 't1'], self.dispatch())
+
+            with patch.object(scheduler.celery, 'send_task') as send_task:
+                scheduler.release('t0')
+
+        self.assertEqual('t2', send_task.call_args[1]['task_id'])
+        self.assertEqual(2, redis_connection.zcard('query_scheduler:queries:in_flight'))
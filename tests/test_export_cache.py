@@ -0,0 +1,42 @@
+from mock import patch
+from tests import BaseTestCase
+from redash import export_cache, settings
+
+
+class TestExportCache(BaseTestCase):
+    def test_put_and_get(self):
+        export_cache.put(1, 'csv', 'a,b\r\n')
+
+        self.assertEqual('a,b\r\n', export_cache.get(1, 'csv'))
+        self.assertIsNone(export_cache.get(1, 'xlsx'))
+        self.assertIsNone(export_cache.get(1, 'csv', {'sheet': 'x'}))
+
+    def test_doesnt_cache_exports_bigger_than_max_export_size(self):
+        with patch.object(settings, 'QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE', 40):
+            export_cache.put(1, 'csv', 'x' * 11)
+
+        self.assertIsNone(export_cache.get(1, 'csv'))
+
+    def test_evicts_least_recently_used_exports(self):
+        with patch.object(settings, 'QUERY_RESULTS_EXPORT_CACHE_MAX_SIZE', 40):
+            export_cache.put(1, 'csv', 'x' * 10)
+            export_cache.put(2, 'csv', 'x' * 10)
+            export_cache.put(3, 'csv', 'x' * 10)
+            export_cache.get(1, 'csv')
+            export_cache.put(4, 'csv', 'x' * 10)
+            export_cache.put(5, 'csv', 'x' * 10)
+
+            self.assertIsNotNone(export_cache.get(1, 'csv'))
+            self.assertIsNone(export_cache.get(2, 'csv'))
+            self.assertIsNotNone(export_cache.get(5, 'csv'))
+
+    def test_invalidate(self):
+        export_cache.put(1, 'csv', 'a')
+        export_cache.put(1, 'xlsx', 'b')
+        export_cache.put(2, 'csv', 'c')
+
+        export_cache.invalidate([1])
+
+        self.assertIsNone(export_cache.get(1, 'csv'))
+        self.assertIsNone(export_cache.get(1, 'xlsx'))
+        self.assertEqual('c', export_cache.get(2, 'csv'))
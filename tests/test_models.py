@@ -1,12 +1,15 @@
 #encoding: utf8
 import datetime
 import json
+import shutil
+import tempfile
 from unittest import TestCase
 import mock
 from dateutil.parser import parse as date_parse
 from tests import BaseTestCase
-from redash import models
-from redash.utils import gen_query_hash, utcnow
+from redash import models, results_storage
+from redash.query_runner import QueryResultWriter
+from redash.utils import gen_query_hash, utcnow, compression
 
 
 class DashboardTest(BaseTestCase):
@@ -401,6 +404,40 @@ class QueryResultTest(BaseTestCase):
         self.assertEqual(found_query_result.id, qr.id)
 
 
+class TestQueryResultDeferredData(BaseTestCase):
+    def test_doesnt_select_data_by_default(self):
+        qr = self.factory.create_query_result(data='{"rows": [], "columns": []}')
+
+        query_result = models.QueryResult.get_by_id(qr.id)
+
+        self.assertNotIn('data', query_result._data)
+        self.assertEqual(query_result.runtime, qr.runtime)
+
+    def test_loads_data_on_access(self):
+        qr = self.factory.create_query_result(data='{"rows": [], "columns": []}')
+
+        query_result = models.QueryResult.get_by_id(qr.id)
+
+        self.assertEqual(query_result.data, '{"rows": [], "columns": []}')
+        self.assertEqual(query_result.to_dict()['data'], {"rows": [], "columns": []})
+
+    def test_selects_data_when_requested(self):
+        qr = self.factory.create_query_result(data='{"rows": [], "columns": []}')
+
+        query_result = models.QueryResult.select(models.QueryResult).where(models.QueryResult.id == qr.id).get()
+
+        self.assertIn('data', query_result._data)
+
+    def test_save_doesnt_override_data(self):
+        qr = self.factory.create_query_result(data='{"rows": [], "columns": []}')
+
+        query_result = models.QueryResult.get_by_id(qr.id)
+        query_result.runtime = 2
+        query_result.save()
+
+        self.assertEqual(models.QueryResult.get_by_id(qr.id).data, '{"rows": [], "columns": []}')
+
+
 class TestUnusedQueryResults(BaseTestCase):
     def test_returns_only_unused_query_results(self):
         two_weeks_ago = datetime.datetime.now() - datetime.timedelta(days=14)
@@ -498,6 +535,130 @@ class TestQueryResultStoreResult(BaseTestCase):
         self.assertEqual(query_result.query_hash, self.query_hash)
         self.assertEqual(query_result.data_source, self.data_source)
 
+    def test_stores_big_results_compressed(self):
+        data = json.dumps({'columns': [{'name': 'value'}], 'rows': [{'value': i} for i in range(1000)]})
+        query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id, self.query_hash,
+                                                          self.query, data, self.runtime, self.utcnow)
+
+        raw_data = models.db.database.execute_sql("SELECT data FROM query_results WHERE id = %s",
+                                                  params=(query_result.id,)).fetchone()[0]
+        self.assertTrue(compression.is_compressed(raw_data))
+        self.assertLess(len(raw_data), len(data))
+        self.assertEqual(models.QueryResult.get_by_id(query_result.id).data, data)
+
+    def test_stores_big_results_in_results_storage(self):
+        path = tempfile.mkdtemp()
+        data = json.dumps({'columns': [{'name': 'value'}], 'rows': [{'value': i} for i in range(1000)]})
+
+        try:
+            with mock.patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+                 mock.patch('redash.settings.QUERY_RESULTS_STORAGE_MIN_SIZE', 1024), \
+                 mock.patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', path), \
+                 mock.patch.dict(results_storage._instances, clear=True):
+                query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                                  self.query_hash, self.query, data, self.runtime,
+                                                                  self.utcnow)
+
+                self.assertTrue(query_result.data_location.startswith('filesystem:'))
+                self.assertEqual(len(data), query_result.data_size)
+                self.assertIsNotNone(query_result.data_checksum)
+
+                raw_data = models.db.database.execute_sql("SELECT data FROM query_results WHERE id = %s",
+                                                          params=(query_result.id,)).fetchone()[0]
+                self.assertEqual('', raw_data)
+                self.assertEqual(data, models.QueryResult.get_by_id(query_result.id).data)
+
+                other_query = "SELECT 2"
+                other_query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                                        gen_query_hash(other_query), other_query, data,
+                                                                        self.runtime, self.utcnow)
+                self.assertNotEqual(query_result.id, other_query_result.id)
+                self.assertEqual(query_result.data_location, other_query_result.data_location)
+        finally:
+            shutil.rmtree(path)
+
+    def test_stores_precompressed_results(self):
+        data = json.dumps({'columns': [{'name': 'value'}], 'rows': [{'value': i} for i in range(1000)]})
+        checksum, size = results_storage.data_checksum(data)
+
+        query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                          self.query_hash, self.query, compression.compress(data),
+                                                          self.runtime, self.utcnow, data_checksum=checksum,
+                                                          data_size=size)
+
+        self.assertEqual(checksum, query_result.data_checksum)
+        self.assertEqual(size, query_result.data_size)
+        self.assertEqual(data, models.QueryResult.get_by_id(query_result.id).data)
+
+    def test_returns_precompressed_results_uncompressed(self):
+        writer = QueryResultWriter({'columns': [{'name': 'value'}]}, compress=True)
+        writer.write_rows([(i,) for i in range(1000)])
+        data = writer.finish()
+
+        query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                          self.query_hash, self.query, data, self.runtime, self.utcnow,
+                                                          data_checksum=writer.checksum, data_size=writer.size,
+                                                          data_index=writer.index)
+
+        self.assertTrue(compression.is_compressed(data))
+        self.assertEqual(compression.decompress(data), query_result.data)
+        self.assertEqual([[i] for i in range(10, 15)], query_result.get_data_slice(10, 5)['rows'])
+        self.assertEqual(1000, len(list(query_result.iter_rows()[1])))
+
+    def test_stores_a_new_result_for_the_same_data(self):
+        query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id, self.query_hash,
+                                                          self.query, self.data, self.runtime, self.utcnow)
+        retrieved_at = self.utcnow + datetime.timedelta(hours=1)
+        second_query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                                 self.query_hash, self.query, self.data, 5,
+                                                                 retrieved_at)
+
+        self.assertNotEqual(query_result.id, second_query_result.id)
+
+        query_result = models.QueryResult.get_by_id(query_result.id)
+        self.assertEqual(self.utcnow, query_result.retrieved_at)
+        self.assertEqual(self.runtime, query_result.runtime)
+        self.assertEqual(self.data, models.QueryResult.get_by_id(second_query_result.id).data)
+
+    def test_stores_identical_data_in_the_database_once(self):
+        query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id, self.query_hash,
+                                                          self.query, self.data, self.runtime, self.utcnow)
+        other_query = "SELECT 2"
+        other_query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                                gen_query_hash(other_query), other_query, self.data,
+                                                                self.runtime, self.utcnow)
+
+        stored_count = models.db.database.execute_sql("SELECT COUNT(*) FROM query_results WHERE data = %s",
+                                                      params=(self.data,)).fetchone()[0]
+        self.assertEqual(1, stored_count)
+        self.assertEqual('query_result:{}'.format(query_result.id), other_query_result.data_location)
+        self.assertEqual(self.data, models.QueryResult.get_by_id(other_query_result.id).data)
+
+    def test_reuses_stored_data_with_same_checksum(self):
+        path = tempfile.mkdtemp()
+        data = json.dumps({'columns': [{'name': 'value'}], 'rows': [{'value': i} for i in range(1000)]})
+
+        try:
+            with mock.patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+                 mock.patch('redash.settings.QUERY_RESULTS_STORAGE_MIN_SIZE', 1024), \
+                 mock.patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', path), \
+                 mock.patch.dict(results_storage._instances, clear=True):
+                query_result, _ = models.QueryResult.store_result(self.data_source.org_id, self.data_source.id,
+                                                                  self.query_hash, self.query, data, self.runtime,
+                                                                  self.utcnow)
+
+                with mock.patch('redash.results_storage.store') as store:
+                    second_query_result, _ = models.QueryResult.store_result(self.data_source.org_id,
+                                                                             self.data_source.id, self.query_hash,
+                                                                             self.query, data, 5, self.utcnow)
+                    self.assertFalse(store.called)
+
+                self.assertNotEqual(query_result.id, second_query_result.id)
+                self.assertEqual(query_result.data_location, second_query_result.data_location)
+                self.assertEqual(data, models.QueryResult.get_by_id(second_query_result.id).data)
+        finally:
+            shutil.rmtree(path)
+
     def test_updates_existing_queries(self):
         query1 = self.factory.create_query(query=self.query)
         query2 = self.factory.create_query(query=self.query)
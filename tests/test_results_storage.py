@@ -0,0 +1,62 @@
+# encoding: utf8
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+from redash import results_storage
+from redash.results_storage.filesystem import FileSystem
+
+
+class TestFileSystemResultsStorage(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.patcher = patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', self.path)
+        self.patcher.start()
+        self.storage = FileSystem()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.path)
+
+    def test_put_and_get(self):
+        self.storage.put('1/abc', 'value')
+        self.assertEqual('value', self.storage.get('1/abc'))
+
+    def test_delete(self):
+        self.storage.put('1/abc', 'value')
+        self.storage.delete('1/abc')
+        self.assertFalse(os.path.exists(os.path.join(self.path, '1/abc')))
+
+    def test_get_raises_key_error_for_missing_keys(self):
+        self.assertRaises(KeyError, self.storage.get, '1/missing')
+
+    def test_delete_ignores_missing_keys(self):
+        self.storage.delete('1/missing')
+
+
+class TestResultsStorage(TestCase):
+    def test_should_store_externally(self):
+        with patch('redash.settings.QUERY_RESULTS_STORAGE', ''):
+            self.assertFalse(results_storage.should_store_externally(10 * 1024 * 1024))
+
+        with patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+             patch('redash.settings.QUERY_RESULTS_STORAGE_MIN_SIZE', 100):
+            self.assertFalse(results_storage.should_store_externally(99))
+            self.assertTrue(results_storage.should_store_externally(100))
+
+    def test_store_load_and_remove(self):
+        path = tempfile.mkdtemp()
+        try:
+            with patch('redash.settings.QUERY_RESULTS_STORAGE', 'filesystem'), \
+                 patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', path), \
+                 patch.dict(results_storage._instances, clear=True):
+                location = results_storage.store(1, u'{"rows": [{"name": "ש"}]}', 'checksum')
+                self.assertEqual('filesystem:1/checksum', location)
+                self.assertEqual(u'{"rows": [{"name": "ש"}]}', results_storage.load(location))
+
+                results_storage.remove(location)
+                self.assertEqual([], os.listdir(os.path.join(path, '1')))
+        finally:
+            shutil.rmtree(path)
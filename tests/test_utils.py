@@ -1,4 +1,13 @@
-from redash.utils import build_url, collect_query_parameters, collect_parameters_from_request
+import base64
+import gzip
+import json
+import struct
+import zlib
+from StringIO import StringIO
+
+from mock import patch
+from redash.utils import arrow, build_url, collect_query_parameters, collect_parameters_from_request, columnar, \
+    compression, generate_csv, generate_ndjson, json_dumps, RawJSON, result_format
 from collections import namedtuple
 from unittest import TestCase
 
@@ -49,3 +58,219 @@ class TestCollectParametersFromRequest(TestCase):
 
     def test_takes_prefixed_values(self):
         self.assertDictEqual({'test': 1, 'something_else': 'test'}, collect_parameters_from_request({'p_test': 1, 'p_something_else': 'test'}))
+
+
+class TestCompression(TestCase):
+    def test_roundtrip(self):
+        data = u'{"columns": [{"name": "text"}], "rows": [{"text": "\u05e9\u05dc\u05d5\u05dd"}]}'
+        compressed = compression.compress(data)
+
+        self.assertTrue(compression.is_compressed(compressed))
+        self.assertEqual(data, compression.decompress(compressed))
+
+    def test_gzip_compress(self):
+        data = u'{"rows": ["\u05e9"]}'
+        compressed = compression.gzip_compress(data)
+
+        self.assertEqual(data.encode('utf-8'), gzip.GzipFile(fileobj=StringIO(compressed)).read())
+        self.assertEqual(compressed, compression.gzip_compress(data))
+
+    def test_returns_legacy_values_as_is(self):
+        self.assertFalse(compression.is_compressed('{"rows": []}'))
+        self.assertEqual('{"rows": []}', compression.decompress('{"rows": []}'))
+        self.assertIsNone(compression.decompress(None))
+
+    def test_doesnt_compress_twice(self):
+        compressed = compression.compress('{"rows": []}')
+        self.assertEqual(compressed, compression.compress(compressed))
+
+    def test_compressor(self):
+        compressor = compression.Compressor()
+        compressor.write('{"rows": ')
+        compressor.write(u'["\u05e9\u05dc\u05d5\u05dd"]}')
+
+        self.assertEqual(u'{"rows": ["\u05e9\u05dc\u05d5\u05dd"]}', compression.decompress(compressor.finish()))
+
+    def test_decompresses_zlib1_values(self):
+        value = compression.FORMAT_MARKER + u'zlib1:' + base64.b64encode(zlib.compress('{"rows": []}'))
+        self.assertEqual('{"rows": []}', compression.decompress(value))
+
+    def test_decompresses_blocks(self):
+        compressor = compression.Compressor()
+        compressor.write('{"rows": [')
+        start = compressor.start_block()
+        compressor.write('1, 2')
+        end = compressor.start_block()
+        compressor.write(']}')
+        value = compressor.finish()
+
+        self.assertEqual('{"rows": [1, 2]}', compression.decompress(value))
+        self.assertEqual('1, 2', compression.decompress_blocks(value, start, end))
+        self.assertEqual('1, 2]}', compression.decompress_blocks(value, start))
+
+    def test_decompresses_in_chunks(self):
+        data = '{"rows": [' + ', '.join(str(i) for i in range(100)) + ']}'
+        for value in [data, compression.compress(data), compression.FORMAT_MARKER + u'zlib1:' +
+                      base64.b64encode(zlib.compress(data))]:
+            chunks = list(compression.iter_decompressed(value, chunk_size=16))
+            self.assertEqual(data, ''.join(chunks))
+            self.assertGreater(len(chunks), 2)
+
+    def test_raises_on_unknown_format(self):
+        with self.assertRaises(compression.UnsupportedFormatError):
+            compression.decompress(compression.FORMAT_MARKER + u'zlib99:abc')
+
+
+class TestJsonDumpsRawJSON(TestCase):
+    def test_includes_raw_values_as_is(self):
+        data = u'{"rows": [{"text": "\u05e9\u05dc\u05d5\u05dd"}], "columns": []}'
+        output = json_dumps({'query_result': {'id': 1, 'data': RawJSON(data)}})
+
+        self.assertIn(data, output)
+        self.assertEqual({'query_result': {'id': 1, 'data': json.loads(data)}}, json.loads(output))
+
+    def test_handles_multiple_raw_values(self):
+        output = json_dumps([RawJSON('{"a": 1}'), RawJSON('[2]'), "\u0000raw-json:0"])
+        self.assertEqual([{"a": 1}, [2], "\u0000raw-json:0"], json.loads(output))
+
+
+class TestResultFormat(TestCase):
+    def setUp(self):
+        self.v1 = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': 1, 'b': 'x'}, {'a': 2}]}
+        self.v2 = {'format': 2, 'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [[1, 'x'], [2, None]]}
+
+    def test_convert(self):
+        self.assertEqual(self.v2, result_format.convert(self.v1, result_format.V2))
+        self.assertEqual({'columns': self.v1['columns'], 'rows': [{'a': 1, 'b': 'x'}, {'a': 2, 'b': None}]},
+                         result_format.convert(self.v2, result_format.V1))
+        self.assertIs(self.v1, result_format.convert(self.v1, result_format.V1))
+
+    def test_iter_row_values(self):
+        self.assertEqual([[1, 'x'], [2, None]], list(result_format.iter_row_values(self.v1)))
+        self.assertEqual([[1, 'x'], [2, None]], list(result_format.iter_row_values(self.v2)))
+
+    def test_row_as_dict(self):
+        self.assertEqual({'a': 1, 'b': 'x'}, result_format.row_as_dict(self.v1, 0))
+        self.assertEqual({'a': 1, 'b': 'x'}, result_format.row_as_dict(self.v2, 0))
+
+    def test_get_serialized_format(self):
+        self.assertEqual(result_format.V1, result_format.get_serialized_format(json.dumps(self.v1)))
+        self.assertEqual(result_format.V2, result_format.get_serialized_format(
+            result_format.serialize_header({}, result_format.V2) + ']}'))
+
+    def test_project_columns(self):
+        self.assertEqual({'format': 2, 'columns': [{'name': 'b'}], 'rows': [['x'], [None]]},
+                         result_format.project_columns(self.v2, ['b']))
+        self.assertEqual({'columns': [{'name': 'b'}, {'name': 'a'}], 'rows': [{'a': 1, 'b': 'x'}, {'a': 2, 'b': None}]},
+                         result_format.project_columns(self.v1, ['b', 'a']))
+
+        with self.assertRaises(result_format.UnknownColumnsError):
+            result_format.project_columns(self.v1, ['c'])
+
+
+class TestColumnarExecute(TestCase):
+    data = {
+        'format': 2,
+        'columns': [{'name': 'country', 'type': 'string'}, {'name': 'amount', 'type': 'integer'}],
+        'rows': [['US', 10], ['CA', 5], ['US', 20], ['FR', None], ['CA', 1]]
+    }
+
+    def test_filters_and_sorts_rows(self):
+        output = columnar.execute(self.data, {'filters': [{'column': 'amount', 'op': 'gte', 'value': 5}],
+                                              'order_by': [{'column': 'amount', 'direction': 'desc'}],
+                                              'limit': 2})
+
+        self.assertEqual(self.data['columns'], output['columns'])
+        self.assertEqual([['US', 20], ['US', 10]], output['rows'])
+
+    def test_groups_and_aggregates(self):
+        output = columnar.execute(self.data, {'group_by': ['country'],
+                                              'aggregations': [{'function': 'sum', 'column': 'amount', 'name': 'total'},
+                                                               {'function': 'avg', 'column': 'amount'},
+                                                               {'function': 'count'}],
+                                              'order_by': [{'column': 'total'}]})
+
+        self.assertEqual(['country', 'total', 'avg_amount', 'count'], result_format.column_names(output))
+        self.assertEqual([['FR', 0, None, 1], ['CA', 6, 3.0, 2], ['US', 30, 15.0, 2]], output['rows'])
+
+    def test_aggregates_v1_results_without_grouping(self):
+        data = result_format.convert(self.data, result_format.V1)
+        output = columnar.execute(data, {'filters': [{'column': 'country', 'op': 'in', 'value': ['US', 'FR']}],
+                                         'aggregations': [{'function': 'max', 'column': 'amount'},
+                                                          {'function': 'count', 'column': 'amount'}]})
+
+        self.assertEqual([[20, 2]], output['rows'])
+
+    def test_raises_for_invalid_spec(self):
+        for spec in [{'filters': [{'column': 'amount', 'op': 'like', 'value': 1}]},
+                     {'aggregations': [{'function': 'sum'}]},
+                     {'order_by': [{'column': 'nope'}]},
+                     {'unknown': True}]:
+            self.assertRaises(columnar.InvalidSpecError, columnar.execute, self.data, spec)
+
+    def test_raises_for_invalid_filter_values(self):
+        spec = {'filters': [{'column': 'country', 'op': 'contains', 'value': 1}]}
+        self.assertRaises(columnar.InvalidSpecError, columnar.execute, self.data, spec)
+
+    def test_filters_json_values_with_in(self):
+        data = {'columns': [{'name': 'tags'}], 'rows': [{'tags': ['a']}, {'tags': {'b': 1}}, {'tags': 'c'}]}
+
+        output = columnar.execute(data, {'filters': [{'column': 'tags', 'op': 'in', 'value': [['a'], {'b': 1}]}]})
+
+        self.assertEqual([[['a']], [{'b': 1}]], output['rows'])
+
+    def test_groups_by_json_values(self):
+        data = {'columns': [{'name': 'tags'}, {'name': 'n'}],
+                'rows': [{'tags': ['a'], 'n': 1}, {'tags': {'b': 1}, 'n': 2}, {'tags': ['a'], 'n': 3}]}
+
+        output = columnar.execute(data, {'group_by': ['tags'], 'aggregations': [{'function': 'sum', 'column': 'n'}]})
+
+        self.assertEqual([[['a'], 4], [{'b': 1}, 2]], output['rows'])
+
+    def test_raises_for_numeric_aggregations_of_non_numeric_columns(self):
+        for function in ['sum', 'avg']:
+            spec = {'aggregations': [{'function': function, 'column': 'country'}]}
+            self.assertRaises(columnar.InvalidSpecError, columnar.execute, self.data, spec)
+
+        output = columnar.execute(self.data, {'aggregations': [{'function': 'max', 'column': 'country'}]})
+        self.assertEqual([['US']], output['rows'])
+
+
+class TestGenerateCSV(TestCase):
+    def test_yields_csv_in_chunks(self):
+        chunks = list(generate_csv([u'a', u'b'], ([i, u'\u05d0'] for i in range(5)), chunk_rows=2))
+
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(u'a,b\r\n0,\u05d0\r\n1,\u05d0\r\n'.encode('utf-8'), chunks[0])
+        self.assertEqual(u'4,\u05d0\r\n'.encode('utf-8'), chunks[-1])
+
+
+class TestGenerateNDJSON(TestCase):
+    def test_yields_a_line_per_row_in_chunks(self):
+        chunks = list(generate_ndjson([u'a', u'b'], ([i, u'\u05d0'] for i in range(5)), chunk_rows=2))
+
+        self.assertEqual(3, len(chunks))
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(5, len(lines))
+        self.assertEqual({'a': 4, 'b': u'\u05d0'}, json.loads(lines[-1]))
+
+
+class TestArrowStream(TestCase):
+    columns = [{'name': 'a', 'type': 'integer'}, {'name': 'b', 'type': 'datetime'}, {'name': 'c'}]
+
+    def test_converts_values_by_column_type(self):
+        types = [arrow.column_type(column) for column in self.columns]
+        batches = list(arrow._iter_batches(types, [[1, '2016-01-01T00:00:01', 'x'], ['y', None, {'d': 1}]], 10))
+
+        self.assertEqual([[[1, None], [1451606401000, None], ['x', '{"d": 1}']]], batches)
+
+    def test_writes_a_record_batch_per_chunk(self):
+        with patch.object(arrow, 'pyarrow', None):
+            chunks = list(arrow.generate_stream(self.columns, ([i, None, u'\u05d0'] for i in range(5)), chunk_rows=2))
+
+        # Schema, 3 record batches and the end of stream marker:
+        self.assertEqual(5, len(chunks))
+        for chunk in chunks[:-1]:
+            self.assertEqual(0xFFFFFFFF, struct.unpack('<I', chunk[:4])[0])
+            self.assertEqual(0, len(chunk) % 8)
+        self.assertEqual(struct.pack('<Ii', 0xFFFFFFFF, 0), chunks[-1])